@@ -18,9 +18,15 @@ from .private_tags import add_private_tags
 
 DEFAULT_CONFIG_PATH = '~/.config/flywheel/cli.cfg'
 CLI_LOG_PATH = '~/.cache/flywheel/logs/cli.log'
+DEFAULT_HEADER_CACHE_PATH = '~/.cache/flywheel/header_cache.db'
+DEFAULT_PACKFILE_CACHE_PATH = '~/.cache/flywheel/packfiles'
 
 RE_CONFIG_LINE = re.compile(r'^\s*([-_a-zA-Z0-9]+)\s*([:=]\s*(.+?))?\s*$')
 
+# Upper and starting bounds for --concurrent-uploads auto
+AUTO_MAX_CONCURRENT_UPLOADS = 16
+AUTO_INITIAL_CONCURRENT_UPLOADS = 2
+
 
 class Config(object):
     def __init__(self, args=None):
@@ -29,7 +35,7 @@ class Config(object):
         # Configure logging
         self.configure_logging(args)
 
-        # Set the default compression (used by zipfile/ZipFS)
+        # Set the default compression (used by zipfile)
         self.compression_level = getattr(args, 'compression_level', 1)
         if self.compression_level > 0:
             zlib.Z_DEFAULT_COMPRESSION = self.compression_level
@@ -38,12 +44,34 @@ class Config(object):
         if self.cpu_count == -1:
             self.cpu_count = max(1, math.floor(multiprocessing.cpu_count() / 2))
 
+        self.packfile_processes = getattr(args, 'packfile_processes', False)
+        self.compress_threads = getattr(args, 'compress_threads', 1)
+        self.compression_policy = getattr(args, 'compression_policy', 'none')
+        self.scan_processes = getattr(args, 'scan_processes', False)
+        self.header_cache = getattr(args, 'header_cache', False)
+        self.header_cache_path = os.environ.get('FW_HEADER_CACHE_PATH', DEFAULT_HEADER_CACHE_PATH)
+        self.packfile_cache_size = getattr(args, 'packfile_cache_size', 0) * (1024 * 1024)
+        self.packfile_cache_path = os.environ.get('FW_PACKFILE_CACHE_PATH', DEFAULT_PACKFILE_CACHE_PATH)
+
         self.concurrent_uploads = getattr(args, 'concurrent_uploads', 4)
+        self.initial_concurrent_uploads = self.concurrent_uploads
+        self.adaptive_uploads = (self.concurrent_uploads == 'auto')
+        if self.adaptive_uploads:
+            self.concurrent_uploads = AUTO_MAX_CONCURRENT_UPLOADS
+            self.initial_concurrent_uploads = AUTO_INITIAL_CONCURRENT_UPLOADS
 
         self.follow_symlinks = getattr(args, 'symlinks', False)
+        self.list_threads = getattr(args, 'list_threads', 1)
+        self.s3_flat_listing = getattr(args, 's3_flat_listing', False)
+        self.s3_cache_size = getattr(args, 's3_cache_size', 0) * (1024 * 1024)
 
         self.buffer_size = 65536
         self.max_spool = getattr(args, 'max_tempfile', 50) * (1024 * 1024)  # Max tempfile size before rolling over to disk
+        self.tmp_dir = getattr(args, 'tmp_dir', None)  # Where tar members are staged, None for the system default
+        self.memory_budget = getattr(args, 'memory_budget', 0) * (1024 * 1024)  # Max buffered upload data, or 0 for no limit
+        self.stream_packfiles = getattr(args, 'stream_packfiles', False)
+        self.bulk_resolve = getattr(args, 'bulk_resolve', False)
+        self.pipelined_import = getattr(args, 'pipeline', False)
 
         # Assume yes option
         self.assume_yes = getattr(args, 'yes', False)
@@ -114,6 +142,14 @@ class Config(object):
             return zipfile.ZIP_STORED
         return zipfile.ZIP_DEFLATED
 
+    def get_compression_policy(self):
+        """Get the policy for choosing the compression of packfile members, or None"""
+        if self.compression_policy == 'none' or self.get_compression_type() != zipfile.ZIP_DEFLATED:
+            return None
+
+        from .importers.compression_policy import CompressionPolicy
+        return CompressionPolicy(trial=(self.compression_policy == 'trial'))
+
     def load_deid_profile(self, name, args=None):
         if os.path.isfile(name):
             return deidentify.load_profile(name)
@@ -136,7 +172,10 @@ class Config(object):
                 self._resolver = FSWrapper(self.output_folder)
             else:
                 fw = create_flywheel_client()
-                self._resolver = SdkUploadWrapper(fw)
+                # List children no faster than uploads may start, so bulk resolve stays within the
+                # request rate that --concurrent-uploads (or its adaptive starting point) allows
+                self._resolver = SdkUploadWrapper(fw, bulk_resolve=self.bulk_resolve,
+                    resolve_threads=self.initial_concurrent_uploads)
 
         return self._resolver
 
@@ -149,6 +188,10 @@ class Config(object):
         for key in ('filter', 'exclude', 'filter_dirs', 'exclude_dirs'):
             kwargs[key] = merge_lists(kwargs.get(key, []), self.walk_filters[key])
         kwargs.setdefault('follow_symlinks', self.follow_symlinks)
+        kwargs.setdefault('list_threads', self.list_threads)
+        kwargs.setdefault('flat_listing', self.s3_flat_listing)
+        kwargs.setdefault('cache_size', self.s3_cache_size)
+        kwargs.setdefault('tmp_dir', self.tmp_dir)
 
         return walker.create_walker(fs_url, **kwargs)
 
@@ -213,18 +256,49 @@ class Config(object):
         parser = argparse.ArgumentParser(add_help=False)
         parser.add_argument('--max-retries', default=3, help='Maximum number of retry attempts, if assume yes')
         parser.add_argument('--jobs', '-j', default=-1, type=int, help='The number of concurrent jobs to run (e.g. compression jobs)')
-        parser.add_argument('--concurrent-uploads', default=4, type=int, help='The maximum number of concurrent uploads')
+        parser.add_argument('--packfile-processes', action='store_true',
+                help='Create packfiles in worker processes (up to --jobs) instead of threads')
+        parser.add_argument('--compress-threads', default=1, type=int,
+                help='The number of threads compressing packfile members in parallel, shared by all packfiles (1 to disable)')
+        parser.add_argument('--scan-processes', action='store_true',
+                help='Read DICOM headers in worker processes (up to --jobs) while scanning')
+        parser.add_argument('--header-cache', action='store_true',
+                help='Cache scanned DICOM headers on disk, and skip reading unchanged files on the next import')
+        parser.add_argument('--packfile-cache-size', default=0, type=int,
+                help='Keep up to this many MB of packfiles on disk, and upload them without repacking on the next import')
+        parser.add_argument('--concurrent-uploads', default=4, type=concurrency_argument,
+                help='The maximum number of concurrent uploads, or auto to adjust to the available throughput')
         parser.add_argument('--compression-level', default=1, type=int, choices=range(-1, 9),
                 help='The compression level to use for packfiles. -1 for default, 0 for store')
+        parser.add_argument('--compression-policy', default='none', choices=['none', 'auto', 'trial'],
+                help='Store packfile members that are already compressed (by extension or DICOM transfer syntax) '
+                     'instead of deflating them. trial also stores members whose first block does not compress')
         parser.add_argument('--symlinks', action='store_true', help='follow symbolic links that resolve to directories')
         parser.add_argument('--include-dirs', action='append', dest='include_dirs', help='Patterns of directories to include')
         parser.add_argument('--exclude-dirs', action='append', dest='exclude_dirs', help='Patterns of directories to exclude')
         parser.add_argument('--include', action='append', dest='filter', help='Patterns of filenames to include')
         parser.add_argument('--exclude', action='append', dest='exclude', help='Patterns of filenames to exclude')
+        parser.add_argument('--list-threads', default=1, type=int,
+                help='The number of directories to list concurrently (useful for S3 and network filesystems)')
+        parser.add_argument('--s3-flat-listing', action='store_true',
+                help='List S3 sources with one recursive listing, instead of one listing per directory')
+        parser.add_argument('--s3-cache-size', default=0, type=int,
+                help='Stage S3 objects in a local cache of up to this many MB, instead of reading them with ranged requests')
+        parser.add_argument('--bulk-resolve', action='store_true',
+                help='Find existing containers by listing the children of each parent once, instead of one lookup per container')
         parser.add_argument('--output-folder', help='Output to the given folder instead of uploading to flywheel')
         parser.add_argument('--no-uids', action='store_true', help='Ignore UIDs when grouping sessions and acquisitions')
         parser.add_argument('--unique-uids', action='store_true', help='Warn before creating any containers with duplicate UIDs')
         parser.add_argument('--max-tempfile', default=50, type=int, help='The max in-memory tempfile size, in MB, or 0 to always use disk')
+        parser.add_argument('--tmp-dir',
+                help='The directory to stage tar archive members in while they are packed (needs room for the uncompressed archives being packed)')
+        parser.add_argument('--memory-budget', default=0, type=int,
+                help='The max memory, in MB, used by packfiles and uploads waiting to be sent, or 0 for no limit')
+        parser.add_argument('--stream-packfiles', action='store_true',
+                help='Write packfiles to --output-folder while they are being created, instead of using temporary files '
+                     '(Flywheel uploads need the packfile size up front, so they always use temporary files)')
+        parser.add_argument('--pipeline', action='store_true',
+                help='Start uploading while the source is still being scanned, and print the summary at the end (requires --yes)')
         parser.add_argument('--skip-existing', action='store_true', help='Skip import of existing files')
         parser.add_argument('--no-audit-log', action='store_true', help='Don\'t generate an audit log.')
         parser.add_argument('--audit-log-path', help='Location to save audit log')
@@ -300,6 +374,27 @@ class Config(object):
             encodings.aliases.aliases[key.strip().lower()] = value.strip().lower()
 
 
+def concurrency_argument(val):
+    """Convert a concurrency argument into a positive integer or 'auto'
+
+    Raises ArgumentTypeError if the value is invalid
+
+    Arguments:
+        val (str): The argument value
+
+    Returns:
+        int|str: The number of concurrent jobs, or 'auto'
+    """
+    if str(val).strip().lower() == 'auto':
+        return 'auto'
+    try:
+        result = int(val)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Expected a number or auto, got: {}'.format(val))
+    if result < 1:
+        raise argparse.ArgumentTypeError('Expected a positive number, got: {}'.format(val))
+    return result
+
 def merge_lists(a, b):
     """Merge lists a and b, returning the result or None if the result is empty"""
     result = (a or []) + (b or [])
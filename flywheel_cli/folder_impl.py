@@ -21,6 +21,12 @@ class FSWrapper(Uploader, ContainerResolver):
         else:
             self.dst_fs.writebytes(path, fileobj)
 
+    def supports_streaming(self):
+        return True
+
+    def upload_stream(self, container, name, fileobj, metadata=None):
+        self.upload(container, name, fileobj, metadata=metadata)
+
     def file_exists(self, container, name):
         path = fs.path.join(container.id, name)
         return self.dst_fs.exists(path)
@@ -44,8 +50,8 @@ class FSWrapper(Uploader, ContainerResolver):
         else:
             path = sanitize_string_to_filename(container.id) # Group id
 
-        if not self.dst_fs.exists(path):
-            self.dst_fs.makedir(path)
+        # Siblings may be created concurrently
+        self.dst_fs.makedir(path, recreate=True)
 
         return path
 
@@ -7,12 +7,15 @@ import io
 import logging
 import os
 import sys
+import time
 
 log = logging.getLogger(__name__)
+PIPELINE_FLUSH_INTERVAL = 5 # Seconds between queueing discovered files, when pipelining
 
 from .. import util
 from .container_factory import ContainerFactory
 from .upload_queue import UploadQueue
+from .work_queue import WorkQueue
 from .audit_log import AuditLog
 from ..walker import create_walker, create_archive_walker
 
@@ -47,6 +50,13 @@ class AbstractImporter(ABC):
 
         self.audit_log = self._init_audit_log(config.audit_log)
 
+        # Upload state while pipelining discovery and upload
+        self._pipeline_queue = None
+        self._pipeline_create_queue = None
+        self._pipeline_walker = None
+        self._pipeline_state = None
+        self._pipeline_flush_time = None
+
     @property
     def assume_yes(self):
         if self.config:
@@ -226,6 +236,12 @@ class AbstractImporter(ABC):
             log.exception('Could not open filesystem at "{}"'.format(folder))
             sys.exit(1)
 
+        if self.config.pipelined_import:
+            if self.use_pipelined_import():
+                self.pipelined_import(walker)
+                return
+            log.warning('Pipelined import requires --yes and cannot be used with --unique-uids, scanning first')
+
         # Perform discovery on target filesystem
         self.discover(walker)
 
@@ -261,49 +277,173 @@ class AbstractImporter(ABC):
             self.deid_profile.initialize()
 
         # Create containers
-        self.container_factory.create_containers()
+        self.container_factory.create_containers(max_workers=self.config.concurrent_uploads, show_progress=True)
 
         # Walk the hierarchy, uploading files
         upload_queue = UploadQueue(self.config, self.audit_log, upload_count=counts['file'], packfile_count=counts['packfile'])
         upload_queue.start()
 
+        # Fetch the file listings of existing containers up front
+        upload_queue.prefetch_existing([container for _, container in self.container_factory.walk_containers()
+            if container.exists and (container.files or container.packfiles)])
+
         for _, container in self.container_factory.walk_containers():
-            cname = container.label or container.id
-            packfiles = copy.copy(container.packfiles)
-
-            for path in container.files:
-                file_name = fs.path.basename(path)
-
-                if self.repackage_archives and util.is_archive(path):
-                    archive_walker = create_archive_walker(walker, path)
-                    if archive_walker:
-                        if util.contains_dicoms(archive_walker):
-                            # Repackage upload
-                            upload_queue.upload_packfile(archive_walker, 'dicom', self.deid_profile, container, file_name)
-                            continue
-                        else:
-                            archive_walker.close()
-
-                # Normal upload
-                upload_queue.upload_file(container, file_name, walker, path)
-
-            # packfiles
-            for desc in container.packfiles:
-                if desc.name:
-                    file_name = desc.name
-                else:
-                    # Don't call things foo.zip.zip
-                    packfile_name = util.str_to_filename(cname)
-                    if desc.packfile_type == 'zip':
-                        file_name = '{}.zip'.format(packfile_name)
-                    else:
-                        file_name = '{}.{}.zip'.format(packfile_name, desc.packfile_type)
+            self.enqueue_uploads(upload_queue, walker, container, container.files, container.packfiles)
+
+        self.finish_upload(upload_queue, walker)
+
+    def use_pipelined_import(self):
+        """Check if discovery and upload can be overlapped.
+
+        Pipelining skips the confirmation prompt and can't check all UIDs before upload.
+        """
+        return self.assume_yes and not self.config.check_unique_uids
+
+    def pipelined_import(self, walker):
+        """Upload discovered files while discovery is still running, printing the summary at the end"""
+        self.before_begin_upload()
+
+        # Initialize profile
+        if self.deid_profile:
+            self.deid_profile.initialize()
+
+        upload_queue = UploadQueue(self.config, self.audit_log)
+        upload_queue.start()
+
+        # Containers are created at every checkpoint, by the same workers
+        create_queue = WorkQueue({'create': self.config.concurrent_uploads})
+        create_queue.start()
+
+        self._pipeline_queue = upload_queue
+        self._pipeline_create_queue = create_queue
+        self._pipeline_walker = walker
+        self._pipeline_state = {}
+        self._pipeline_flush_time = time.time()
+
+        try:
+            self.discover(walker)
+            # Upload everything that remains
+            self.flush_pipeline()
+        finally:
+            self._pipeline_queue = None
+            self._pipeline_create_queue = None
+            create_queue.shutdown()
+
+        if self.container_factory.is_empty():
+            log.error('Nothing found to import!')
+
+        self.finish_upload(upload_queue, walker)
+
+        # Print summary
+        print('The following data hierarchy was imported:\n')
+        self.print_summary()
+
+        print('')
+        for severity, msg in self.verify():
+            print('{} - {}'.format(severity.upper(), msg))
+        print('')
 
-                if isinstance(desc.path, str):
-                    upload_queue.upload_packfile(walker, desc.packfile_type, self.deid_profile, container, file_name, subdir=desc.path)
+    def discovery_checkpoint(self, get_in_progress_paths=None):
+        """Called periodically during discovery, to upload completed subtrees when pipelining.
+
+        Arguments:
+            get_in_progress_paths (function): Function that returns the paths still being discovered
+        """
+        if self._pipeline_queue is None:
+            return
+
+        if time.time() - self._pipeline_flush_time < PIPELINE_FLUSH_INTERVAL:
+            return
+
+        in_progress = get_in_progress_paths() if get_in_progress_paths else []
+        self.flush_pipeline(in_progress)
+
+    def flush_pipeline(self, in_progress=None):
+        """Create discovered containers and queue their files that were not queued yet.
+
+        Packfiles whose folder is still being discovered are held back, so they are final.
+
+        Arguments:
+            in_progress (list(str)): The paths still being discovered
+        """
+        self._pipeline_flush_time = time.time()
+        upload_queue = self._pipeline_queue
+
+        self.container_factory.create_containers(queue=self._pipeline_create_queue)
+
+        pending = []
+        for _, container in self.container_factory.walk_containers():
+            # Track the number of files and the packfiles queued for each container
+            state = self._pipeline_state.setdefault(id(container), [0, set()])
+
+            files = container.files[state[0]:]
+            state[0] = len(container.files)
+
+            packfiles = [desc for desc in container.packfiles
+                if id(desc) not in state[1] and not _is_in_progress(desc, in_progress)]
+            state[1].update(id(desc) for desc in packfiles)
+
+            if files or packfiles:
+                pending.append((container, files, packfiles))
+
+        if not pending:
+            return
+
+        upload_queue.add_counts(upload_count=sum(len(files) for _, files, _ in pending),
+            packfile_count=sum(len(packfiles) for _, _, packfiles in pending))
+        upload_queue.prefetch_existing([container for container, _, _ in pending])
+
+        for container, files, packfiles in pending:
+            self.enqueue_uploads(upload_queue, self._pipeline_walker, container, files, packfiles)
+
+    def enqueue_uploads(self, upload_queue, walker, container, files, packfiles):
+        """Queue uploads of the given files and packfiles to container
+
+        Arguments:
+            upload_queue (UploadQueue): The upload queue
+            walker (AbstractWalker): The source walker
+            container (ContainerNode): The destination container
+            files (list(str)): The file paths to upload
+            packfiles (list(PackfileDescriptor)): The packfiles to create and upload
+        """
+        cname = container.label or container.id
+
+        for path in files:
+            file_name = fs.path.basename(path)
+
+            if self.repackage_archives and util.is_archive(path):
+                archive_walker = create_archive_walker(walker, path,
+                    tmp_dir=self.config.tmp_dir if self.config else None)
+                if archive_walker:
+                    if util.contains_dicoms(archive_walker):
+                        # Repackage upload
+                        upload_queue.upload_packfile(archive_walker, 'dicom', self.deid_profile, container, file_name)
+                        continue
+                    else:
+                        archive_walker.close()
+
+            # Normal upload
+            upload_queue.upload_file(container, file_name, walker, path)
+
+        # packfiles
+        for desc in packfiles:
+            if desc.name:
+                file_name = desc.name
+            else:
+                # Don't call things foo.zip.zip
+                packfile_name = util.str_to_filename(cname)
+                if desc.packfile_type == 'zip':
+                    file_name = '{}.zip'.format(packfile_name)
                 else:
-                    upload_queue.upload_packfile(walker, desc.packfile_type, self.deid_profile, container, file_name, paths=desc.path)
+                    file_name = '{}.{}.zip'.format(packfile_name, desc.packfile_type)
 
+            if isinstance(desc.path, str):
+                upload_queue.upload_packfile(walker, desc.packfile_type, self.deid_profile, container, file_name, subdir=desc.path)
+            else:
+                upload_queue.upload_packfile(walker, desc.packfile_type, self.deid_profile, container, file_name, paths=desc.path)
+
+    def finish_upload(self, upload_queue, walker):
+        """Wait for uploads to finish, retrying errors, then shut down"""
         upload_queue.wait_for_finish()
         # Retry loop for errored jobs
         retries = 0
@@ -316,7 +456,6 @@ class AbstractImporter(ABC):
                     log.error('Maximum number of retries has been reached!')
                     break
                 retries += 1
-                import time
 
                 log.info('Retrying in {} seconds...'.format(self.retry_wait))
                 time.sleep(self.retry_wait)
@@ -336,6 +475,7 @@ class AbstractImporter(ABC):
         self.audit_log.finalize(self.container_factory)
 
         upload_queue.shutdown()
+        self.container_factory.resolver.close()
         walker.close()
 
     def before_begin_upload(self):
@@ -349,3 +489,10 @@ class AbstractImporter(ABC):
         else:
             audit_log_path = None
         return AuditLog(audit_log_path)
+
+def _is_in_progress(desc, in_progress):
+    """Check if the folder of a packfile descriptor is still being discovered"""
+    if not in_progress or not isinstance(desc.path, str):
+        return False
+    prefix = desc.path.rstrip('/') + '/'
+    return any(path == desc.path or path.startswith(prefix) for path in in_progress)
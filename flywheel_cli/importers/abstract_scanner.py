@@ -10,6 +10,8 @@ class AbstractScanner(ABC):
     def __init__(self, config):
         self.config = config
         self.messages = []
+        # Optional function called periodically during discovery, see discovery_checkpoint
+        self.checkpoint = None
 
     @abstractmethod
     def discover(self, walker, context, container_factory, path_prefix=None, audit_log=None):
@@ -23,6 +25,11 @@ class AbstractScanner(ABC):
             audit_log (AuditLog): The optional audit_log instance
         """
 
+    def discovery_checkpoint(self):
+        """Called periodically while scanning, so that a pipelined import can upload what was already discovered"""
+        if self.checkpoint is not None:
+            self.checkpoint()
+
     # def add_log(self, src_path, container, file_name, failed=False, message=None):
     def report_file_error(self, audit_log, path, exc=False, msg=None):
         """Report that a file error has occurred, along with the given message.
@@ -0,0 +1,205 @@
+"""Chooses per packfile member whether to deflate it, or store data that is already compressed"""
+import os
+import struct
+import threading
+import time
+import zipfile
+import zlib
+
+import fs.filesize
+import fs.path
+
+from ..walker.filters import PatternMatcher
+
+# Extensions of formats that are already compressed (matched in lower case)
+STORED_FILE_PATTERNS = [
+    '*.gz', '*.tgz', '*.bz2', '*.xz', '*.zip', '*.7z',
+    '*.jpg', '*.jpeg', '*.png', '*.gif', '*.jp2', '*.j2k',
+    '*.mp4', '*.mov', '*.avi', '*.mkv', '*.mp3',
+]
+
+# DICOM transfer syntaxes with compressed pixel data
+COMPRESSED_TRANSFER_SYNTAX_PREFIX = '1.2.840.10008.1.2.4.'  # JPEG, JPEG-LS, JPEG 2000, MPEG, HEVC
+COMPRESSED_TRANSFER_SYNTAXES = {
+    '1.2.840.10008.1.2.5',  # RLE Lossless
+    '1.2.840.10008.1.2.1.99',  # Deflated Explicit VR Little Endian
+}
+
+# The number of bytes read from the start of each member to choose the compression
+SNIFF_SIZE = 64 * 1024
+
+# Trial compression only considers members with at least this much data
+TRIAL_MIN_SIZE = 4096
+# Members that don't shrink below this ratio in the trial are stored
+TRIAL_MAX_RATIO = 0.9
+
+# The number of (incompressible) bytes deflated to measure the throughput of deflate
+THROUGHPUT_SAMPLE_SIZE = 1024 * 1024
+
+# VRs that have a 2 byte reserved field and 4 byte length in explicit VR encoding
+_LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+
+
+class CompressionPolicy(object):
+    """Decides whether packfile members are deflated or stored, and keeps statistics.
+
+    Members are stored if their extension or DICOM transfer syntax indicates that the
+    data is already compressed, or optionally if a trial compression of their first
+    block does not shrink it.
+    """
+    def __init__(self, trial=False):
+        """Initialize the policy
+
+        Arguments:
+            trial (bool): Whether to also store members that fail a trial compression
+        """
+        self.trial = trial
+        self._stored_files = PatternMatcher(STORED_FILE_PATTERNS)
+        self._init_stats()
+
+    def __getstate__(self):
+        # Statistics are collected separately in worker processes (see add_stats)
+        return {'trial': self.trial}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _init_stats(self):
+        self._lock = threading.Lock()
+        self.deflated_count = 0
+        self.deflated_bytes = 0
+        self.deflated_saved_bytes = 0
+        self.stored_count = 0
+        self.stored_bytes = 0
+        self.cpu_seconds_avoided = 0.0
+        self._deflate_throughput = None
+
+    def choose(self, path, head):
+        """Choose the compression type for a member
+
+        Arguments:
+            path (str): The member path
+            head (bytes): Up to SNIFF_SIZE bytes from the start of the member
+
+        Returns:
+            int: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+        """
+        if self._stored_files.match(fs.path.basename(path).lower()):
+            return zipfile.ZIP_STORED
+
+        transfer_syntax = get_transfer_syntax(head)
+        if transfer_syntax is not None and (transfer_syntax.startswith(COMPRESSED_TRANSFER_SYNTAX_PREFIX)
+                or transfer_syntax in COMPRESSED_TRANSFER_SYNTAXES):
+            return zipfile.ZIP_STORED
+
+        if self.trial and len(head) >= TRIAL_MIN_SIZE:
+            if len(zlib.compress(head, 1)) > TRIAL_MAX_RATIO * len(head):
+                return zipfile.ZIP_STORED
+
+        return zipfile.ZIP_DEFLATED
+
+    def get_deflate_throughput(self):
+        """Get the deflate throughput for already compressed data, measured on first use
+
+        Returns:
+            float: The number of bytes deflated per second
+        """
+        with self._lock:
+            if self._deflate_throughput is None:
+                sample = os.urandom(THROUGHPUT_SAMPLE_SIZE)
+                start = time.perf_counter()
+                compressobj = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+                compressobj.compress(sample)
+                compressobj.flush()
+                elapsed = max(time.perf_counter() - start, 1e-6)
+                self._deflate_throughput = len(sample) / elapsed
+            return self._deflate_throughput
+
+    def add_member(self, compress_type, file_size, compress_size):
+        """Record a member that was added to a packfile
+
+        For stored members, the CPU time avoided is estimated from the deflate throughput.
+
+        Arguments:
+            compress_type (int): The compression type that was used
+            file_size (int): The uncompressed size of the member
+            compress_size (int): The compressed size of the member
+        """
+        cpu_seconds = 0.0
+        if compress_type == zipfile.ZIP_STORED and file_size:
+            cpu_seconds = file_size / self.get_deflate_throughput()
+
+        with self._lock:
+            if compress_type == zipfile.ZIP_STORED:
+                self.stored_count += 1
+                self.stored_bytes += file_size
+                self.cpu_seconds_avoided += cpu_seconds
+            else:
+                self.deflated_count += 1
+                self.deflated_bytes += file_size
+                self.deflated_saved_bytes += file_size - compress_size
+
+    def get_stats(self):
+        """Get the statistics, as a dictionary"""
+        with self._lock:
+            return {
+                'deflated_count': self.deflated_count,
+                'deflated_bytes': self.deflated_bytes,
+                'deflated_saved_bytes': self.deflated_saved_bytes,
+                'stored_count': self.stored_count,
+                'stored_bytes': self.stored_bytes,
+                'cpu_seconds_avoided': self.cpu_seconds_avoided,
+            }
+
+    def add_stats(self, stats):
+        """Add statistics collected by another policy instance (e.g. in a worker process)"""
+        with self._lock:
+            for key, value in stats.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def get_summary(self):
+        """Get a summary of the statistics, for the final report"""
+        stats = self.get_stats()
+        return ('Compressed {} file(s) ({}), saving {}. Stored {} already compressed file(s) ({}), '
+            'avoiding about {:.1f} CPU seconds').format(
+            stats['deflated_count'], fs.filesize.traditional(stats['deflated_bytes']),
+            fs.filesize.traditional(stats['deflated_saved_bytes']),
+            stats['stored_count'], fs.filesize.traditional(stats['stored_bytes']),
+            stats['cpu_seconds_avoided'])
+
+
+def get_transfer_syntax(head):
+    """Get the transfer syntax UID from the file meta information of a DICOM file
+
+    Arguments:
+        head (bytes): The start of the file
+
+    Returns:
+        str: The transfer syntax UID, or None if head is not the start of a DICOM file
+    """
+    if head[128:132] != b'DICM':
+        return None
+
+    # File meta elements are always explicit VR little endian
+    offset = 132
+    while offset + 8 <= len(head):
+        group, element = struct.unpack_from('<HH', head, offset)
+        if group != 0x0002:
+            break
+
+        vr = head[offset+4:offset+6]
+        if vr in _LONG_VRS:
+            if offset + 12 > len(head):
+                break
+            length, = struct.unpack_from('<I', head, offset + 8)
+            offset += 12
+        else:
+            length, = struct.unpack_from('<H', head, offset + 6)
+            offset += 8
+
+        if element == 0x0010:
+            value = head[offset:offset+length]
+            return value.rstrip(b'\x00 ').decode('ascii', 'replace')
+        offset += length
+
+    return None
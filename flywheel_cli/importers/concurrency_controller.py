@@ -0,0 +1,173 @@
+"""Provides adaptive concurrency control for work queue groups"""
+import logging
+import threading
+
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+# HTTP status codes that indicate the server wants us to slow down
+THROTTLE_STATUS_CODES = (429, 503)
+
+def is_throttle_error(exc):
+    """Check if the given exception represents a throttling response (429/503)
+
+    Arguments:
+        exc (Exception): The exception raised by an upload
+
+    Returns:
+        bool: True if the server responded with a throttling status code
+    """
+    # flywheel.ApiException
+    status = getattr(exc, 'status', None)
+    if status is None:
+        # requests.HTTPError
+        response = getattr(exc, 'response', None)
+        status = getattr(response, 'status_code', None)
+    return status in THROTTLE_STATUS_CODES
+
+class AdaptiveConcurrencyController(object):
+    """Thread that tunes the number of active workers in a queue group.
+
+    Every sample_time seconds the byte rate of the group is measured. The limit is
+    increased by one (additive increase) for as long as throughput keeps improving,
+    a step that does not improve throughput is undone, and errors or throttling
+    responses halve the limit (multiplicative decrease).
+    """
+    def __init__(self, queue, group, min_count=1, max_count=None, initial_count=None,
+            sample_time=5.0, min_improvement=0.05, error_threshold=2, hold_samples=6):
+        """Initialize the controller
+
+        Arguments:
+            queue (WorkQueue): The work queue to control
+            group (str): The group tag to control
+            min_count (int): The minimum number of active workers
+            max_count (int): The maximum number of active workers (default is the thread count)
+            initial_count (int): The starting number of active workers
+            sample_time (float): The number of seconds between adjustments
+            min_improvement (float): The relative throughput gain required to keep growing
+            error_threshold (int): The number of errors in one sample that triggers back-off
+            hold_samples (int): The number of samples to wait before probing again
+        """
+        self.queue = queue
+        self.group = group
+        self.min_count = min_count
+        self.max_count = max_count or queue.groups[group]
+        self.sample_time = sample_time
+        self.min_improvement = min_improvement
+        self.error_threshold = error_threshold
+        self.hold_samples = hold_samples
+
+        if initial_count is None:
+            initial_count = self.min_count
+        self.limit = max(self.min_count, min(initial_count, self.max_count))
+
+        self._lock = threading.Lock()
+        self._throttled = 0
+        self._last_sample = None
+        self._last_rate = None
+        self._last_errors = 0
+        self._probing = False
+        self._hold = 0
+
+        self._running = False
+        self._thread = None
+        self._shutdown_event = threading.Event()
+
+    def start(self):
+        self.limit = self.queue.set_concurrency(self.group, self.limit)
+
+        self._running = True
+        self._thread = threading.Thread(target=self.run, name='{}-concurrency-thread'.format(self.group))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        self._running = False
+        self._shutdown_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def run(self):
+        while True:
+            self._shutdown_event.wait(self.sample_time)
+            if not self._running:
+                return
+
+            self.sample()
+
+    def record_throttle(self):
+        """Record that the server responded with a throttling status"""
+        with self._lock:
+            self._throttled += 1
+
+    def sample(self, sample_time=None):
+        """Measure the group byte rate and adjust the worker limit.
+
+        Arguments:
+            sample_time (datetime): The time of the sample (default is now)
+        """
+        stats = self.queue.get_stats()[self.group]
+        sample_time = sample_time or datetime.now()
+
+        with self._lock:
+            throttled = self._throttled
+            self._throttled = 0
+
+        errors = stats.get('errors', 0) - self._last_errors
+        self._last_errors = stats.get('errors', 0)
+
+        last_sample = self._last_sample
+        self._last_sample = (sample_time, stats['completed_bytes'])
+        if last_sample is None:
+            return
+
+        dt = (sample_time - last_sample[0]).total_seconds()
+        if dt <= 0:
+            return
+        rate = (stats['completed_bytes'] - last_sample[1]) / dt
+
+        if throttled or errors >= self.error_threshold:
+            # Multiplicative decrease
+            log.debug('Backing off %s concurrency (errors=%d, throttled=%d)', self.group, errors, throttled)
+            self._set_limit(self.limit // 2)
+            self._probing = False
+            self._hold = self.hold_samples
+            self._last_rate = None
+            return
+
+        last_rate = self._last_rate
+        self._last_rate = rate
+
+        if self._probing:
+            self._probing = False
+            if last_rate and rate < last_rate * (1 + self.min_improvement):
+                # No improvement from the last step, undo it and settle
+                self._set_limit(self.limit - 1)
+                self._hold = self.hold_samples
+                self._last_rate = None
+                return
+
+        if self._hold > 0:
+            self._hold -= 1
+            return
+
+        # Only probe if the group is saturated, otherwise the rate is limited by demand
+        if self.limit < self.max_count and self._is_saturated(stats):
+            self._set_limit(self.limit + 1)
+            self._probing = True
+
+    def _is_saturated(self, stats):
+        """Check if every allowed worker in the group was busy, with more jobs waiting
+
+        Arguments:
+            stats (dict): The group stats from the queue snapshot
+        """
+        return stats['active'] >= stats['limit'] and stats['waiting'] > 0
+
+    def _set_limit(self, count):
+        count = max(self.min_count, min(count, self.max_count))
+        if count != self.limit:
+            log.debug('Setting %s concurrency to %d', self.group, count)
+            self.limit = self.queue.set_concurrency(self.group, count)
@@ -4,6 +4,9 @@ import logging
 
 from abc import ABC, abstractmethod
 
+from .progress_reporter import ProgressReporter
+from .work_queue import Task, WorkQueue
+
 CONTAINERS = ['group', 'project', 'subject', 'session', 'acquisition']
 UID_CONTAINERS = {
     'acquisition': 'acquisitions',
@@ -30,6 +33,31 @@ class ContainerNode(object):
         self.files = []
         self.packfiles = []
 
+class CreateContainerTask(Task):
+    """Task that creates a single container, once its parent exists"""
+    def __init__(self, resolver, parent, container):
+        super(CreateContainerTask, self).__init__('create')
+        self.resolver = resolver
+        self.parent = parent
+        self.container = container
+        self.error = None
+
+    def execute(self):
+        try:
+            self.container.id = self.resolver.create_container(self.parent, self.container)
+        except Exception as ex:
+            self.error = ex
+            raise
+
+        self.container.exists = True
+        return None, None
+
+    def get_bytes_processed(self):
+        return 0
+
+    def get_desc(self):
+        return 'Create {} {}'.format(self.container.container_type, self.container.label or self.container.id)
+
 class ContainerResolver(ABC):
     def __init__(self):
         """Interface that handles resolution and creation of containers"""
@@ -78,6 +106,9 @@ class ContainerResolver(ABC):
             dict: The subset of UIDs that are not unique
         """
 
+    def close(self):
+        """Release any resources (e.g. background threads) held by the resolver"""
+
 
 class ContainerFactory(object):
     def __init__(self, resolver, uids=True):
@@ -131,12 +162,54 @@ class ContainerFactory(object):
 
         return current or last
 
-    def create_containers(self):
-        """Invoke resolver.create_container for each container that doesn't exist"""
-        for parent, child in self.walk_containers():
-            if not child.exists:
-                child.id = self.resolver.create_container(parent, child)
-                child.exists = True
+    def create_containers(self, max_workers=1, show_progress=False, queue=None):
+        """Invoke resolver.create_container for each container that doesn't exist.
+
+        Containers are created one level at a time, so parents always exist before their
+        children, while siblings are created concurrently.
+
+        Arguments:
+            max_workers (int): The maximum number of containers to create at once
+            show_progress (bool): Whether or not to report progress
+            queue (WorkQueue): An already started queue with a 'create' group to use (and keep running),
+                instead of starting a new one
+        """
+        levels = []
+        level = [(None, child) for child in self.root.children]
+        while level:
+            levels.append(level)
+            level = [(current, child) for _, current in level for child in current.children]
+
+        create_count = sum(1 for level in levels for _, child in level if not child.exists)
+        if not create_count:
+            return
+
+        own_queue = queue is None
+        if own_queue:
+            queue = WorkQueue({'create': max_workers})
+        progress = None
+        if show_progress:
+            progress = ProgressReporter(queue)
+            progress.add_group('create', 'Creating containers', create_count)
+            progress.start()
+
+        if own_queue:
+            queue.start()
+        try:
+            for level in levels:
+                for parent, child in level:
+                    if not child.exists:
+                        queue.enqueue(CreateContainerTask(self.resolver, parent, child))
+
+                queue.wait_for_finish()
+                if queue.has_errors():
+                    raise queue.errors[0].error
+        finally:
+            if progress:
+                progress.shutdown()
+                progress.final_report()
+            if own_queue:
+                queue.shutdown()
 
     def walk_containers(self):
         """Breadth-first walk of containers resolved by this factory
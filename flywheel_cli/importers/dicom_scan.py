@@ -1,3 +1,4 @@
+import collections
 import copy
 import gzip
 import itertools
@@ -7,11 +8,14 @@ import sys
 
 from .abstract_importer import AbstractImporter
 from .abstract_scanner import AbstractScanner
+from .header_cache import HeaderCache
 from .packfile import PackfileDescriptor
 from .. import util
+from ..walker import create_walker
 
 from flywheel_migration.dcm import DicomFileError, DicomFile
 
+import pydicom
 from pydicom.datadict import tag_for_keyword
 from pydicom.tag import Tag
 
@@ -63,6 +67,89 @@ def _at_stack_id(related_acquisitions):
         return tag == stop_tag
     return f
 
+# Number of files read by a worker process at a time
+SCAN_CHUNK_SIZE = 128
+
+# Walkers opened by worker processes, by fs url and options
+_worker_walkers = {}
+
+def read_dicom_header(walker, path, tags, session_label_key, related_acquisitions, buffer_size=-1):
+    """Read the scanned header fields of the dicom file at path
+
+    Returns:
+        DicomFile: The partially read dicom file
+    """
+    with walker.open(path, 'rb', buffering=buffer_size) as f:
+        # Unzip gzipped files
+        _, ext = os.path.splitext(path)
+        if ext.lower() == '.gz':
+            f = gzip.GzipFile(fileobj=f)
+
+        # Don't decode while scanning, stop as early as possible
+        # TODO: will we ever rely on fields after stack id for subject mapping
+        return DicomFile(f, parse=False, session_label_key=session_label_key,
+            decode=related_acquisitions, stop_when=_at_stack_id(related_acquisitions), update_in_place=False, specific_tags=tags)
+
+def read_scanned_headers(walker, path, tags, session_label_key, related_acquisitions, buffer_size=-1):
+    """Read the scanned header fields of the dicom file at path, as a plain tag dict
+
+    Returns:
+        tuple: The headers in the DICOM JSON model (or None) and the (exception class name, message)
+            of the error (or None)
+    """
+    try:
+        dcm = read_dicom_header(walker, path, tags, session_label_key, related_acquisitions,
+            buffer_size=buffer_size)
+        return dcm.raw.to_json_dict(), None
+    except Exception as exc:  # pylint: disable=broad-except
+        return None, (type(exc).__name__, str(exc))
+
+def read_dicom_headers_in_process(fs_url, walker_options, paths, tags, session_label_key, related_acquisitions,
+        buffer_size=-1):
+    """Read the scanned header fields of several dicom files, in a worker process.
+
+    Returns:
+        list(tuple): The result of read_scanned_headers for each path
+    """
+    key = (fs_url, repr(sorted(walker_options.items())))
+    walker = _worker_walkers.get(key)
+    if walker is None:
+        walker = _worker_walkers[key] = create_walker(fs_url, **walker_options)
+
+    return [read_scanned_headers(walker, path, tags, session_label_key, related_acquisitions,
+        buffer_size=buffer_size) for path in paths]
+
+def create_scan_error(error):
+    """Create the exception for an error returned by read_scanned_headers
+
+    Arguments:
+        error (tuple): The exception class name and message
+
+    Returns:
+        Exception: A DicomFileError for files that are not DICOM, otherwise an Exception
+    """
+    name, message = error
+    if name == DicomFileError.__name__:
+        return DicomFileError(message)
+    return Exception('{}: {}'.format(name, message))
+
+class ScannedDicomFile(DicomFile):
+    """DicomFile for the scanned header fields of a file, given as a plain tag dict"""
+    def __init__(self, headers):  # pylint: disable=super-init-not-called
+        """Create the dicom file from its headers
+
+        Arguments:
+            headers (dict): The scanned header fields, in the DICOM JSON model
+        """
+        self.headers = headers
+        self.raw = pydicom.Dataset.from_json(headers)
+
+        # Derived attributes, as set by DicomFile when not parsing
+        if self.get_manufacturer() != 'SIEMENS':
+            self.acq_no = str(self.raw.get('AcquisitionNumber', '')) or None
+        else:
+            self.acq_no = None
+
 class DicomScanner(AbstractScanner):
     # The session label dicom header key
     session_label_key = 'StudyDescription'
@@ -86,6 +173,130 @@ class DicomScanner(AbstractScanner):
 
         self.sessions = {}
 
+    def open_header_cache(self, tags):
+        """Open the header cache, if enabled
+
+        Returns:
+            HeaderCache: The cache for the given tags, or None
+        """
+        if not self.config or not getattr(self.config, 'header_cache', False):
+            return None
+
+        scan_key = HeaderCache.get_scan_key(sorted(int(tag) for tag in tags), self.session_label_key,
+            self.related_acquisitions, pydicom.__version__)
+        return HeaderCache(self.config.header_cache_path, scan_key=scan_key)
+
+    def scan_headers(self, walker, file_infos, tags):
+        """Read the scanned header fields of each file, using cached headers for unchanged files.
+
+        Arguments:
+            walker (AbstractWalker): The filesystem to read
+            file_infos (list): The list of (path, FileInfo) tuples
+            tags (list): The dicom tags to read
+
+        Returns:
+            generator: (path, DicomFile, Exception) tuples, in the order of file_infos
+        """
+        header_cache = self.open_header_cache(tags)
+        if header_cache is None:
+            for result in self.read_headers(walker, [path for path, _ in file_infos], tags):
+                yield result
+            return
+
+        try:
+            fs_url = walker.get_fs_url()
+            entries = [header_cache.get(fs_url, path, file_info) for path, file_info in file_infos]
+            log.debug('Using cached headers for %d of %d files', header_cache.hits, len(file_infos))
+
+            changed = [path for (path, _), entry in zip(file_infos, entries) if entry is None]
+            changed_results = self.read_headers(walker, changed, tags)
+
+            for (path, file_info), entry in zip(file_infos, entries):
+                if entry is None:
+                    result = next(changed_results)
+                    _, dcm, error = result
+                    if dcm is not None:
+                        header_cache.put(fs_url, path, file_info, dcm.headers)
+                    elif isinstance(error, DicomFileError):
+                        header_cache.put(fs_url, path, file_info, None, error=str(error))
+                    yield result
+                else:
+                    headers, message = entry
+                    if headers is None:
+                        yield path, None, DicomFileError(message)
+                    else:
+                        yield path, ScannedDicomFile(headers), None
+        finally:
+            header_cache.close()
+
+    def get_scan_process_count(self, walker):
+        """Get the number of worker processes to read headers with, or 0 to read them serially"""
+        if not self.config or not getattr(self.config, 'scan_processes', False):
+            return 0
+        if not walker.can_reopen():
+            return 0
+        return max(1, self.config.cpu_count)
+
+    def read_headers(self, walker, files, tags):
+        """Read the scanned header fields of each file.
+
+        Results are yielded in the order of files, whether the headers are read serially
+        or in worker processes.
+
+        Arguments:
+            walker (AbstractWalker): The filesystem to read
+            files (list): The list of file paths
+            tags (list): The dicom tags to read
+
+        Returns:
+            generator: (path, DicomFile, Exception) tuples, with either the file or the error set
+        """
+        buffer_size = self.config.buffer_size if self.config else -1
+        process_count = self.get_scan_process_count(walker)
+
+        if not process_count or len(files) <= SCAN_CHUNK_SIZE:
+            for path in files:
+                headers, error = read_scanned_headers(walker, path, tags, self.session_label_key,
+                    self.related_acquisitions, buffer_size=buffer_size)
+                yield self._get_scan_result(path, headers, error)
+            return
+
+        fs_url = walker.get_fs_url()
+        walker_options = walker.get_options()
+        chunks = [files[i:i+SCAN_CHUNK_SIZE] for i in range(0, len(files), SCAN_CHUNK_SIZE)]
+
+        pool = util.create_process_pool(process_count)
+        try:
+            # Keep a bounded number of chunks in flight, and merge them in order
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append((chunk, pool.submit(read_dicom_headers_in_process, fs_url, walker_options,
+                    chunk, tags, self.session_label_key, self.related_acquisitions, buffer_size)))
+
+                if len(pending) < 2 * process_count:
+                    continue
+
+                for result in self._read_chunk_results(*pending.popleft()):
+                    yield result
+
+            while pending:
+                for result in self._read_chunk_results(*pending.popleft()):
+                    yield result
+        finally:
+            pool.shutdown()
+
+    @classmethod
+    def _read_chunk_results(cls, chunk, future):
+        for path, (headers, error) in zip(chunk, future.result()):
+            yield cls._get_scan_result(path, headers, error)
+
+    @staticmethod
+    def _get_scan_result(path, headers, error):
+        """Create the (path, DicomFile, Exception) result for headers read by read_scanned_headers"""
+        if error is not None:
+            return path, None, create_scan_error(error)
+        return path, ScannedDicomFile(headers), None
+
     def save_subject_map(self):
         if self.subject_map:
             self.subject_map.save()
@@ -105,48 +316,42 @@ class DicomScanner(AbstractScanner):
         sys.stdout.flush()
 
         # Discover files first
-        files = list(walker.files(subdir=path_prefix))
-        file_count = len(files)
+        file_infos = list(walker.file_infos(subdir=path_prefix))
+        file_count = len(file_infos)
         files_scanned = 0
 
-        for path in files:
+        for path, dcm, error in self.scan_headers(walker, file_infos, tags):
             sys.stdout.write('Scanning {}/{} files...'.format(files_scanned, file_count).ljust(80) + '\r')
             sys.stdout.flush()
             files_scanned = files_scanned+1
+            self.discovery_checkpoint()
 
             try:
                 full_path = path_prefix + path if path_prefix else path
-                with walker.open(path, 'rb', buffering=self.config.buffer_size) as f:
-                    # Unzip gzipped files
-                    _, ext = os.path.splitext(path)
-                    if ext.lower() == '.gz':
-                        f = gzip.GzipFile(fileobj=f)
-
-                    # Don't decode while scanning, stop as early as possible
-                    # TODO: will we ever rely on fields after stack id for subject mapping
-                    dcm = DicomFile(f, parse=False, session_label_key=self.session_label_key,
-                        decode=self.related_acquisitions, stop_when=_at_stack_id(self.related_acquisitions), update_in_place=False, specific_tags=tags)
-                    acquisition = self.resolve_acquisition(context, dcm)
-
-                    sop_uid = self.get_value(dcm, 'SOPInstanceUID', required=True)
-                    series_uid = self.get_value(dcm, 'SeriesInstanceUID', required=True)
-                    if sop_uid in acquisition.files.setdefault(series_uid, {}):
-                        orig_path = acquisition.files[series_uid][sop_uid]
-
-                        if not util.files_equal(walker, full_path, orig_path):
-                            message = ('DICOM conflicts with {}! Both files have the '
-                                'same IDs, but contents differ!').format(orig_path)
-                            self.report_file_error(audit_log, full_path, msg=message)
-                    else:
-                        acquisition.files[series_uid][sop_uid] = path
+                if error is not None:
+                    raise error
+
+                acquisition = self.resolve_acquisition(context, dcm)
+
+                sop_uid = self.get_value(dcm, 'SOPInstanceUID', required=True)
+                series_uid = self.get_value(dcm, 'SeriesInstanceUID', required=True)
+                if sop_uid in acquisition.files.setdefault(series_uid, {}):
+                    orig_path = acquisition.files[series_uid][sop_uid]
+
+                    if not util.files_equal(walker, full_path, orig_path):
+                        message = ('DICOM conflicts with {}! Both files have the '
+                            'same IDs, but contents differ!').format(orig_path)
+                        self.report_file_error(audit_log, full_path, msg=message)
+                else:
+                    acquisition.files[series_uid][sop_uid] = path
 
-                    # Add a filename for that series uid
-                    if series_uid not in acquisition.filenames:
-                        acquisition_timestamp = self.determine_acquisition_timestamp(dcm)
-                        series_label = self.determine_acquisition_label(acquisition.context,
-                            dcm, series_uid, timestamp=acquisition_timestamp)
-                        filename = DicomScanner.determine_dicom_zipname(acquisition.filenames, series_label)
-                        acquisition.filenames[series_uid] = filename
+                # Add a filename for that series uid
+                if series_uid not in acquisition.filenames:
+                    acquisition_timestamp = self.determine_acquisition_timestamp(dcm)
+                    series_label = self.determine_acquisition_label(acquisition.context,
+                        dcm, series_uid, timestamp=acquisition_timestamp)
+                    filename = DicomScanner.determine_dicom_zipname(acquisition.filenames, series_label)
+                    acquisition.filenames[series_uid] = filename
 
             except DicomFileError as exc:
                 if util.is_dicom_file(path):
@@ -381,5 +586,7 @@ class DicomScannerImporter(AbstractImporter):
             walker (AbstractWalker): The filesystem to query
             context (dict): The initial context
         """
+        # Series are only complete once every file was scanned, so their packfiles are added at the end
+        self.scanner.checkpoint = self.discovery_checkpoint
         self.scanner.discover(walker, context, self.container_factory, audit_log=self.audit_log)
         self.messages += self.scanner.messages
@@ -1,6 +1,5 @@
 import collections
 import copy
-import fnmatch
 import fs
 import os
 import sys
@@ -8,6 +7,7 @@ import sys
 from queue import Empty, LifoQueue
 
 from ..util import set_nested_attr, sorted_container_nodes, METADATA_ALIASES, NO_FILE_CONTAINERS
+from ..walker.filters import PatternMatcher
 from .abstract_importer import AbstractImporter
 from .container_factory import ContainerFactory
 from .template import CompositeNode, TERMINAL_NODE
@@ -19,6 +19,7 @@ IGNORED_FILE_LIST = [
     'Thumbs.db',
     'Icon\r'
 ]
+IGNORED_FILES = PatternMatcher(IGNORED_FILE_LIST)
 
 class VisitTarget(object):
     """Represents a single node to visit while scanning"""
@@ -30,10 +31,7 @@ class VisitTarget(object):
 
 def should_ignore_file(name):
     """Check if the given filename should be ignored"""
-    for pattern in IGNORED_FILE_LIST:
-        if fnmatch.fnmatch(name, pattern):
-            return True
-    return False
+    return IGNORED_FILES.match(name)
 
 class FolderImporter(AbstractImporter):
     def __init__(self, group=None, project=None,  repackage_archives=False,
@@ -103,6 +101,9 @@ class FolderImporter(AbstractImporter):
 
                 self.visit_dir(walker, queue, target)
                 queue.task_done()
+
+                # Folders that are still queued are not complete yet
+                self.discovery_checkpoint(lambda: [queued.path for queued in list(queue.queue)])
             except Empty:
                 break  # Queue is empty, so stop
 
@@ -157,8 +158,12 @@ class FolderImporter(AbstractImporter):
                             child_path, 0, name=packfile_name)
 
                     if next_node and next_node.node_type == 'scanner':
+                        # The folder being scanned, this folder and queued folders are still in progress
+                        in_progress = [target.path, child_path]
+                        checkpoint = lambda: self.discovery_checkpoint(
+                            lambda: in_progress + [queued.path for queued in list(queue.queue)])
                         messages = next_node.scan(walker, child_path, child_context,
-                            self.container_factory, self.audit_log)
+                            self.container_factory, self.audit_log, checkpoint=checkpoint)
                         self.messages += messages
                         resolve = False
                     else:
@@ -0,0 +1,129 @@
+"""Provides a persistent cache of scanned file headers"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+log = logging.getLogger(__name__)
+
+# Number of writes between commits
+COMMIT_INTERVAL = 1000
+
+
+class HeaderCache(object):
+    """Maps (fs_url, path, size, mtime) to the headers read from a file during a previous scan.
+
+    Entries are also keyed on a scan key, which identifies the set of fields that were read,
+    so that changing the scan options (e.g. subject mapping fields) invalidates the cache.
+    Only the extracted fields are stored, as JSON.
+    """
+    def __init__(self, path, scan_key=''):
+        """Open (or create) the cache database
+
+        Arguments:
+            path (str): The path to the database file
+            scan_key (str): Identifies the fields that are read and stored
+        """
+        self.path = os.path.expanduser(path)
+        self.scan_key = scan_key
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        # Cached headers may contain patient information, only the user may read them
+        if not os.path.exists(self.path):
+            os.close(os.open(self.path, os.O_CREAT | os.O_WRONLY, 0o600))
+
+        self._db = sqlite3.connect(self.path)
+        # Earlier versions stored pickled headers in a "headers" table, which is never read
+        self._db.execute('CREATE TABLE IF NOT EXISTS scan_headers ('
+            'fs_url TEXT NOT NULL, path TEXT NOT NULL, scan_key TEXT NOT NULL, '
+            'size INTEGER NOT NULL, mtime REAL NOT NULL, headers TEXT, error TEXT, '
+            'PRIMARY KEY (fs_url, path, scan_key))')
+        self._db.commit()
+
+    @staticmethod
+    def get_scan_key(*args):
+        """Create a scan key from the given values"""
+        return hashlib.sha1(repr(args).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_mtime(file_info):
+        """Get the modification time of file_info, as a timestamp
+
+        Returns:
+            float: The timestamp, or None if it's not known
+        """
+        if file_info is None or file_info.modified is None:
+            return None
+        return file_info.modified.timestamp()
+
+    def get(self, fs_url, path, file_info):
+        """Get the cached headers for the given file, if it has not changed
+
+        Arguments:
+            fs_url (str): The url of the filesystem
+            path (str): The path to the file
+            file_info (FileInfo): The current file info
+
+        Returns:
+            tuple: The cached headers and error message, or None if there is no valid entry
+        """
+        mtime = self.get_mtime(file_info)
+        row = None
+        if mtime is not None and file_info.size is not None:
+            row = self._db.execute('SELECT headers, error FROM scan_headers WHERE fs_url=? AND path=? '
+                'AND scan_key=? AND size=? AND mtime=?',
+                (fs_url, path, self.scan_key, file_info.size, mtime)).fetchone()
+
+        if row is not None:
+            headers, error = row
+            try:
+                headers = json.loads(headers) if headers is not None else None
+            except ValueError:
+                log.debug('Could not load cached headers for %s', path, exc_info=True)
+                row = None
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return headers, error
+
+    def put(self, fs_url, path, file_info, headers, error=None):
+        """Store the headers (or error message) read from the given file
+
+        Arguments:
+            fs_url (str): The url of the filesystem
+            path (str): The path to the file
+            file_info (FileInfo): The file info at the time of reading
+            headers (dict): The JSON serializable headers that were read
+            error (str): The error message, if the file could not be read
+        """
+        mtime = self.get_mtime(file_info)
+        if mtime is None or file_info.size is None:
+            return
+
+        data = json.dumps(headers) if headers is not None else None
+        self._db.execute('INSERT OR REPLACE INTO scan_headers (fs_url, path, scan_key, size, mtime, headers, error) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', (fs_url, path, self.scan_key, file_info.size, mtime, data, error))
+
+        self._pending += 1
+        if self._pending >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        """Write pending entries to disk"""
+        self._db.commit()
+        self._pending = 0
+
+    def close(self):
+        """Commit pending entries and close the database"""
+        self.commit()
+        self._db.close()
@@ -0,0 +1,142 @@
+"""Provides a process-wide memory budget for buffered upload data"""
+import io
+import tempfile
+import threading
+
+
+class MemoryBudget(object):
+    """Tracks bytes held in memory by queued work, blocking producers when exhausted"""
+    def __init__(self, limit):
+        """Initialize the memory budget
+
+        Arguments:
+            limit (int): The maximum number of bytes that may be reserved at once
+        """
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size):
+        """Reserve size bytes, blocking until they are available.
+
+        Requests larger than the budget are reduced to the whole budget, so that
+        they can still proceed once everything else has been released.
+
+        Arguments:
+            size (int): The number of bytes to reserve
+
+        Returns:
+            int: The number of bytes actually reserved
+        """
+        size = min(size, self.limit)
+        with self._cond:
+            while self.used + size > self.limit:
+                self._cond.wait()
+            self.used += size
+        return size
+
+    def try_acquire(self, size):
+        """Reserve size bytes if they are available, without blocking.
+
+        Arguments:
+            size (int): The number of bytes to reserve
+
+        Returns:
+            bool: True if the bytes were reserved
+        """
+        with self._cond:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        """Release size previously reserved bytes
+
+        Arguments:
+            size (int): The number of bytes to release
+        """
+        if not size:
+            return
+        with self._cond:
+            self.used = max(0, self.used - size)
+            self._cond.notify_all()
+
+
+# Memory for spooled files is reserved in blocks of this size
+SPOOL_RESERVE_SIZE = 1024 * 1024
+
+
+class BudgetedSpooledFile(object):
+    """Temporary file that is held in memory for as long as the memory budget allows.
+
+    Memory is reserved from the budget as data is written. When the file grows over
+    max_size, or the budget can't cover the next block, the data is moved to a temporary
+    file on disk and the reservation is released. Closing the file also releases it.
+    """
+    def __init__(self, memory_budget, max_size):
+        """Initialize the spooled file
+
+        Arguments:
+            memory_budget (MemoryBudget): The memory budget to reserve from
+            max_size (int): The maximum number of bytes to hold in memory
+        """
+        self.memory_budget = memory_budget
+        self.max_size = max_size
+        self.reserved_bytes = 0
+        self.rolled = False
+        self.name = None
+        self._file = io.BytesIO()
+
+    def __getattr__(self, name):
+        # Delegate everything else (read, seek, tell, flush...) to the current file
+        return getattr(self._file, name)
+
+    def write(self, data):
+        if not self.rolled:
+            size = self._file.tell() + len(data)
+            if size > self.reserved_bytes and not self._reserve(size):
+                self.rollover()
+        return self._file.write(data)
+
+    def _reserve(self, size):
+        """Grow the reservation to cover size bytes, returning False if it can't"""
+        if size > self.max_size:
+            return False
+
+        size = min(max(size, self.reserved_bytes + SPOOL_RESERVE_SIZE), self.max_size)
+        if not self.memory_budget.try_acquire(size - self.reserved_bytes):
+            return False
+        self.reserved_bytes = size
+        return True
+
+    def _release(self):
+        self.memory_budget.release(self.reserved_bytes)
+        self.reserved_bytes = 0
+
+    def rollover(self):
+        """Move the data to a temporary file on disk, releasing the reservation"""
+        if self.rolled:
+            return
+
+        fileobj = tempfile.TemporaryFile()
+        fileobj.write(self._file.getbuffer())
+        fileobj.seek(self._file.tell())
+        self._file.close()
+        self._file = fileobj
+        self.rolled = True
+        self._release()
+
+    def fileno(self):
+        self.rollover()
+        return self._file.fileno()
+
+    def close(self):
+        self._file.close()
+        self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,14 +1,28 @@
+import collections
+import concurrent.futures
 import io
 import logging
+import shutil
+import time
+import zipfile
+import zlib
 
 import fs
 import fs.path
-import fs.copy
-from fs.zipfs import ZipFS
+
+from .compression_policy import SNIFF_SIZE
+from .memory_budget import MemoryBudget
 
 
 log = logging.getLogger(__name__)
 
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Larger members are compressed by the packing thread, rather than held in memory
+PARALLEL_MAX_MEMBER_SIZE = 64 * 1024 * 1024
+# The default maximum size of the members being compressed or waiting to be added, for all packfiles
+PARALLEL_WINDOW_SIZE = 2 * PARALLEL_MAX_MEMBER_SIZE
+
 
 class PackfileDescriptor(object):
     def __init__(self, packfile_type, path, count, name=None):
@@ -18,9 +32,11 @@ class PackfileDescriptor(object):
         self.count = count
         self.name = name
 
-def create_zip_packfile(dst_file, walker, packfile_type=None, subdir=None, paths=None, progress_callback=None, compression=None, deid_profile=None):
+def create_zip_packfile(dst_file, walker, packfile_type=None, subdir=None, paths=None, progress_callback=None, compression=None, deid_profile=None, compressor=None, policy=None):
     """Create a zipped packfile for the given packfile_type and options, that writes a ZipFile to dst_file
 
+    The archive is written in a single pass without seeking, so dst_file may be a pipe or socket.
+
     Arguments:
         dst_file (file): The destination path or file object
         walker (AbstractWalker): The source walker instance
@@ -29,24 +45,42 @@ def create_zip_packfile(dst_file, walker, packfile_type=None, subdir=None, paths
         paths (list(str)): The list of paths to add to the packfile
         progress_callback (function): Function to call with byte totals
         deid_profile: The de-identification profile to use
+        compressor (ParallelCompressor): The optional compressor for compressing members in parallel
+        policy (CompressionPolicy): The optional policy for choosing the compression of each member
     """
     if compression is None:
-        import zipfile
         compression = zipfile.ZIP_DEFLATED
 
-    with ZipFS(dst_file, write=True, compression=compression) as dst_fs:
-        zip_member_count = create_packfile(walker, dst_fs, packfile_type, subdir=subdir, paths=paths, progress_callback=progress_callback, deid_profile=deid_profile)
+    with StreamingZipWriter(dst_file, compression=compression, policy=policy) as dst_fs:
+        zip_member_count = create_packfile(walker, dst_fs, packfile_type, subdir=subdir, paths=paths, progress_callback=progress_callback, deid_profile=deid_profile, compressor=compressor)
 
     return zip_member_count
 
-def create_packfile(walker, dst_fs, packfile_type, subdir=None, paths=None, progress_callback=None, deid_profile=None):
+def get_packfile_paths(walker, subdir=None):
+    """Get the list of file paths that belong in a packfile
+
+    Arguments:
+        walker (AbstractWalker): The source walker instance
+        subdir (str): The optional packfile subdirectory
+
+    Returns:
+        list(str): The list of file paths
+    """
+    paths = []
+    for root, _, files in walker.walk(subdir=subdir):
+        for file_info in files:
+            paths.append(walker.combine(root, file_info.name))
+    return paths
+
+def create_packfile(walker, dst_fs, packfile_type, subdir=None, paths=None, progress_callback=None, deid_profile=None, compressor=None):
     """Create a packfile by copying files from walker to dst_fs, possibly validating and/or de-identifying
 
     Arguments:
         walker (AbstractWalker): The source walker instance
-        write_fn (function): Write function that takes path and bytes to write
+        dst_fs (StreamingZipWriter): The destination, which creates parent directories as files are added
         progress_callback (function): Function to call with byte totals
         deid_profile: The de-identification profile to use
+        compressor (ParallelCompressor): The optional compressor for compressing members in parallel
     """
     progress = {'total_bytes': 0}
 
@@ -60,29 +94,356 @@ def create_packfile(walker, dst_fs, packfile_type, subdir=None, paths=None, prog
 
     if not paths:
         # Determine file paths
-        paths = []
-        for root, _, files in walker.walk(subdir=subdir):
-            for file_info in files:
-                paths.append(walker.combine(root, file_info.name))
+        paths = get_packfile_paths(walker, subdir=subdir)
 
     # Attempt to de-identify using deid_profile first
     if deid_profile:
         if deid_profile.process_packfile(packfile_type, walker, dst_fs, paths, callback=progress_fn):
             return len(paths) # Handled by de-id
 
-    # Otherwise, just copy files into place
-    for path in paths:
-        # Ensure folder exists
-        folder = fs.path.dirname(path)
-        dst_fs.makedirs(folder, recreate=True)
-
-        if subdir:
-            dst_path = walker.remove_prefix(subdir, path)
-        else:
-            dst_path = path
+    # Otherwise, just copy files into place, as compressed data if possible
+    if compressor and hasattr(dst_fs, 'upload_compressed') and compressor.supports(dst_fs.compression):
+        compressor.copy_members(walker, dst_fs, paths, progress_fn=progress_fn)
+        return len(paths)
 
-        with walker.open(path, 'rb') as src_file:
-            dst_fs.upload(path, src_file)
+    copy_compressed = walker.can_open_compressed() and hasattr(dst_fs, 'upload_compressed')
+    for path, file_info in zip(paths, walker.get_file_infos(paths)):
+        size = file_info.size if file_info is not None else None
+        copy_member(walker, dst_fs, path, copy_compressed=copy_compressed, size=size)
         if callable(progress_fn):
             progress_fn(dst_fs, path)
     return len(paths)
+
+def copy_member(walker, dst_fs, path, copy_compressed=False, size=None):
+    """Copy a single file from walker to dst_fs
+
+    Arguments:
+        walker (AbstractWalker): The source walker instance
+        dst_fs (StreamingZipWriter): The destination archive
+        path (str): The path of the file
+        copy_compressed (bool): Whether to copy compressed zip member data as-is, if possible
+        size (int): The size of the file, if known
+    """
+    if copy_compressed:
+        src_info, src_file = walker.open_compressed(path)
+        if src_info is not None:
+            with src_file:
+                if dst_fs.upload_compressed(path, src_info, src_file):
+                    return
+
+    with walker.open(path, 'rb') as src_file:
+        dst_fs.upload(path, src_file, size=size)
+
+
+class ParallelCompressor(object):
+    """Compresses packfile members on a thread pool, which may be shared by several packfiles.
+
+    Members are read and compressed in parallel (zlib releases the GIL), then added to
+    the archive in order by the packing thread, with their precomputed CRC and sizes.
+    The members held in memory are bounded by count per packfile, and by their total
+    size across all packfiles. Members that are too large are added by the packing thread.
+    """
+    def __init__(self, threads, window_size=PARALLEL_WINDOW_SIZE):
+        """Create the compressor
+
+        Arguments:
+            threads (int): The number of compression threads
+            window_size (int): The maximum size of the members held in memory, for all packfiles
+        """
+        self.threads = threads
+        # Members waiting to be added to an archive, per packfile
+        self.window = 2 * threads
+        self.window_size = window_size
+        self._window_budget = MemoryBudget(window_size)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+    def supports(self, compression):
+        """Check if members can be compressed in parallel with the given compression type"""
+        return compression in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED)
+
+    def shutdown(self):
+        """Stop the compression threads"""
+        self._executor.shutdown()
+
+    def copy_members(self, walker, dst_fs, paths, progress_fn=None):
+        """Compress the files in parallel, and add them to dst_fs in order
+
+        Arguments:
+            walker (AbstractWalker): The source walker instance
+            dst_fs (StreamingZipWriter): The destination archive
+            paths (list(str)): The paths of the files to add
+            progress_fn (function): Function to call with dst_fs and path after adding each file
+        """
+        copy_compressed = walker.can_open_compressed()
+        pending = collections.deque()
+
+        def add_next():
+            path, size, future, reserved = pending.popleft()
+            try:
+                member = future.result() if future is not None else None
+                if member is None:
+                    copy_member(walker, dst_fs, path, copy_compressed=copy_compressed, size=size)
+                else:
+                    info, data = member
+                    dst_fs.add_compressed(path, info, io.BytesIO(data))
+            finally:
+                self._window_budget.release(reserved)
+            if callable(progress_fn):
+                progress_fn(dst_fs, path)
+
+        def reserve(size):
+            # Add members of this packfile while waiting, since other packfiles may hold the window
+            while not self._window_budget.try_acquire(size):
+                if not pending:
+                    return self._window_budget.acquire(size)
+                add_next()
+            return size
+
+        try:
+            for path, file_info in zip(paths, walker.get_file_infos(paths)):
+                size = file_info.size if file_info is not None else None
+                if size is not None and size > PARALLEL_MAX_MEMBER_SIZE:
+                    # Don't read the file just to find out that it doesn't fit
+                    pending.append((path, size, None, 0))
+                else:
+                    reserved = reserve(size if size is not None else PARALLEL_MAX_MEMBER_SIZE)
+                    try:
+                        future = self._executor.submit(self._read_member, walker, path, dst_fs, copy_compressed)
+                    except:
+                        self._window_budget.release(reserved)
+                        raise
+                    pending.append((path, size, future, reserved))
+
+                if len(pending) >= self.window:
+                    add_next()
+            while pending:
+                add_next()
+        finally:
+            for _, _, future, reserved in pending:
+                if future is not None and not future.cancel():
+                    # Don't release the memory before the member was read
+                    concurrent.futures.wait([future])
+                self._window_budget.release(reserved)
+
+    def _read_member(self, walker, path, dst_fs, copy_compressed):
+        """Read and compress a file
+
+        Returns:
+            tuple(zipfile.ZipInfo, bytes): The member info and compressed data, or None if
+                the file is too large to hold in memory
+        """
+        if copy_compressed:
+            src_info, src_file = walker.open_compressed(path)
+            if src_info is not None:
+                with src_file:
+                    if (src_info.compress_type == dst_fs.compression
+                            and src_info.compress_size <= PARALLEL_MAX_MEMBER_SIZE):
+                        return src_info, src_file.read()
+
+        compress_type = dst_fs.compression
+        compressobj = None
+
+        crc = 0
+        file_size = 0
+        chunks = []
+        with walker.open(path, 'rb') as src_file:
+            while True:
+                chunk = src_file.read(COPY_CHUNK_SIZE)
+                if file_size == 0:
+                    # Choose the compression from the first chunk
+                    if dst_fs.policy:
+                        head = chunk[:SNIFF_SIZE]
+                        compress_type = dst_fs.policy.choose(path, head)
+                    if compress_type == zipfile.ZIP_DEFLATED:
+                        # Same settings as zipfile
+                        compressobj = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+                if not chunk:
+                    break
+                file_size += len(chunk)
+                if file_size > PARALLEL_MAX_MEMBER_SIZE:
+                    return None
+                crc = zlib.crc32(chunk, crc)
+                chunks.append(compressobj.compress(chunk) if compressobj else chunk)
+
+        if compressobj:
+            chunks.append(compressobj.flush())
+        data = b''.join(chunks)
+
+        info = zipfile.ZipInfo(path, date_time=time.localtime(time.time())[:6])
+        info.compress_type = compress_type
+        info.external_attr = 0o600 << 16
+        info.CRC = crc
+        info.compress_size = len(data)
+        info.file_size = file_size
+
+        if dst_fs.policy:
+            dst_fs.policy.add_member(compress_type, file_size, len(data))
+        return info, data
+
+
+class StreamingZipWriter(object):
+    """Minimal write-only filesystem that adds files to a zip archive as they are written.
+
+    This is the destination of all packfiles, implementing the parts of the filesystem
+    interface used by create_packfile and de-id profiles directly on zipfile. Unlike
+    ZipFS, nothing is staged in a temporary filesystem, there is no per-call path
+    validation or locking, and the destination does not need to be seekable (zipfile
+    uses data descriptors in that case). When deflating, a CompressionPolicy may
+    choose to store individual members instead.
+    """
+    def __init__(self, dst_file, compression=zipfile.ZIP_DEFLATED, policy=None):
+        self.compression = compression
+        self.policy = policy if compression == zipfile.ZIP_DEFLATED else None
+        self._zipfile = zipfile.ZipFile(dst_file, mode='w', compression=compression, allowZip64=True)
+        self._dirs = set()
+        self._sizes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._zipfile.close()
+
+    def makedir(self, path, recreate=False):
+        path = _zip_path(path)
+        if path and path not in self._dirs:
+            self._dirs.add(path)
+            self._zipfile.writestr(path + '/', b'')
+
+    def makedirs(self, path, recreate=False):
+        self._add_dirs(_zip_path(path))
+
+    def _add_dirs(self, path):
+        """Add entries for a normalized directory path and its parents, if not added yet"""
+        if not path or path in self._dirs:
+            return
+        self._add_dirs(fs.path.dirname(path))
+        self._dirs.add(path)
+        self._zipfile.writestr(path + '/', b'')
+
+    def upload(self, path, file, chunk_size=None, size=None, **options):
+        """Copy the contents of file into the archive as path
+
+        Arguments:
+            path (str): The destination path
+            file (file): The source file
+            chunk_size (int): The number of bytes to copy at a time
+            size (int): The size of the file if known, so zip64 extensions are only added when needed
+        """
+        name = _zip_path(path)
+        self._add_dirs(fs.path.dirname(name))
+
+        info = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+        info.compress_type = self.compression
+        info.external_attr = 0o600 << 16
+        if size is not None:
+            # zipfile uses zip64 extensions for members that may grow over the limit
+            info.file_size = size
+
+        head = b''
+        if self.policy:
+            head = file.read(SNIFF_SIZE)
+            info.compress_type = self.policy.choose(name, head)
+
+        with self._zipfile.open(info, mode='w', force_zip64=size is None) as dst_file:
+            dst_file.write(head)
+            shutil.copyfileobj(file, dst_file, chunk_size or COPY_CHUNK_SIZE)
+
+        self._sizes[name] = info.file_size
+        if self.policy:
+            self.policy.add_member(info.compress_type, info.file_size, info.compress_size)
+
+    def upload_compressed(self, path, src_info, file):
+        """Copy the compressed data of a zip member into the archive as path, without recompressing it
+
+        Arguments:
+            path (str): The destination path
+            src_info (zipfile.ZipInfo): The source member info, providing the CRC and sizes
+            file (file): The compressed member data
+
+        Returns:
+            bool: True if the data was copied, False if it uses a different compression method
+        """
+        if src_info.compress_type != self.compression:
+            return False
+
+        self.add_compressed(path, src_info, file)
+        return True
+
+    def add_compressed(self, path, src_info, file):
+        """Add compressed data to the archive as path, with the compression type, CRC and sizes of src_info
+
+        Arguments:
+            path (str): The destination path
+            src_info (zipfile.ZipInfo): The member info
+            file (file): The compressed member data
+        """
+        name = _zip_path(path)
+        self._add_dirs(fs.path.dirname(name))
+
+        info = zipfile.ZipInfo(name, date_time=src_info.date_time)
+        info.compress_type = src_info.compress_type
+        info.external_attr = src_info.external_attr
+        info.CRC = src_info.CRC
+        info.compress_size = src_info.compress_size
+        info.file_size = src_info.file_size
+        zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+
+        # zipfile has no public interface for adding compressed data, so write the
+        # local header and data, then register the member for the central directory
+        # pylint: disable=protected-access
+        zip_file = self._zipfile
+        with zip_file._lock:
+            zip_file._writecheck(info)
+            info.header_offset = zip_file.fp.tell()
+            zip_file.fp.write(info.FileHeader(zip64))
+
+            remaining = info.compress_size
+            while remaining > 0:
+                chunk = file.read(min(remaining, COPY_CHUNK_SIZE))
+                if not chunk:
+                    raise zipfile.BadZipFile('Compressed data for {} is truncated'.format(path))
+                zip_file.fp.write(chunk)
+                remaining -= len(chunk)
+
+            zip_file.filelist.append(info)
+            zip_file.NameToInfo[name] = info
+            zip_file.start_dir = zip_file.fp.tell()
+            zip_file._didModify = True
+
+        self._sizes[name] = info.file_size
+
+    def open(self, path, mode='rb', **options):
+        """Open path for writing, the contents are added to the archive on close"""
+        if 'r' in mode or '+' in mode:
+            raise ValueError('StreamingZipWriter is write-only')
+        # Buffer each member, since writers (e.g. pydicom) may seek within the file
+        return _StreamingMemberFile(self, path)
+
+    def getsize(self, path):
+        return self._sizes[_zip_path(path)]
+
+    def exists(self, path):
+        path = _zip_path(path)
+        return not path or path in self._dirs or path in self._sizes
+
+class _StreamingMemberFile(io.BytesIO):
+    """In-memory file that is written to a StreamingZipWriter when closed"""
+    def __init__(self, writer, path):
+        super(_StreamingMemberFile, self).__init__()
+        self._writer = writer
+        self._path = path
+
+    def close(self):
+        if not self.closed:
+            size = self.seek(0, io.SEEK_END)
+            self.seek(0)
+            self._writer.upload(self._path, self, size=size)
+        super(_StreamingMemberFile, self).close()
+
+def _zip_path(path):
+    """Convert a filesystem path to a zip member name"""
+    return fs.path.relpath(fs.path.normpath(path))
@@ -0,0 +1,143 @@
+"""Provides a persistent, size-bounded cache of packfiles, so reruns can upload them without repacking"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+PACKFILE_EXT = '.zip'
+
+
+class PackfileCache(object):
+    """Stores packfiles by a key derived from their options and members.
+
+    Packfiles are keyed on the packfile type, the de-id profile, the compression
+    and the (path, size, mtime) of every member, so any change to the source files
+    or options results in a new key. The least recently used packfiles are removed
+    when the cache grows over max_size.
+    """
+    def __init__(self, dirname, max_size):
+        """Open (or create) the cache directory
+
+        Arguments:
+            dirname (str): The cache directory
+            max_size (int): The maximum number of bytes to keep on disk
+        """
+        self.dirname = os.path.expanduser(dirname)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        # Packfiles may contain patient information, only the user may read them
+        os.makedirs(self.dirname, mode=0o700, exist_ok=True)
+
+    @staticmethod
+    def get_key(fs_url, packfile_type, deid_profile, compression, compression_level, policy, members):
+        """Create a cache key for a packfile
+
+        Arguments:
+            fs_url (str): The url of the source filesystem
+            packfile_type (str): The packfile type
+            deid_profile: The de-identification profile, or None
+            compression (int): The zip compression type
+            compression_level (int): The compression level
+            policy (CompressionPolicy): The compression policy, or None
+            members (list): The (path, FileInfo) of each member
+
+        Returns:
+            str: The key, or None if the packfile can't be cached
+        """
+        member_keys = []
+        for path, file_info in members:
+            if file_info is None or file_info.size is None or file_info.modified is None:
+                return None
+            member_keys.append((path.lstrip('/'), file_info.size, file_info.modified.timestamp()))
+
+        if deid_profile is not None:
+            deid_profile = deid_profile.to_config()
+        if policy is not None:
+            policy = {'trial': policy.trial}
+
+        key_data = json.dumps([fs_url, packfile_type, deid_profile, compression, compression_level,
+            policy, sorted(member_keys)], sort_keys=True, default=str)
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        """Get the path of the packfile for key"""
+        return os.path.join(self.dirname, key + PACKFILE_EXT)
+
+    def open(self, key):
+        """Open the cached packfile for key
+
+        Returns:
+            file: The opened packfile, or None if it is not cached
+        """
+        path = self.get_path(key)
+        with self._lock:
+            try:
+                fileobj = open(path, 'rb')
+            except FileNotFoundError:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            # Mark as recently used
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return fileobj
+
+    def put(self, key, fileobj):
+        """Copy a packfile into the cache, then evict packfiles that don't fit
+
+        Arguments:
+            key (str): The cache key
+            fileobj (file): The packfile, which is read from the current position
+        """
+        fd, tmp_path = tempfile.mkstemp(suffix='.part', dir=self.dirname)
+        try:
+            with os.fdopen(fd, 'wb') as dst_file:
+                shutil.copyfileobj(fileobj, dst_file, 1024 * 1024)
+                size = dst_file.tell()
+
+            if size > self.max_size:
+                # Don't evict everything else for a packfile that doesn't fit
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, self.get_path(key))
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        """Remove the least recently used packfiles until the cache fits (called with the lock held)"""
+        entries = []
+        used = 0
+        for entry in os.scandir(self.dirname):
+            if not entry.name.endswith(PACKFILE_EXT):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            used += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if used <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                used -= size
+            except OSError:
+                log.debug('Could not remove cached packfile %s', path, exc_info=True)
@@ -48,6 +48,7 @@ class ParRecScanner(AbstractScanner):
             sys.stdout.write('Scanning {}/{} files...'.format(files_scanned, file_count).ljust(80) + '\r')
             sys.stdout.flush()
             files_scanned = files_scanned+1
+            self.discovery_checkpoint()
 
             lpath = path.lower()
             real_path = path_prefix + path if path_prefix else path
@@ -193,5 +194,6 @@ class ParRecScannerImporter(AbstractImporter):
             walker (AbstractWalker): The filesystem to query
             context (dict): The initial context
         """
+        self.scanner.checkpoint = self.discovery_checkpoint
         self.scanner.discover(walker, context, self.container_factory, audit_log=self.audit_log)
         self.messages += self.scanner.messages
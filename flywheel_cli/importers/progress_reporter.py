@@ -49,6 +49,10 @@ class ProgressReporter(ABC):
     def add_group(self, name, desc, total_count):
         self.groups[name] = GroupStats(desc, total_count)
 
+    def add_to_group(self, name, count):
+        """Increase the total count of a group"""
+        self.groups[name].total_count += count
+
     def start(self):
         self._running = True
         self._suspended = False
@@ -0,0 +1,172 @@
+"""Provides a bounded in-memory pipe between a producer and a consumer thread"""
+import collections
+import threading
+
+DEFAULT_PIPE_SIZE = 8 * (2 ** 20) # Buffer up to 8mb between packing and uploading
+DEFAULT_PIPE_TIMEOUT = 300 # Fail the writer if the reader makes no progress for 5 minutes
+
+
+class PipeClosedError(IOError):
+    """Raised when writing to a pipe whose reader has gone away"""
+
+
+class PipeTimeoutError(IOError):
+    """Raised when the writer has waited too long for the reader"""
+
+
+class BoundedPipe(object):
+    """File-like pipe that blocks the writer while more than max_size bytes are buffered.
+
+    The writer calls write() and then close() (or abort() on failure), the reader
+    calls read() until it returns no data and then close_reader().
+    """
+    # There is no name for the underlying file
+    name = None
+
+    def __init__(self, max_size=DEFAULT_PIPE_SIZE, timeout=DEFAULT_PIPE_TIMEOUT):
+        """Initialize the pipe
+
+        Arguments:
+            max_size (int): The maximum number of bytes to buffer
+            timeout (float): The number of seconds the writer waits for the reader to make progress
+        """
+        self.max_size = max_size
+        self.timeout = timeout
+        self._chunks = collections.deque()
+        self._size = 0
+
+        self._cond = threading.Condition()
+        self._write_closed = False
+        self._write_error = None
+        self._read_closed = False
+        self._read_error = None
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def write(self, data):
+        """Append data to the pipe, blocking while the buffer is full
+
+        Arguments:
+            data (bytes): The data to write
+
+        Returns:
+            int: The number of bytes written
+        """
+        if not data:
+            return 0
+
+        data = bytes(data)
+        with self._cond:
+            # Always accept at least one chunk, so that large writes cannot block forever
+            while self._size and self._size + len(data) > self.max_size and not self._read_closed:
+                self._wait_for_reader_progress()
+
+            if self._read_closed:
+                raise PipeClosedError('Pipe was closed by the reader')
+
+            self._chunks.append(data)
+            self._size += len(data)
+            self._cond.notify_all()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Signal the end of data to the reader"""
+        with self._cond:
+            self._write_closed = True
+            self._cond.notify_all()
+
+    def abort(self, error):
+        """Close the pipe, causing the reader to raise error
+
+        Arguments:
+            error (Exception): The error that stopped the writer
+        """
+        with self._cond:
+            self._write_error = error
+            self._write_closed = True
+            self._cond.notify_all()
+
+    def cancel(self, error):
+        """Close both ends of the pipe, unblocking the reader and the writer
+
+        Arguments:
+            error (Exception): The error raised by the reader, and returned to the writer
+        """
+        self.abort(error)
+        self.close_reader(error)
+
+    def read(self, size=-1):
+        """Read up to size bytes, blocking until data is available
+
+        Arguments:
+            size (int): The maximum number of bytes to read, or -1 to read to the end
+
+        Returns:
+            bytes: The data read, or empty bytes at the end of the stream
+        """
+        result = []
+        remaining = size
+        with self._cond:
+            while True:
+                if self._write_error is not None:
+                    raise IOError('Pipe writer failed: {}'.format(self._write_error))
+
+                while self._chunks and remaining != 0:
+                    chunk = self._chunks.popleft()
+                    if remaining > 0 and len(chunk) > remaining:
+                        self._chunks.appendleft(chunk[remaining:])
+                        chunk = chunk[:remaining]
+
+                    result.append(chunk)
+                    self._size -= len(chunk)
+                    if remaining > 0:
+                        remaining -= len(chunk)
+
+                if result:
+                    self._cond.notify_all()
+
+                # Return partial reads as soon as some data is available
+                if (result and size > 0) or remaining == 0 or self._write_closed:
+                    break
+
+                self._cond.wait()
+
+        return b''.join(result)
+
+    def close_reader(self, error=None):
+        """Signal that the reader is finished, unblocking the writer
+
+        Arguments:
+            error (Exception): The error that stopped the reader, if any
+        """
+        with self._cond:
+            self._read_closed = True
+            self._read_error = error
+            self._chunks.clear()
+            self._size = 0
+            self._cond.notify_all()
+
+    def wait_for_reader(self):
+        """Wait for the reader to finish
+
+        Raises PipeTimeoutError if the reader makes no progress for timeout seconds.
+
+        Returns:
+            Exception: The error that stopped the reader, or None if it succeeded
+        """
+        with self._cond:
+            while not self._read_closed:
+                self._wait_for_reader_progress()
+            return self._read_error
+
+    def _wait_for_reader_progress(self):
+        """Wait to be notified by the reader (called with the condition held)"""
+        if not self._cond.wait(self.timeout):
+            raise PipeTimeoutError('Pipe reader made no progress for {} seconds'.format(self.timeout))
@@ -153,7 +153,7 @@ class ScannerNode(ImportTemplateNode):
         """Set the next node"""
         raise ValueError('Cannot declare nodes after dicom scanner!')
 
-    def scan(self, src_fs, path_prefix, context, container_factory, audit_log):
+    def scan(self, src_fs, path_prefix, context, container_factory, audit_log, checkpoint=None):
         """Scan directory contents, rather than walking.
 
         Called if this is a scanner node.
@@ -164,11 +164,13 @@ class ScannerNode(ImportTemplateNode):
             context (dict): The current context object
             container_factory: The container factory where nodes should be added
             audit_log: The audit log instance
+            checkpoint (function): The optional function to call periodically while scanning
 
         Returns:
             list: The list of warning/error messages
         """
         scanner = self.scanner_cls(self.config, **self.opts)
+        scanner.checkpoint = checkpoint
         scanner.discover(src_fs, context, container_factory,
                 path_prefix=path_prefix, audit_log=audit_log)
         return scanner.messages
@@ -1,15 +1,27 @@
+import io
 import logging
 import os
+import shutil
 import tempfile
+import zlib
 
 from abc import ABC, abstractmethod
 
+from .. import util
+from ..walker import create_walker
 from .work_queue import Task, WorkQueue
-from .packfile import create_zip_packfile
+from .concurrency_controller import AdaptiveConcurrencyController, is_throttle_error
+from .memory_budget import BudgetedSpooledFile, MemoryBudget
+from .packfile import create_zip_packfile, get_packfile_paths, ParallelCompressor, PARALLEL_WINDOW_SIZE
+from .packfile_cache import PackfileCache
 from .progress_reporter import ProgressReporter
+from .stream_pipe import BoundedPipe, PipeClosedError, PipeTimeoutError
 
 log = logging.getLogger(__name__)
 MAX_IN_MEMORY_XFER = 32 * (2 ** 20) # Files under 32mb send as one chunk
+BATCH_MAX_FILES = 100 # The max number of files uploaded with one ticket
+BATCH_MAX_BYTES = 16 * (2 ** 20) # The max total size of files uploaded with one ticket
+BATCH_MAX_FILE_SIZE = 2 ** 20 # Files under 1mb are eligible for batch upload
 
 class Uploader(ABC):
     """Abstract uploader class, that can upload files"""
@@ -41,6 +53,13 @@ class Uploader(ABC):
             bool: True if the file already exists, otherwise False
         """
 
+    def prefetch_files(self, containers):
+        """Fetch the existing file names of containers in advance, for file_exists.
+
+        Arguments:
+            containers (list(ContainerNode)): The containers that will be checked
+        """
+
     def supports_signed_url(self):
         """Check if signed url upload is supported.
 
@@ -49,16 +68,66 @@ class Uploader(ABC):
         """
         return False
 
+    def supports_batch_upload(self):
+        """Check if uploading several files at once is supported.
+
+        Returns:
+            bool: True if upload_batch is supported
+        """
+        return False
+
+    def upload_batch(self, container, files, max_workers=1):
+        """Upload several small files to the given container at once.
+
+        By default, each file is uploaded on its own.
+
+        Arguments:
+            container (ContainerNode): The destination container
+            files (list): The list of (name, bytes) tuples to upload
+            max_workers (int): The maximum number of files to send at the same time
+        """
+        for name, data in files:
+            self.upload(container, name, data)
+
+    def supports_streaming(self):
+        """Check if uploading from a stream of unknown length is supported.
+
+        Returns:
+            bool: True if upload_stream is supported
+        """
+        return False
+
+    def upload_stream(self, container, name, fileobj, metadata=None):
+        """Upload the given non-seekable file-like object to the given container as name.
+
+        By default, the data is copied to a temporary file which is then uploaded.
+
+        Arguments:
+            container (ContainerNode): The destination container
+            name (str): The file name
+            fileobj (obj): The file-like object, which only supports read()
+            metadata (dict): Container metadata
+        """
+        with tempfile.TemporaryFile() as tmpfile:
+            shutil.copyfileobj(fileobj, tmpfile)
+            tmpfile.seek(0)
+            self.upload(container, name, tmpfile, metadata=metadata)
+
 class UploadFileWrapper(object):
     """Wrapper around file that measures progress"""
     def __init__(self, fileobj=None, walker=None, path=None):
-        """Initialize a file wrapper, must specify fileobj OR walker and path"""
+        """Initialize a file wrapper, must specify fileobj OR walker and path
+
+        The name reported to the audit log is path if given, otherwise the name of fileobj.
+        Packfiles are uploaded from temporary files, so they are reported by the path
+        they were created from rather than the name of the temporary file.
+        """
         self.fileobj = fileobj
         self.walker = walker
         self.path = path
         self._sent = 0
         self._total_size = None
-        if fileobj and fileobj.name:
+        if fileobj and fileobj.name and not path:
             self.name = fileobj.name
         else:
             self.name = path
@@ -96,13 +165,69 @@ class UploadFileWrapper(object):
             self.fileobj.close()
         self.fileobj = None
 
+    def release(self):
+        """Let the walker remove any local copy of the file, after it has been uploaded"""
+        if self.walker is not None and self.path is not None:
+            self.walker.release([self.path])
+
     def get_bytes_sent(self):
         return self._sent
 
+class DeleteOnCloseFile(io.FileIO):
+    """File that is removed from disk when closed"""
+    def close(self):
+        closed = self.closed
+        super(DeleteOnCloseFile, self).close()
+        if not closed:
+            try:
+                os.remove(self.name)
+            except OSError:
+                log.debug('Could not remove temporary file %s', self.name, exc_info=True)
+
+def create_packfile_in_process(fs_url, walker_options, packfile_type, deid_profile,
+        subdir=None, paths=None, compression=None, compression_level=None, policy=None):
+    """Create a packfile in a worker process, writing it to a temporary file.
+
+    The walker is re-created from fs_url and walker_options, since walkers
+    cannot be shared between processes.
+
+    Returns:
+        tuple(str, int, int, dict): The temporary file path, the member count, the bytes processed
+            and the compression policy statistics (or None)
+    """
+    # Worker processes may not inherit the configured compression level
+    if compression_level is not None and compression_level > 0:
+        zlib.Z_DEFAULT_COMPRESSION = compression_level
+
+    progress = {'bytes': 0}
+    def update_progress(bytes_processed):
+        progress['bytes'] = bytes_processed
+
+    walker = create_walker(fs_url, **walker_options)
+    fd, path = tempfile.mkstemp(suffix='.zip')
+    try:
+        with os.fdopen(fd, 'wb') as dst_file:
+            zip_member_count = create_zip_packfile(dst_file, walker, packfile_type=packfile_type,
+                subdir=subdir, paths=paths, compression=compression,
+                progress_callback=update_progress, deid_profile=deid_profile, policy=policy)
+    except:
+        os.remove(path)
+        raise
+    finally:
+        walker.close()
+
+    policy_stats = policy.get_stats() if policy else None
+    return path, zip_member_count, progress['bytes'], policy_stats
+
 
 class UploadTask(Task):
-    def __init__(self, uploader, audit_log, container, filename, fileobj=None, walker=None, path=None, metadata=None):
-        """Initialize an upload task, must specify fileobj OR walker and path"""
+    def __init__(self, uploader, audit_log, container, filename, fileobj=None, walker=None, path=None, metadata=None,
+            memory_budget=None):
+        """Initialize an upload task, must specify fileobj OR walker and path
+
+        Arguments:
+            memory_budget (MemoryBudget): The optional memory budget for in-memory transfers
+        """
         super(UploadTask, self).__init__('upload')
         self.uploader = uploader
         self.audit_log = audit_log
@@ -110,7 +235,9 @@ class UploadTask(Task):
         self.filename = filename
         self.fileobj = UploadFileWrapper(fileobj=fileobj, walker=walker, path=path)
         self._data = None
+        self._data_reserved = 0
         self.metadata = metadata
+        self.memory_budget = memory_budget
 
     def execute(self):
         self.fileobj.reset()
@@ -122,11 +249,12 @@ class UploadTask(Task):
             self.audit_log.add_log(self.fileobj.name, self.container, self.filename,
                     failed=True, message='Skipped 0-byte file')
             self.skipped = True
-        elif self.fileobj.len < MAX_IN_MEMORY_XFER:
+        elif self.fileobj.len < MAX_IN_MEMORY_XFER and self._reserve_data():
             if self._data is None:
                 self._data = self.fileobj.read(self.fileobj.len)
             self.uploader.upload(self.container, self.filename, self._data, metadata=self.metadata)
         else:
+            # Stream large files (or small files, if the memory budget is exhausted)
             self.uploader.upload(self.container, self.filename, self.fileobj, metadata=self.metadata)
 
         # Safely close the file object
@@ -136,18 +264,186 @@ class UploadTask(Task):
             log.exception('Cannot close file object')
             pass
 
+        self.fileobj.release()
+        self.release_memory()
+
         # No more jobs so no priority
         return None, None
 
+    def _reserve_data(self):
+        """Reserve memory for reading the file into memory, returning False if it should be streamed"""
+        if self.memory_budget is None or self._data is not None:
+            return True
+
+        size = self.fileobj.len
+        if not self.memory_budget.try_acquire(size):
+            log.debug('Memory budget exhausted, streaming %s', self.filename)
+            return False
+
+        self._data_reserved = size
+        return True
+
+    def release_memory(self):
+        """Drop in-memory data and release any bytes held in the memory budget"""
+        self._data = None
+
+        if self.memory_budget is not None:
+            self.memory_budget.release(self._data_reserved)
+            self._data_reserved = 0
+
+            # Move spooled packfiles to disk, so their memory can be reused while waiting to retry
+            if isinstance(self.fileobj.fileobj, BudgetedSpooledFile):
+                self.fileobj.fileobj.rollover()
+
     def get_bytes_processed(self):
         return self.fileobj.get_bytes_sent()
 
     def get_desc(self):
         return 'Upload {}'.format(self.filename)
 
+class UploadBatchTask(Task):
+    """Upload task that sends many small files to one container, sharing upload tickets"""
+    def __init__(self, uploader, audit_log, container, upload_queue, memory_budget=None):
+        """Initialize a batch upload task
+
+        Arguments:
+            upload_queue (WorkQueue): The queue that files too large for the batch are moved to
+            memory_budget (MemoryBudget): The optional memory budget for the batched data
+        """
+        super(UploadBatchTask, self).__init__('upload')
+        self.uploader = uploader
+        self.audit_log = audit_log
+        self.container = container
+        self.upload_queue = upload_queue
+        self.memory_budget = memory_budget
+        # List of filename, UploadFileWrapper tuples
+        self.files = []
+        # Indexes of files that have been uploaded or skipped, which are not repeated on retry
+        self.finished = set()
+        self.skipped_files = set()
+        # Indexes of files that were queued as separate upload tasks
+        self.queued_files = set()
+
+    def add_file(self, filename, walker, path):
+        self.files.append((filename, UploadFileWrapper(walker=walker, path=path)))
+
+    def execute(self):
+        batch = []
+        batch_names = set()
+        batch_bytes = 0
+
+        for index, (filename, fileobj) in enumerate(self.files):
+            if index in self.finished:
+                continue
+
+            fileobj.reset()
+            size = fileobj.len
+
+            if size == 0:
+                # Skip and log 0-byte files
+                log.info('Skipping 0-byte file upload: %s', filename)
+                self.audit_log.add_log(fileobj.name, self.container, filename,
+                        failed=True, message='Skipped 0-byte file')
+                self._finish(index)
+                self.skipped_files.add(index)
+                continue
+
+            if size >= BATCH_MAX_FILE_SIZE:
+                # Queue larger files as normal uploads, which run concurrently and reserve memory
+                self.upload_queue.enqueue(UploadTask(self.uploader, self.audit_log, self.container, filename,
+                    walker=fileobj.walker, path=fileobj.path, memory_budget=self.memory_budget))
+                self.finished.add(index)
+                self.queued_files.add(index)
+                fileobj.close()
+                continue
+
+            if batch and (len(batch) >= BATCH_MAX_FILES or batch_bytes + size > BATCH_MAX_BYTES
+                    or filename in batch_names):
+                self._upload_batch(batch)
+                batch, batch_names, batch_bytes = [], set(), 0
+
+            reserved = 0
+            if self.memory_budget is not None:
+                reserved = size
+                if not self.memory_budget.try_acquire(size):
+                    # Send what we have, then wait for memory
+                    if batch:
+                        self._upload_batch(batch)
+                        batch, batch_names, batch_bytes = [], set(), 0
+                    reserved = self.memory_budget.acquire(size)
+
+            batch.append((index, fileobj.read(size), reserved))
+            batch_names.add(filename)
+            batch_bytes += size
+
+        if batch:
+            self._upload_batch(batch)
+
+        return None, None
+
+    def _upload_batch(self, batch):
+        """Upload a list of (index, data, reserved bytes) tuples"""
+        try:
+            # Send the files as concurrently as the queue currently allows uploads to run
+            self.uploader.upload_batch(self.container, [(self.files[index][0], data) for index, data, _ in batch],
+                max_workers=self.upload_queue.get_concurrency('upload'))
+        finally:
+            if self.memory_budget is not None:
+                self.memory_budget.release(sum(reserved for _, _, reserved in batch))
+
+        for index, _, _ in batch:
+            self._finish(index)
+
+    def _finish(self, index):
+        self.finished.add(index)
+        try:
+            self.files[index][1].close()
+        except:
+            log.exception('Cannot close file object')
+        self.files[index][1].release()
+
+    def get_item_count(self):
+        # Queued files are counted by their own tasks
+        return len(self.files) - len(self.queued_files)
+
+    def get_bytes_processed(self):
+        return sum(fileobj.get_bytes_sent() for _, fileobj in self.files)
+
+    def get_desc(self):
+        return 'Upload {} files to {}'.format(len(self.files), self.container.label or self.container.id)
+
+class StreamingUploadTask(UploadTask):
+    """Upload task that reads a packfile from a pipe while it is being created"""
+    def __init__(self, uploader, audit_log, container, filename, pipe, path=None, metadata=None):
+        super(StreamingUploadTask, self).__init__(uploader, audit_log, container, filename,
+            fileobj=pipe, path=path, metadata=metadata)
+        self.pipe = pipe
+
+    def execute(self):
+        try:
+            self.uploader.upload_stream(self.container, self.filename, self.fileobj, metadata=self.metadata)
+        except Exception as ex:
+            # Stop the packfile task, which will be retried as a whole
+            self.pipe.close_reader(ex)
+            raise
+
+        self.pipe.close_reader()
+        self.fileobj.fileobj = None
+        return None, None
+
 class PackfileTask(Task):
     def __init__(self, uploader, audit_log, walker, packfile_type, deid_profile,
-            container, filename, subdir=None, paths=None, compression=None, max_spool=None):
+            container, filename, subdir=None, paths=None, compression=None, max_spool=None,
+            process_pool=None, compression_level=None, memory_budget=None, stream_queue=None, compressor=None,
+            compression_policy=None, packfile_cache=None):
+        """Initialize a packfile task
+
+        Arguments:
+            stream_queue (WorkQueue): If set, stream the packfile to an upload task in this queue
+            compressor (ParallelCompressor): If set, compress members in parallel with this compressor
+            compression_policy (CompressionPolicy): If set, choose the compression of each member with this policy
+            packfile_cache (PackfileCache): If set, reuse packfiles from (and add them to) this cache
+        """
         super(PackfileTask, self).__init__('packfile')
 
         self.uploader = uploader
@@ -162,16 +458,64 @@ class PackfileTask(Task):
         self.paths = paths
         self.compression = compression
         self.max_spool = max_spool
+        self.process_pool = process_pool
+        self.compression_level = compression_level
+        self.memory_budget = memory_budget
+        self.stream_queue = stream_queue
+        self.compressor = compressor
+        self.compression_policy = compression_policy
+        self.packfile_cache = packfile_cache
 
         self._bytes_processed = None
         self._logged_error = False
 
-    def execute(self):
-        if self.max_spool:
-            tmpfile = tempfile.SpooledTemporaryFile(max_size=self.max_spool)
-        else:
-            tmpfile = tempfile.TemporaryFile()
+    def use_process_pool(self):
+        """Check if this packfile can be created in a worker process"""
+        if not self.process_pool or not self.walker.can_reopen():
+            return False
+
+        # De-id logs and subject maps are stateful, and must stay in this process
+        if self.deid_profile and (self.deid_profile.log or self.deid_profile.map_subjects):
+            return False
+
+        return True
 
+    def get_cache_key(self):
+        """Get the packfile cache key for this packfile
+
+        Returns:
+            tuple(str, int): The cache key (or None if the packfile can't be cached) and the member count
+        """
+        if self.packfile_cache is None:
+            return None, 0
+
+        # De-id logs and subject maps must see every packed file
+        if self.deid_profile and (self.deid_profile.log or self.deid_profile.map_subjects):
+            return None, 0
+
+        try:
+            if self.paths:
+                members = list(zip(self.paths, self.walker.get_file_infos(self.paths)))
+            else:
+                members = list(self.walker.file_infos(subdir=self.subdir))
+
+            key = PackfileCache.get_key(self.walker.get_fs_url(), self.packfile_type, self.deid_profile,
+                self.compression, self.compression_level, self.compression_policy, members)
+        except Exception:  # pylint: disable=broad-except
+            log.debug('Could not determine the packfile cache key for %s', self.filename, exc_info=True)
+            return None, 0
+
+        return key, len(members)
+
+    def add_to_cache(self, cache_key, tmpfile):
+        """Add a packfile to the cache, if possible, then rewind it"""
+        try:
+            self.packfile_cache.put(cache_key, tmpfile)
+        except OSError:
+            log.debug('Could not add packfile %s to the cache', self.filename, exc_info=True)
+        tmpfile.seek(0)
+
+    def execute(self):
         # store the packfile path
         audit_path = None
         if self.subdir:
@@ -182,9 +526,25 @@ class PackfileTask(Task):
             audit_path = self.walker.get_fs_url()
 
         try:
-            zip_member_count = create_zip_packfile(tmpfile, self.walker, packfile_type=self.packfile_type,
-                subdir=self.subdir, paths=self.paths, compression=self.compression,
-                progress_callback=self.update_bytes_processed, deid_profile=self.deid_profile)
+            cache_key, zip_member_count = self.get_cache_key()
+            tmpfile = self.packfile_cache.open(cache_key) if cache_key else None
+
+            if tmpfile is not None:
+                log.debug('Using cached packfile for %s', self.filename)
+                self.update_bytes_processed(os.fstat(tmpfile.fileno()).st_size)
+            elif self.stream_queue is not None:
+                paths = self.stream_packfile(audit_path)
+                self.walker.release(paths)
+                self.walker = None
+                return None, None
+            else:
+                if self.use_process_pool():
+                    tmpfile, zip_member_count = self.create_packfile_in_process()
+                else:
+                    tmpfile, zip_member_count = self.create_packfile()
+
+                if cache_key:
+                    self.add_to_cache(cache_key, tmpfile)
         except Exception as ex:
             log.debug('Error processing packfile at %s', audit_path, exc_info=True)
             if not self._logged_error:
@@ -194,10 +554,9 @@ class PackfileTask(Task):
                 self._logged_error = True
             raise
 
-        #Rewind
-        tmpfile.seek(0)
-
-        # Remove walker reference
+        # Packed files are not read again, remove walker reference
+        if self.paths:
+            self.walker.release(self.paths)
         self.walker = None
 
         metadata = {
@@ -205,14 +564,101 @@ class PackfileTask(Task):
             'zip_member_count': zip_member_count
         }
 
-        # The next task is an uplad task
+        # The next task is an upload task, which releases the memory held by the packfile when it closes it
         next_task = UploadTask(self.uploader, self.audit_log, self.container, self.filename,
                           fileobj=tmpfile, metadata=metadata,
-                          path=audit_path)
+                          path=audit_path, memory_budget=self.memory_budget)
 
         # Enqueue with higher priority than normal uploads
         return (next_task, 5)
 
+    def create_packfile(self):
+        """Create the packfile in this thread, as a temporary file
+
+        Returns:
+            tuple(file, int): The rewound packfile and the number of members
+        """
+        if self.max_spool and self.memory_budget is not None:
+            # Memory is reserved as the packfile grows, and it moves to disk if the budget is exhausted
+            tmpfile = BudgetedSpooledFile(self.memory_budget, self.max_spool)
+        elif self.max_spool:
+            tmpfile = tempfile.SpooledTemporaryFile(max_size=self.max_spool)
+        else:
+            tmpfile = tempfile.TemporaryFile()
+
+        try:
+            zip_member_count = create_zip_packfile(tmpfile, self.walker, packfile_type=self.packfile_type,
+                subdir=self.subdir, paths=self.paths, compression=self.compression,
+                progress_callback=self.update_bytes_processed, deid_profile=self.deid_profile,
+                compressor=self.compressor, policy=self.compression_policy)
+        except:
+            tmpfile.close()
+            raise
+
+        #Rewind
+        tmpfile.seek(0)
+        return tmpfile, zip_member_count
+
+    def stream_packfile(self, audit_path):
+        """Create the packfile in this thread, while an upload task sends it from a pipe
+
+        Raises an error if either packing or uploading fails, so the task can be retried.
+
+        Returns:
+            list: The paths of the packed files
+        """
+        # The member count is sent with the upload ticket, so determine the paths up front
+        paths = self.paths
+        if not paths:
+            paths = get_packfile_paths(self.walker, subdir=self.subdir)
+
+        metadata = {
+            'name': self.filename,
+            'zip_member_count': len(paths)
+        }
+
+        pipe = BoundedPipe()
+        upload_task = StreamingUploadTask(self.uploader, self.audit_log, self.container, self.filename,
+            pipe, path=audit_path, metadata=metadata)
+        # Enqueue with higher priority than normal uploads
+        self.stream_queue.enqueue(upload_task, priority=5)
+
+        try:
+            create_zip_packfile(pipe, self.walker, packfile_type=self.packfile_type,
+                subdir=self.subdir, paths=paths, compression=self.compression,
+                progress_callback=self.update_bytes_processed, deid_profile=self.deid_profile,
+                compressor=self.compressor, policy=self.compression_policy)
+        except Exception as ex:
+            pipe.abort(ex)
+            raise
+
+        pipe.close()
+        try:
+            error = pipe.wait_for_reader()
+        except PipeTimeoutError as ex:
+            pipe.abort(ex)
+            raise
+        if error is not None:
+            raise error
+        return paths
+
+    def create_packfile_in_process(self):
+        """Create the packfile in the process pool, as a temporary file on disk
+
+        Returns:
+            tuple(file, int): The opened packfile (removed on close) and the number of members
+        """
+        future = self.process_pool.submit(create_packfile_in_process, self.walker.get_fs_url(),
+            self.walker.get_options(), self.packfile_type, self.deid_profile, subdir=self.subdir,
+            paths=self.paths, compression=self.compression, compression_level=self.compression_level,
+            policy=self.compression_policy)
+
+        path, zip_member_count, bytes_processed, policy_stats = future.result()
+        self.update_bytes_processed(bytes_processed)
+        if policy_stats:
+            self.compression_policy.add_stats(policy_stats)
+        return DeleteOnCloseFile(path, 'rb'), zip_member_count
+
     def get_bytes_processed(self):
         if self._bytes_processed is None:
             return 0
@@ -233,6 +679,16 @@ class UploadQueue(WorkQueue):
         if uploader.supports_signed_url():
             upload_threads = config.concurrent_uploads
 
+        # Stream packfiles directly to the uploader, if requested and supported
+        stream_packfiles = False
+        if config.stream_packfiles:
+            if uploader.supports_streaming():
+                stream_packfiles = True
+                # Every packing thread waits on the upload of its packfile, so each needs an upload thread
+                upload_threads = max(upload_threads, config.cpu_count)
+            else:
+                log.warning('Streaming packfiles is not supported by this destination, using temporary files')
+
         super(UploadQueue, self).__init__({
             'upload': upload_threads,
             'packfile': config.cpu_count
@@ -240,11 +696,51 @@ class UploadQueue(WorkQueue):
 
         self.uploader = uploader
         self.compression = config.get_compression_type()
+        self.compression_policy = config.get_compression_policy()
+
+        # Keep packfiles on disk for reruns, if requested
+        self.packfile_cache = None
+        if config.packfile_cache_size:
+            self.packfile_cache = PackfileCache(config.packfile_cache_path, config.packfile_cache_size)
+        self.compression_level = config.compression_level
         self.max_spool = config.max_spool
         self.audit_log = audit_log
 
+        # Limit the memory held by spooled packfiles and in-memory uploads
+        self.memory_budget = None
+        if config.memory_budget:
+            self.memory_budget = MemoryBudget(config.memory_budget)
+
         self.skip_existing = config.skip_existing_files
 
+        self.stream_packfiles = stream_packfiles
+
+        # Group small files into batches that share an upload ticket, if supported
+        self.batch_uploads = uploader.supports_batch_upload()
+        self._batch = None
+
+        # Create packfiles in worker processes, if requested (the pool is started on first use)
+        self._process_pool = None
+        self._use_process_pool = config.packfile_processes and not self.stream_packfiles
+        self._process_count = config.cpu_count
+
+        # Compress the members of each packfile in parallel, if requested
+        self._compressor = None
+        self._compressor_reserved = 0
+        if config.compress_threads > 1:
+            window_size = PARALLEL_WINDOW_SIZE
+            if self.memory_budget:
+                # The members being compressed are held in memory too, leave the rest for uploads
+                window_size = min(window_size, self.memory_budget.limit // 2)
+                self._compressor_reserved = self.memory_budget.acquire(window_size)
+            self._compressor = ParallelCompressor(config.compress_threads, window_size=window_size)
+
+        # Tune the number of active upload threads, if requested
+        self._concurrency_controller = None
+        if config.adaptive_uploads and upload_threads > 1:
+            self._concurrency_controller = AdaptiveConcurrencyController(self, 'upload',
+                max_count=upload_threads, initial_count=config.initial_concurrent_uploads)
+
         self._progress_thread = None
         if show_progress:
             self._progress_thread = ProgressReporter(self)
@@ -252,15 +748,37 @@ class UploadQueue(WorkQueue):
             self._progress_thread.add_group('packfile', 'Packing',  packfile_count)
             self._progress_thread.add_group('upload', self.uploader.verb, upload_count + packfile_count)
 
+    def add_counts(self, upload_count=0, packfile_count=0):
+        """Add to the expected number of uploads and packfiles, when queueing incrementally"""
+        if self._progress_thread:
+            self._progress_thread.add_to_group('packfile', packfile_count)
+            self._progress_thread.add_to_group('upload', upload_count + packfile_count)
+
+    def get_process_pool(self):
+        """Get the process pool for creating packfiles, if enabled"""
+        if self._use_process_pool and self._process_pool is None:
+            self._process_pool = util.create_process_pool(self._process_count)
+        return self._process_pool
+
     def start(self):
         super(UploadQueue, self).start()
 
+        if self._concurrency_controller:
+            self._concurrency_controller.start()
+
         if self._progress_thread:
             self._progress_thread.start()
 
     def add_audit_log(self, task, failed=False, message=None):
         """Add audit log, if this is not a packfile task"""
-        if not isinstance(task, PackfileTask):
+        if isinstance(task, UploadBatchTask):
+            for index, (filename, fileobj) in enumerate(task.files):
+                # Skipped and queued files are logged by their tasks, and failed files are logged on completion
+                if index in task.skipped_files or index in task.queued_files or (failed and index in task.finished):
+                    continue
+                self.audit_log.add_log(fileobj.path, task.container, filename,
+                        failed=failed, message=message)
+        elif not isinstance(task, PackfileTask):
             self.audit_log.add_log(task.fileobj.name, task.container, task.filename,
                     failed=failed, message=message)
 
@@ -270,13 +788,47 @@ class UploadQueue(WorkQueue):
         super(UploadQueue, self).complete(task)
 
     def shutdown(self):
+        if self._concurrency_controller:
+            self._concurrency_controller.shutdown()
+
         # Shutdown reporting thread
         if self._progress_thread:
             self._progress_thread.shutdown()
             self._progress_thread.final_report()
+            if self.compression_policy:
+                print(self.compression_policy.get_summary())
+
+        # Unblock packfile tasks that are streaming to uploads that won't run
+        self.running = False
+        self.cancel_streams(PipeClosedError('Upload queue was shut down'))
 
         super(UploadQueue, self).shutdown()
 
+        if self._process_pool:
+            self._process_pool.shutdown()
+            self._process_pool = None
+
+        if self._compressor:
+            self._compressor.shutdown()
+            self._compressor = None
+            if self.memory_budget:
+                self.memory_budget.release(self._compressor_reserved)
+
+    def cancel_streams(self, error):
+        """Close the pipes of all waiting and running streaming uploads
+
+        Arguments:
+            error (Exception): The error raised by both ends of each pipe
+        """
+        with self._lock:
+            tasks = list(self.pending)
+            for queue in self.waiting.values():
+                tasks.extend(task for _, _, task in queue)
+
+        for task in tasks:
+            if isinstance(task, StreamingUploadTask):
+                task.pipe.cancel(error)
+
     def suspend_reporting(self):
         if self._progress_thread:
             self._progress_thread.suspend()
@@ -287,15 +839,36 @@ class UploadQueue(WorkQueue):
 
     def error(self, task):
         self.add_audit_log(task, failed=True, message='Upload error')
+        if self.memory_budget is not None and isinstance(task, UploadTask):
+            # Don't hold memory while waiting for a retry
+            task.release_memory()
         super(UploadQueue, self).error(task)
 
+    def wait_for_finish(self):
+        self.flush_batch()
+        super(UploadQueue, self).wait_for_finish()
+
+    def requeue_errors(self):
+        with self._lock:
+            # Streamed uploads cannot be repeated, they are recreated when their packfile is retried
+            self.errors = [task for task in self.errors if not isinstance(task, StreamingUploadTask)]
+        super(UploadQueue, self).requeue_errors()
+
     def log_exception(self, job, exc_info):
+        if self._concurrency_controller and is_throttle_error(exc_info):
+            self._concurrency_controller.record_throttle()
+
         self.suspend_reporting()
 
         super(UploadQueue, self).log_exception(job, exc_info)
 
         self.resume_reporting()
 
+    def prefetch_existing(self, containers):
+        """Prefetch existing file names for containers, if skipping existing files"""
+        if self.skip_existing:
+            self.uploader.prefetch_files(containers)
+
     def upload(self, container, filename, fileobj):
         if self.skip_existing and self.uploader.file_exists(container, filename):
             log.debug('Skipping existing file "%s" on %s %s', filename,
@@ -304,7 +877,8 @@ class UploadQueue(WorkQueue):
             self.audit_log.add_log(fileobj.name, container, filename, message='Skipped existing')
             return
 
-        self.enqueue(UploadTask(self.uploader, self.audit_log, container, filename, fileobj=fileobj))
+        self.enqueue(UploadTask(self.uploader, self.audit_log, container, filename, fileobj=fileobj,
+            memory_budget=self.memory_budget))
 
     def upload_file(self, container, filename, walker, path):
         if self.skip_existing and self.uploader.file_exists(container, filename):
@@ -314,7 +888,38 @@ class UploadQueue(WorkQueue):
             self.audit_log.add_log(path, container, filename, message='Skipped existing')
             return
 
-        self.enqueue(UploadTask(self.uploader, self.audit_log, container, filename, walker=walker, path=path))
+        walker.prefetch([path])
+        if self.batch_uploads:
+            self._add_to_batch(container, filename, walker, path)
+        else:
+            self.enqueue(UploadTask(self.uploader, self.audit_log, container, filename, walker=walker, path=path,
+                memory_budget=self.memory_budget))
+
+    def _add_to_batch(self, container, filename, walker, path):
+        """Add a file to the batch for container, queueing the previous batch if it is full"""
+        batch = self._batch
+        if batch is not None and (batch.container is not container or len(batch.files) >= BATCH_MAX_FILES):
+            self.flush_batch()
+
+        if self._batch is None:
+            self._batch = UploadBatchTask(self.uploader, self.audit_log, container, self,
+                memory_budget=self.memory_budget)
+        self._batch.add_file(filename, walker, path)
+
+    def flush_batch(self):
+        """Queue the current batch of files, if any"""
+        batch = self._batch
+        self._batch = None
+        if batch is None:
+            return
+
+        if len(batch.files) == 1:
+            # No need for a batch
+            filename, fileobj = batch.files[0]
+            self.enqueue(UploadTask(self.uploader, self.audit_log, batch.container, filename,
+                walker=fileobj.walker, path=fileobj.path, memory_budget=self.memory_budget))
+        else:
+            self.enqueue(batch)
 
     def upload_packfile(self, walker, packfile_type, deid_profile, container, filename, subdir=None, paths=None):
         if self.skip_existing and self.uploader.file_exists(container, filename):
@@ -326,6 +931,12 @@ class UploadQueue(WorkQueue):
                 self.audit_log.add_log(paths[0], container, filename, message='Skipped existing')
             return
 
+        if paths:
+            walker.prefetch(paths)
         self.enqueue(PackfileTask(self.uploader, self.audit_log, walker, packfile_type,
             deid_profile, container, filename, subdir=subdir, paths=paths,
-            compression=self.compression, max_spool=self.max_spool))
+            compression=self.compression, max_spool=self.max_spool,
+            process_pool=self.get_process_pool(), compression_level=self.compression_level,
+            memory_budget=self.memory_budget, stream_queue=self if self.stream_packfiles else None,
+            compressor=self._compressor, compression_policy=self.compression_policy,
+            packfile_cache=self.packfile_cache))
@@ -32,6 +32,10 @@ class Task(ABC):
     def allow_retry(self):
         return False
 
+    def get_item_count(self):
+        """Get the number of items (e.g. files) processed by this task"""
+        return 1
+
 class WorkQueue(object):
     """Multi-threaded upload queue that reports progress"""
     def __init__(self, groups):
@@ -42,16 +46,19 @@ class WorkQueue(object):
         """
         # Queue of waiting jobs, by group
         self.waiting = {key: [] for key in groups.keys()}
-        # Queue of pending jobs
-        self.pending = []
-        # Queue of completed jobs
-        self.completed = []
+        # Set of pending (running) jobs
+        self.pending = set()
         # List of errored jobs
         self.errors = []
-        # Count of skipped jobs
-        self.skipped = { group: 0 for group in groups.keys() }
+        # Running totals of completed, skipped and errored jobs, by group
+        self.stats = {group: {'completed': 0, 'completed_bytes': 0, 'skipped': 0, 'errors': 0}
+            for group in groups.keys()}
 
         self.groups = groups
+        # The number of jobs that may run at once, by group (at most the thread count)
+        self.limits = dict(groups)
+        # The number of jobs currently running, by group
+        self.active = {group: 0 for group in groups.keys()}
 
         self.running = False
         self._finish_called = False
@@ -88,7 +95,36 @@ class WorkQueue(object):
         if group is None:
             group = task.group
         with self._lock:
-            self.skipped[group] += 1
+            self.stats[group]['skipped'] += 1
+
+    def set_concurrency(self, group, count):
+        """Set the number of jobs in group that may run at the same time.
+
+        Arguments:
+            group (str): The group tag
+            count (int): The new limit, between 1 and the number of worker threads
+
+        Returns:
+            int: The limit that was applied
+        """
+        count = max(1, min(count, self.groups[group]))
+        cond = self._cond[group]
+        with cond:
+            self.limits[group] = count
+            cond.notify_all()
+        return count
+
+    def get_concurrency(self, group):
+        """Get the number of jobs in group that may currently run at the same time.
+
+        Arguments:
+            group (str): The group tag
+
+        Returns:
+            int: The current limit
+        """
+        with self._lock:
+            return self.limits[group]
 
     def take(self, group):
         result = None
@@ -96,7 +132,7 @@ class WorkQueue(object):
         with cond:
             while self.running:
                 queue = self.waiting[group]
-                if queue:
+                if queue and self.active[group] < self.limits[group]:
                     _, _, result = heapq.heappop(queue)
                     break
                 cond.wait()
@@ -104,15 +140,25 @@ class WorkQueue(object):
             if not self.running:
                 return None
 
-            self.pending.append(result)
+            self.active[group] += 1
+            self.pending.add(result)
             return result
 
+    def _release(self, task):
+        """Remove task from the pending set, allowing another job in its group to start"""
+        self.pending.discard(task)
+        self.active[task.group] -= 1
+        self._cond[task.group].notify()
+
     def complete(self, task):
         finished = False
 
         with self._lock:
-            self.pending.remove(task)
-            self.completed.append(task)
+            self._release(task)
+
+            stats = self.stats[task.group]
+            stats['completed'] += task.get_item_count()
+            stats['completed_bytes'] += task.get_bytes_processed()
 
             if self._finish_called:
                 # Check to see if we're done
@@ -135,7 +181,8 @@ class WorkQueue(object):
         finished = False
 
         with self._lock:
-            self.pending.remove(task)
+            self._release(task)
+            self.stats[task.group]['errors'] += 1
             self.errors.append(task)
 
             if self._finish_called:
@@ -157,20 +204,21 @@ class WorkQueue(object):
             return False
 
     def get_stats(self):
-        results = {}
+        """Get a snapshot of completed counts and bytes, by group.
+
+        Completed and skipped totals are maintained as tasks finish, so the cost
+        of this call only depends on the number of currently running tasks.
+        The snapshot also includes the number of running ('active') and
+        waiting jobs, and the current concurrency 'limit' of each group.
 
+        Returns:
+            dict: The stats dictionary for each group
+        """
         with self._lock:
-            for group in self.groups.keys():
-                results[group] = {
-                    'completed': 0,
-                    'completed_bytes': 0,
-                    'skipped': self.skipped[group]
-                }
-
-            for task in self.completed:
-                stats = results[task.group]
-                stats['completed'] = stats['completed'] + 1
-                stats['completed_bytes'] = stats['completed_bytes'] + task.get_bytes_processed()
+            results = {}
+            for group, stats in self.stats.items():
+                results[group] = dict(stats, active=self.active[group], limit=self.limits[group],
+                    waiting=len(self.waiting[group]))
 
             for task in self.pending:
                 stats = results[task.group]
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import argparse
 import logging
+import multiprocessing
 import os
 import platform
 import sys
@@ -15,6 +16,9 @@ perror = util.perror
 
 
 def main():
+    # Support worker processes in frozen executables
+    multiprocessing.freeze_support()
+
     # Handle fs weirdness
     monkey.patch_fs()
 
@@ -1,11 +1,14 @@
 """Provides flywheel-sdk implementations of common abstract classes"""
+import concurrent.futures
 import copy
 import flywheel
 import json
 import logging
 import os
+import re
 import requests
 import sys
+import threading
 
 from .importers import Uploader, ContainerResolver
 
@@ -13,6 +16,23 @@ CONFIG_PATH = '~/.config/flywheel/user.json'
 config = None
 
 TICKETED_UPLOAD_PATH = '/{ContainerType}/{ContainerId}/files'
+ID_PATH_EL_RE = re.compile(r'^<id:(.*)>$')
+PREFETCH_THREADS = 8 # Number of concurrent requests when prefetching file names or children
+RESOLVE_PAGE_SIZE = 1000 # Number of children to retrieve per request when indexing the hierarchy
+
+# The method to list children of each container type, for bulk resolution
+CHILD_LIST_METHODS = {
+    'group': 'get_group_projects',
+    'project': 'get_project_subjects',
+    'subject': 'get_subject_sessions',
+    'session': 'get_session_acquisitions',
+}
+PARENT_TYPES = {
+    'project': 'group',
+    'subject': 'project',
+    'session': 'subject',
+    'acquisition': 'session',
+}
 
 log = logging.getLogger(__name__)
 
@@ -125,12 +145,29 @@ For now we skip subjects, replacing them (effectively) with the project layer,
 and treating them as if they always exist.
 """
 class SdkUploadWrapper(Uploader, ContainerResolver):
-    def __init__(self, fw):
+    def __init__(self, fw, bulk_resolve=False, resolve_threads=PREFETCH_THREADS):
+        """Initialize the uploader
+
+        Arguments:
+            fw (Client): The flywheel client
+            bulk_resolve (bool): Resolve containers from a listing of their parent's children
+            resolve_threads (int): The number of children listings to request at the same time
+        """
         self.fw = fw
+        self.resolve_threads = max(1, resolve_threads)
+        # Index of child label to (id, uid), by parent id, retrieved in the background
+        self._child_indexes = None
+        self._child_index_lock = threading.Lock()
+        self._resolve_executor = None
+        if bulk_resolve:
+            self._child_indexes = {}
         self.fw.api_client.set_default_header('X-Accept-Feature', 'Subject-Container')
         self._supports_signed_url = None
         # Session for signed-url uploads
         self._upload_session = requests.Session()
+        # Cache of file names, by container id
+        self._file_names = {}
+        self._file_names_lock = threading.Lock()
 
     def supports_signed_url(self):
         if self._supports_signed_url is None:
@@ -146,6 +183,11 @@ class SdkUploadWrapper(Uploader, ContainerResolver):
         return self._supports_signed_url
 
     def resolve_path(self, container_type, path):
+        if self._child_indexes is not None:
+            result = self._resolve_from_index(container_type, path)
+            if result is not None:
+                return result
+
         parts = path.split('/')
 
         try:
@@ -157,6 +199,82 @@ class SdkUploadWrapper(Uploader, ContainerResolver):
             log.debug('Resolve %s: %s - NOT FOUND', container_type, path)
             return None, None
 
+    def _resolve_from_index(self, container_type, path):
+        """Resolve path from the listing of its parent's children.
+
+        Returns:
+            tuple(str, str): The id and uid (or None, None if the container doesn't exist),
+                or None if the path could not be resolved this way
+        """
+        parent_type = PARENT_TYPES.get(container_type)
+        parts = path.split('/')
+        if not parent_type or len(parts) < 2:
+            return None
+
+        # The parent must be an existing container, and the child referenced by label
+        parent_el, label = parts[-2], parts[-1]
+        if parent_type == 'group':
+            parent_id = parent_el
+        else:
+            match = ID_PATH_EL_RE.match(parent_el)
+            if not match:
+                return None
+            parent_id = match.group(1)
+        if ID_PATH_EL_RE.match(label):
+            return None
+
+        try:
+            index = self._get_child_index(parent_type, parent_id).result()
+        except flywheel.ApiException:
+            log.debug('Could not list children of %s=%s', parent_type, parent_id, exc_info=True)
+            return None
+
+        cid, uid = index.get(label, (None, None))
+        log.debug('Resolve %s: %s - from index: %s', container_type, path, cid)
+
+        # Start listing this container's children, which are likely to be resolved next
+        if cid and container_type in CHILD_LIST_METHODS:
+            self._get_child_index(container_type, cid)
+
+        return cid, uid
+
+    def _get_child_index(self, parent_type, parent_id):
+        """Get a future for the child index of the given parent, starting the listing if necessary"""
+        with self._child_index_lock:
+            future = self._child_indexes.get(parent_id)
+            if future is None:
+                if self._resolve_executor is None:
+                    self._resolve_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.resolve_threads)
+                future = self._resolve_executor.submit(self._list_children, parent_type, parent_id)
+                self._child_indexes[parent_id] = future
+            return future
+
+    def close(self):
+        with self._child_index_lock:
+            executor = self._resolve_executor
+            self._resolve_executor = None
+        if executor is not None:
+            executor.shutdown()
+
+    def _list_children(self, parent_type, parent_id):
+        """List all children of parent, page by page, returning an index of label to (id, uid)"""
+        list_fn = getattr(self.fw, CHILD_LIST_METHODS[parent_type])
+
+        index = {}
+        kwargs = {'limit': RESOLVE_PAGE_SIZE}
+        while True:
+            page = list_fn(parent_id, **kwargs)
+            for child in page:
+                # Like resolve, the first child with a given label wins
+                index.setdefault(child.label, (child.id, child.get('uid')))
+
+            if len(page) < RESOLVE_PAGE_SIZE:
+                break
+            kwargs['after_id'] = page[-1].id
+
+        log.debug('Indexed %d children of %s=%s', len(index), parent_type, parent_id)
+        return index
+
     def create_container(self, parent, container):
         # Create container
         create_fn = getattr(self.fw, 'add_{}'.format(container.container_type), None)
@@ -176,6 +294,10 @@ class SdkUploadWrapper(Uploader, ContainerResolver):
 
         new_id = create_fn(create_doc)
         log.debug('Created container: %s as %s', create_doc, new_id)
+
+        # New containers don't have any files
+        with self._file_names_lock:
+            self._file_names[new_id] = set()
         return new_id
 
     def check_unique_uids(self, request):
@@ -198,15 +320,84 @@ class SdkUploadWrapper(Uploader, ContainerResolver):
             self.signed_url_upload(container, name, fileobj, metadata=metadata)
         else:
             upload_fn(container.id, flywheel.FileSpec(name, fileobj), metadata=json.dumps(metadata))
+        self._add_file_name(container, name)
+
+    def supports_batch_upload(self):
+        # A signed-url ticket can be created for several files
+        return self.supports_signed_url()
+
+    def upload_batch(self, container, files, max_workers=1):
+        path_params = {
+            'ContainerType': pluralize(container.container_type),
+            'ContainerId': container.id
+        }
+        names = [name for name, _ in files]
+        ticket, upload_urls = self.create_batch_upload_ticket(path_params, names)
+
+        log.debug('Batch upload of %d files to %s=%s (ticket=%s)', len(files),
+            container.container_type, container.id, ticket)
+
+        def put_file(item):
+            name, data = item
+            resp = self._upload_session.put(upload_urls[name], data=data)
+            resp.raise_for_status()
+            resp.close()
+
+        # Perform the uploads in parallel, then complete them all at once
+        max_workers = max(1, min(max_workers, len(files)))
+        if max_workers == 1:
+            for item in files:
+                put_file(item)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for _ in executor.map(put_file, files):
+                    pass
+
+        self.complete_upload_ticket(path_params, ticket)
+
+        for name in names:
+            self._add_file_name(container, name)
 
     def file_exists(self, container, name):
-        cont = self.fw.get(container.id)
-        if not cont:
-            return False
-        for file_entry in cont.get('files', []):
-            if file_entry['name'] == name:
-                return True
-        return False
+        with self._file_names_lock:
+            file_names = self._file_names.get(container.id)
+
+        if file_names is None:
+            file_names = self._fetch_file_names(container.id)
+        return name in file_names
+
+    def prefetch_files(self, containers):
+        with self._file_names_lock:
+            container_ids = {container.id for container in containers
+                if container.id and container.id not in self._file_names}
+
+        if not container_ids:
+            return
+
+        log.debug('Prefetching file names for %d containers', len(container_ids))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_THREADS) as executor:
+            for _ in executor.map(self._fetch_file_names, container_ids):
+                pass
+
+    def _fetch_file_names(self, container_id):
+        """Retrieve and cache the set of file names on a container"""
+        cont = self.fw.get(container_id)
+        file_names = set()
+        if cont:
+            file_names = {file_entry['name'] for file_entry in cont.get('files', [])}
+
+        with self._file_names_lock:
+            # Keep names added by uploads that completed while fetching
+            file_names.update(self._file_names.get(container_id, ()))
+            self._file_names[container_id] = file_names
+        return file_names
+
+    def _add_file_name(self, container, name):
+        """Record an uploaded file in the cache, if the container is cached"""
+        with self._file_names_lock:
+            file_names = self._file_names.get(container.id)
+            if file_names is not None:
+                file_names.add(name)
 
     def signed_url_upload(self, container, name, fileobj, metadata=None):
         """Upload fileobj to container as name, using signed-urls"""
@@ -229,9 +420,13 @@ class SdkUploadWrapper(Uploader, ContainerResolver):
         self.complete_upload_ticket(path_params, ticket)
 
     def create_upload_ticket(self, path_params, name, metadata=None):
+        ticket, upload_urls = self.create_batch_upload_ticket(path_params, [name], metadata=metadata)
+        return ticket, upload_urls[name]
+
+    def create_batch_upload_ticket(self, path_params, names, metadata=None):
         body = {
             'metadata': metadata or {},
-            'filenames': [ name ]
+            'filenames': names
         }
 
         response = self.call_api(TICKETED_UPLOAD_PATH, 'POST',
@@ -241,7 +436,7 @@ class SdkUploadWrapper(Uploader, ContainerResolver):
             response_type=object
         )
 
-        return response['ticket'], response['urls'][name]
+        return response['ticket'], response['urls']
 
     def complete_upload_ticket(self, path_params, ticket):
         self.call_api(TICKETED_UPLOAD_PATH, 'POST',
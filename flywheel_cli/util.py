@@ -1,7 +1,9 @@
 import argparse
+import concurrent.futures
 import datetime
 import dateutil.parser
 import logging
+import multiprocessing
 import re
 import os
 import string
@@ -120,6 +122,25 @@ def is_archive(path):
     """Check if path appears to be a zip or tar archive"""
     return is_zip_file(path) or is_tar_file(path)
 
+def create_process_pool(max_workers):
+    """Create a process pool executor for CPU-bound work.
+
+    Workers are spawned rather than forked where supported, since the pool is
+    typically created after worker threads (and their locks) already exist.
+
+    Arguments:
+        max_workers (int): The maximum number of worker processes
+
+    Returns:
+        ProcessPoolExecutor: The process pool
+    """
+    try:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+            mp_context=multiprocessing.get_context('spawn'))
+    except TypeError:
+        # Python < 3.7 does not support mp_context
+        return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+
 def confirmation_prompt(message):
     """Continue prompting at the terminal for a yes/no repsonse
 
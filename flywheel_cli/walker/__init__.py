@@ -1,5 +1,8 @@
 """Provides filesystem walkers"""
 from .abstract_walker import AbstractWalker, FileInfo
+from .os_walker import OsWalker
 from .pyfs_walker import PyFsWalker
 from .s3_walker import S3Walker
+from .tar_stream_walker import TarStreamWalker
+from .zip_walker import ZipWalker
 from .factory import create_walker, create_archive_walker
@@ -1,9 +1,11 @@
 """Abstract file-system walker class"""
 import collections
-import fnmatch
+import concurrent.futures
 
 from abc import ABC, abstractmethod
 
+from .filters import compile_patterns, PathFilter
+
 class FileInfo(object):
     """Represents a node in a filesystem
 
@@ -31,7 +33,7 @@ class FileInfo(object):
 class AbstractWalker(ABC):
     """Abstract interface for walking a filesystem"""
     def __init__(self, root, ignore_dot_files=True, follow_symlinks=False, filter=None, exclude=None,
-            filter_dirs=None, exclude_dirs=None):
+            filter_dirs=None, exclude_dirs=None, list_threads=1):
         """Initialize the abstract walker
 
         Args:
@@ -42,8 +44,10 @@ class AbstractWalker(ABC):
             exclude (list): An optional list of filename patterns to EXCLUDE
             filter_dirs (list): An optional list of directories to INCLUDE
             exclude_dirs (list): An optional list of patterns of directories to EXCLUDE
+            list_threads (int): The number of directories to list concurrently
         """
         self.root = root
+        self.list_threads = max(1, list_threads or 1)
 
         self._ignore_dot_files = ignore_dot_files
         self._follow_symlinks = follow_symlinks
@@ -56,6 +60,12 @@ class AbstractWalker(ABC):
             self._include_dirs = [spec.split('/') for spec in self._include_dirs]
         self._exclude_dirs = exclude_dirs
 
+        # Compile the patterns once, they are checked for every entry
+        self._include_files_matcher = compile_patterns(self._include_files)
+        self._exclude_files_matcher = compile_patterns(self._exclude_files)
+        self._include_dirs_filter = PathFilter(self._include_dirs) if self._include_dirs is not None else None
+        self._exclude_dirs_matcher = compile_patterns(self._exclude_dirs)
+
     def __repr__(self):
         include_files_str = ','.join(self._include_files) if self._include_files else '[]'
         exclude_files_str = ','.join(self._exclude_files) if self._exclude_files else '[]'
@@ -72,40 +82,117 @@ class AbstractWalker(ABC):
     def get_fs_url(self):
         """Return the FS url for the underlying filesystem"""
 
+    def can_reopen(self):
+        """Check if an equivalent walker can be created from get_fs_url() and get_options().
+
+        This is required for using the walker from another process.
+        """
+        return False
+
+    def get_options(self):
+        """Return the keyword arguments that were used to create this walker
+
+        Returns:
+            dict: The filtering options, suitable for passing to create_walker
+        """
+        include_dirs = None
+        if self._include_dirs is not None:
+            include_dirs = ['/'.join(spec) for spec in self._include_dirs]
+
+        return {
+            'ignore_dot_files': self._ignore_dot_files,
+            'follow_symlinks': self._follow_symlinks,
+            'filter': self._include_files,
+            'exclude': self._exclude_files,
+            'filter_dirs': include_dirs,
+            'exclude_dirs': self._exclude_dirs,
+            'list_threads': self.list_threads,
+        }
+
     def walk(self, subdir=None, max_depth=None):
         """Recursively list files in a filesystem.
 
+        If list_threads is greater than 1, upcoming directories are listed concurrently,
+        but results are still yielded in the same (breadth-first) order.
+
         Yields:
             tuple: containing root path, a list of directories, and list of files
         """
-        queue = collections.deque()
         if subdir:
             subdir = self.combine(self.root, subdir)
         else:
             subdir = self.root
 
+        if self.list_threads > 1:
+            walk_iter = self._walk_concurrent(subdir, max_depth)
+        else:
+            walk_iter = self._walk_serial(subdir, max_depth)
+
+        for result in walk_iter:
+            yield result
+
+    def _walk_serial(self, subdir, max_depth):
+        """Walk the filesystem, listing one directory at a time"""
+        queue = collections.deque()
         queue.append((1, subdir))
 
         while queue:
             # Pop next off
             depth, root = queue.popleft()
+            subdirs, files = self._filter_listing(root, self._listdir(root), depth, max_depth, queue)
+            yield (root, subdirs, files)
+
+    def _walk_concurrent(self, subdir, max_depth):
+        """Walk the filesystem, listing up to list_threads directories in parallel"""
+        # Directories that are being listed, in walk order, followed by directories still to list
+        listing = collections.deque()
+        queue = collections.deque()
+        queue.append((1, subdir))
 
-            subdirs = []
-            files = []
+        # Keep a bounded number of listings in flight (and in memory)
+        max_listing = 4 * self.list_threads
 
-            for item in self._listdir(root):
-                full_path = self.combine(root, item.name)
-                if item.is_dir:
-                    prefix_path = self.get_prefix_path(full_path)
-                    if self._should_include_dir(prefix_path, item):
-                        subdirs.append(item)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.list_threads)
+        try:
+            while queue or listing:
+                while queue and len(listing) < max_listing:
+                    depth, root = queue.popleft()
+                    listing.append((depth, root, executor.submit(self._listdir_all, root)))
 
-                        if max_depth is None or depth < max_depth:
-                            queue.append((depth+1, full_path))
-                elif self._should_include_file(item):
-                    files.append(item)
+                depth, root, future = listing.popleft()
+                subdirs, files = self._filter_listing(root, future.result(), depth, max_depth, queue)
+                yield (root, subdirs, files)
+        finally:
+            for _, _, future in listing:
+                future.cancel()
+            executor.shutdown(wait=False)
 
-            yield (root, subdirs, files)
+    def _listdir_all(self, path):
+        """List the contents of the given directory, as a list"""
+        return list(self._listdir(path))
+
+    def _filter_listing(self, root, items, depth, max_depth, queue):
+        """Split a directory listing into included subdirs and files, queueing subdirs to walk
+
+        Returns:
+            tuple: containing a list of directories, and list of files
+        """
+        subdirs = []
+        files = []
+
+        for item in items:
+            full_path = self.combine(root, item.name)
+            if item.is_dir:
+                prefix_path = self.get_prefix_path(full_path)
+                if self._should_include_dir(prefix_path, item):
+                    subdirs.append(item)
+
+                    if max_depth is None or depth < max_depth:
+                        queue.append((depth+1, full_path))
+            elif self._should_include_file(item):
+                files.append(item)
+
+        return subdirs, files
 
     def get_prefix_path(self, root):
         if self.root == '':
@@ -122,10 +209,71 @@ class AbstractWalker(ABC):
 
     def files(self, subdir=None, max_depth=None):
         """Return all files in the sub directory"""
+        for path, _ in self.file_infos(subdir=subdir, max_depth=max_depth):
+            yield path
+
+    def file_infos(self, subdir=None, max_depth=None):
+        """Return all files in the sub directory, along with their FileInfo
+
+        Yields:
+            tuple: containing the file path and FileInfo
+        """
         for root, _, files in self.walk(subdir=subdir, max_depth=max_depth):
+            prefix_path = self.get_prefix_path(root)
             for file_info in files:
-                prefix_path = self.get_prefix_path(root)
-                yield self.combine(prefix_path, file_info.name)
+                yield self.combine(prefix_path, file_info.name), file_info
+
+    def get_file_infos(self, paths):
+        """Get the FileInfo of each of the given files, listing each parent directory once
+
+        Params:
+            paths (list): The relative or full paths of the files
+
+        Returns:
+            list(FileInfo): The file infos in the same order as paths, or None for files that were not found
+        """
+        listings = {}
+        result = []
+        for path in paths:
+            dirname, _, name = path.strip('/').rpartition('/')
+            listing = listings.get(dirname)
+            if listing is None:
+                root = self.combine(self.root, dirname) if dirname else self.root
+                listing = listings[dirname] = {info.name: info for info in self._listdir(root) if not info.is_dir}
+            result.append(listing.get(name))
+        return result
+
+    def prefetch(self, paths):
+        """Hint that the given files will be opened soon.
+
+        Walkers for remote filesystems may start fetching them in the background.
+
+        Params:
+            paths (list): The relative or full paths of the files
+        """
+
+    def release(self, paths):
+        """Hint that the given files will not be opened again, so any local copies can be removed
+
+        Params:
+            paths (list): The relative or full paths of the files
+        """
+
+    def can_open_compressed(self):
+        """Check if this walker can provide the compressed data of archive members (see open_compressed)"""
+        return False
+
+    def open_compressed(self, path):
+        """Open the compressed data of a zip archive member, so it can be copied without recompressing.
+
+        Params:
+            path (str): The relative or full path of the file to open
+
+        Returns:
+            tuple(zipfile.ZipInfo, file): The member info and its compressed data,
+                or (None, None) if the data can't be copied as-is
+        """
+        return None, None
 
     @abstractmethod
     def open(self, path, mode='rb', **kwargs):
@@ -165,13 +313,6 @@ class AbstractWalker(ABC):
         part2 = part2.lstrip('/')
         return part1 + '/' + part2
 
-    def _match(self, patterns, name):
-        """Return true if name matches any of the given patterns"""
-        for pat in patterns:
-            if fnmatch.fnmatch(name, pat):
-                return True
-        return False
-
     def _should_include_dir(self, path, info):
         """Check if the given directory should be included"""
         if self._ignore_dot_files and info.name.startswith('.'):
@@ -180,12 +321,12 @@ class AbstractWalker(ABC):
         if not self._follow_symlinks and info.is_link:
             return False
 
-        if self._include_dirs is not None:
+        if self._include_dirs_filter is not None:
             parts = path.lstrip('/').split('/')
-            if not filter_match(self._include_dirs, parts):
+            if not self._include_dirs_filter.match(parts):
                 return False
 
-        if self._exclude_dirs is not None and self._match(self._exclude_dirs, info.name):
+        if self._exclude_dirs_matcher is not None and self._exclude_dirs_matcher.match(info.name):
             return False
 
         return True
@@ -195,24 +336,10 @@ class AbstractWalker(ABC):
         if self._ignore_dot_files and info.name.startswith('.'):
             return False
 
-        if self._exclude_files is not None and self._match(self._exclude_files, info.name):
+        if self._exclude_files_matcher is not None and self._exclude_files_matcher.match(info.name):
             return False
 
-        if self._include_files is not None and not self._match(self._include_files, info.name):
+        if self._include_files_matcher is not None and not self._include_files_matcher.match(info.name):
             return False
 
         return True
-
-def filter_match(patterns, parts):
-    """Check if any of the given patterns match the split path"""
-    # Fast match - assumes that if the length of parts is
-    # larger than the length of the pattern, then it already matched
-    # previously
-    count = len(parts)
-    for pattern in patterns:
-        pattern_count = len(pattern)
-        if count <= pattern_count:
-            for i in range(count):
-                if not fnmatch.fnmatch(parts[i], pattern[i]):
-                    return False
-    return True
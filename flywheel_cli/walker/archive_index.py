@@ -0,0 +1,62 @@
+"""Directory index for walkers over archive members"""
+import fs.path
+
+from .abstract_walker import FileInfo
+
+
+class ArchiveIndex(object):
+    """Maps directories in an archive to their listings.
+
+    Archives may omit entries for directories, so parent directories are
+    added implicitly whenever a member is added.
+    """
+    def __init__(self):
+        # Map of directory path to (dict of directory name to FileInfo, dict of file name to FileInfo)
+        self._listings = {'': ({}, {})}
+
+    def add_dir(self, path):
+        """Add a directory (and its parents) to the index
+
+        Arguments:
+            path (str): The normalized directory path
+
+        Returns:
+            tuple: The (dirs, files) listing of the directory
+        """
+        listing = self._listings.get(path)
+        if listing is None:
+            parent, name = fs.path.split(path)
+            listing = self._listings[path] = ({}, {})
+            self.add_dir(parent.lstrip('/'))[0].setdefault(name, FileInfo(name, True))
+        return listing
+
+    def add_file(self, path, file_info):
+        """Add a file (and its parent directories) to the index, replacing a file with the same path
+
+        Arguments:
+            path (str): The normalized file path
+            file_info (FileInfo): The file info
+        """
+        dirname = fs.path.dirname(path).lstrip('/')
+        self.add_dir(dirname)[1][file_info.name] = file_info
+
+    def listdir(self, path):
+        """List the contents of a directory
+
+        Arguments:
+            path (str): The directory path
+
+        Returns:
+            list(FileInfo): The subdirectories and files, or an empty list if path is not a directory
+        """
+        listing = self._listings.get(normpath(path))
+        if listing is None:
+            return []
+        return list(listing[0].values()) + list(listing[1].values())
+
+
+def normpath(path):
+    """Normalize a member or walker path to a relative path with no leading slash"""
+    if path in ('', '/', '.'):
+        return ''
+    return fs.path.relpath(fs.path.normpath(path))
@@ -2,12 +2,16 @@
 from urllib.parse import urlparse
 
 from .. import util
+from .os_walker import OsWalker
 from .pyfs_walker import PyFsWalker
 from .s3_walker import S3Walker
+from .tar_stream_walker import TarStreamWalker
+from .zip_walker import ZipWalker
 
 
 def create_walker(fs_url, ignore_dot_files=True, follow_symlinks=False,
-        filter=None, exclude=None, filter_dirs=None, exclude_dirs=None):
+        filter=None, exclude=None, filter_dirs=None, exclude_dirs=None, list_threads=1,
+        flat_listing=False, cache_size=0, tmp_dir=None):
     """Create a walker from a filesystem url
 
     Args:
@@ -18,6 +22,10 @@ def create_walker(fs_url, ignore_dot_files=True, follow_symlinks=False,
         exclude (list): An optional list of filename patterns to EXCLUDE
         filter_dirs (list): An optional list of directories to INCLUDE
         exclude_dirs (list): An optional list of patterns of directories to EXCLUDE
+        list_threads (int): The number of directories to list concurrently
+        flat_listing (bool): Whether S3 walkers should list the whole tree with one recursive listing
+        cache_size (int): If set, the size in bytes of the local staging cache for S3 walkers
+        tmp_dir (str): The directory that tar walkers stage members in, or None for the system default
 
     Returns:
         AbstractWalker: fs_url opened as a walker
@@ -25,32 +33,40 @@ def create_walker(fs_url, ignore_dot_files=True, follow_symlinks=False,
 
     scheme, *_ = urlparse(fs_url)
 
-    cls = S3Walker if scheme == 's3' else PyFsWalker
+    kwargs = {}
+    if scheme == 's3':
+        cls = S3Walker
+        kwargs['flat_listing'] = flat_listing
+        kwargs['cache_size'] = cache_size
+    elif scheme == 'osfs':
+        cls = OsWalker
+    elif scheme == 'tar':
+        cls = TarStreamWalker
+        kwargs['tmp_dir'] = tmp_dir
+    elif scheme == 'zip':
+        cls = ZipWalker
+    else:
+        cls = PyFsWalker
 
     return cls(fs_url, ignore_dot_files=ignore_dot_files,
         follow_symlinks=follow_symlinks, filter=filter, exclude=exclude,
-        filter_dirs=filter_dirs, exclude_dirs=exclude_dirs)
+        filter_dirs=filter_dirs, exclude_dirs=exclude_dirs, list_threads=list_threads, **kwargs)
 
 
-def create_archive_walker(walker, path):
+def create_archive_walker(walker, path, tmp_dir=None):
     """Open the given path as a walker
 
     Arguments:
         walker (AbstractWalker): The source walker instance
         path (str): The path to the file to open
+        tmp_dir (str): The directory that tar archive members are staged in, or None for the system default
 
     Returns:
         AbstractWalker: Path opened as a sub walker
     """
-    archive_fs = None
-
     if util.is_tar_file(path):
-        import fs.tarfs
-        archive_fs = fs.tarfs.TarFS(walker.open(path, 'rb'))
+        # Read tar files once, in order, rather than seeking through them
+        return TarStreamWalker(path, fileobj=walker.open(path, 'rb'), tmp_dir=tmp_dir)
     if util.is_zip_file(path):
-        import fs.zipfs
-        archive_fs = fs.zipfs.ZipFS(walker.open(path, 'rb'))
-
-    if archive_fs:
-        return PyFsWalker(path, src_fs=archive_fs)
+        return ZipWalker(path, fileobj=walker.open(path, 'rb'))
     return None
@@ -0,0 +1,124 @@
+"""Compiled filename and directory filters, with the same semantics as fnmatch"""
+import fnmatch
+import os
+import re
+
+MAGIC_CHARS = re.compile(r'[*?[]')
+
+# Only normalize case where the platform's fnmatch would (e.g. Windows)
+_normcase = os.path.normcase if os.path.normcase('A') != 'A' else None
+
+
+def has_magic(pattern):
+    """Check if pattern contains any wildcard characters"""
+    return MAGIC_CHARS.search(pattern) is not None
+
+
+class PatternMatcher(object):
+    """Matches names against a list of fnmatch patterns at once.
+
+    Literal patterns are looked up in a set, and '*suffix' and 'prefix*' patterns are
+    checked with a single endswith/startswith call. Any other patterns are combined into
+    one regular expression.
+    """
+    def __init__(self, patterns):
+        """Compile the patterns
+
+        Arguments:
+            patterns (list): The fnmatch patterns
+        """
+        self.patterns = list(patterns)
+
+        self._match_all = False
+        self._literals = set()
+        suffixes = []
+        prefixes = []
+        regex_parts = []
+
+        for pattern in self.patterns:
+            if _normcase:
+                pattern = _normcase(pattern)
+
+            if pattern == '*':
+                self._match_all = True
+            elif not has_magic(pattern):
+                self._literals.add(pattern)
+            elif pattern.startswith('*') and not has_magic(pattern[1:]):
+                suffixes.append(pattern[1:])
+            elif pattern.endswith('*') and not has_magic(pattern[:-1]):
+                prefixes.append(pattern[:-1])
+            else:
+                regex_parts.append(fnmatch.translate(pattern))
+
+        self._suffixes = tuple(suffixes)
+        self._prefixes = tuple(prefixes)
+        self._regex = re.compile('|'.join(regex_parts)) if regex_parts else None
+
+    def __repr__(self):
+        return 'PatternMatcher({})'.format(self.patterns)
+
+    def match(self, name):
+        """Check if name matches any of the patterns"""
+        if self._match_all:
+            return True
+
+        if _normcase:
+            name = _normcase(name)
+
+        if name in self._literals:
+            return True
+        if self._suffixes and name.endswith(self._suffixes):
+            return True
+        if self._prefixes and name.startswith(self._prefixes):
+            return True
+        if self._regex is not None and self._regex.match(name) is not None:
+            return True
+        return False
+
+
+class PathFilter(object):
+    """Matches split directory paths against patterns such as 'subject*/session*'.
+
+    A path matches if, for every pattern at least as long as the path, each path
+    component matches the corresponding pattern component. Paths that are longer
+    than a pattern are assumed to have matched it at a previous level.
+    """
+    def __init__(self, specs):
+        """Compile the path patterns
+
+        Arguments:
+            specs (list): The list of patterns, as lists of components
+        """
+        self.specs = specs
+        self._compiled = [[PatternMatcher([part]) for part in spec] for spec in specs]
+
+    def match(self, parts):
+        """Check if the split path matches
+
+        Arguments:
+            parts (list): The path components
+
+        Returns:
+            bool: True if the path should be included
+        """
+        count = len(parts)
+        for spec in self._compiled:
+            if count <= len(spec):
+                for i in range(count):
+                    if not spec[i].match(parts[i]):
+                        return False
+        return True
+
+
+def compile_patterns(patterns):
+    """Compile patterns into a PatternMatcher
+
+    Arguments:
+        patterns (list): The fnmatch patterns, or None
+
+    Returns:
+        PatternMatcher: The compiled patterns, or None if patterns is None
+    """
+    if patterns is None:
+        return None
+    return PatternMatcher(patterns)
@@ -0,0 +1,79 @@
+"""Walker for local directories, implemented directly on os.scandir"""
+import datetime
+import io
+import os
+
+import fs
+import fs.opener
+import fs.path
+
+from .abstract_walker import AbstractWalker, FileInfo
+
+
+class OsWalker(AbstractWalker):
+    """Walker for osfs:// urls that avoids the PyFilesystem layer when listing and opening files"""
+    def __init__(self, fs_url, ignore_dot_files=True, follow_symlinks=False, filter=None, exclude=None,
+            filter_dirs=None, exclude_dirs=None, list_threads=1):
+        """Initialize the os walker
+
+        Args:
+            fs_url (str): The osfs url of the directory to walk
+            ignore_dot_files (bool): Whether or not to ignore files starting with '.'
+            follow_symlinks(bool): Whether or not to follow symlinks
+            filter (list): An optional list of filename patterns to INCLUDE
+            exclude (list): An optional list of filename patterns to EXCLUDE
+            filter_dirs (list): An optional list of directories to INCLUDE
+            exclude_dirs (list): An optional list of patterns of directories to EXCLUDE
+            list_threads (int): The number of directories to list concurrently
+        """
+        super(OsWalker, self).__init__('/', ignore_dot_files=ignore_dot_files,
+                follow_symlinks=follow_symlinks, filter=filter, exclude=exclude,
+                filter_dirs=filter_dirs, exclude_dirs=exclude_dirs, list_threads=list_threads)
+
+        self.fs_url = fs_url
+
+        # Resolve the root the same way as OSFS
+        root_path = fs.opener.parse(fs_url).resource or '.'
+        self.root_path = os.path.normpath(os.path.abspath(os.path.expanduser(os.path.expandvars(root_path))))
+        if not os.path.isdir(self.root_path):
+            raise fs.errors.CreateFailed('root path "{}" does not exist'.format(self.root_path))
+
+    def get_sys_path(self, path):
+        """Get the system path for a path relative to the walker root"""
+        path = fs.path.relpath(fs.path.normpath(path))
+        if not path:
+            return self.root_path
+        return os.path.join(self.root_path, path)
+
+    def _listdir(self, path):
+        with os.scandir(self.get_sys_path(path)) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # Broken symlink
+                    stat = entry.stat(follow_symlinks=False)
+
+                created = getattr(stat, 'st_birthtime', None)
+                yield FileInfo(entry.name, entry.is_dir(),
+                    created=_to_datetime(created) if created is not None else None,
+                    modified=_to_datetime(stat.st_mtime),
+                    size=stat.st_size,
+                    is_link=entry.is_symlink())
+
+    def open(self, path, mode='rb', **kwargs):
+        try:
+            return io.open(self.get_sys_path(path), mode, **kwargs)
+        except (FileNotFoundError, NotADirectoryError):
+            raise FileNotFoundError('File {} not found'.format(path))
+
+    def get_fs_url(self):
+        return self.fs_url
+
+    def can_reopen(self):
+        return True
+
+
+def _to_datetime(timestamp):
+    """Convert an epoch timestamp to a UTC datetime, like PyFilesystem"""
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
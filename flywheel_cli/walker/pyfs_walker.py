@@ -7,7 +7,7 @@ from .abstract_walker import AbstractWalker, FileInfo
 class PyFsWalker(AbstractWalker):
     """Walker that is implemented in terms of PyFs"""
     def __init__(self, fs_url, ignore_dot_files=True, follow_symlinks=False, filter=None, exclude=None,
-            filter_dirs=None, exclude_dirs=None, src_fs=None):
+            filter_dirs=None, exclude_dirs=None, list_threads=1, src_fs=None):
         """Initialize the abstract walker
 
         Args:
@@ -18,13 +18,15 @@ class PyFsWalker(AbstractWalker):
             exclude (list): An optional list of filename patterns to EXCLUDE
             filter_dirs (list): An optional list of directories to INCLUDE
             exclude_dirs (list): An optional list of patterns of directories to EXCLUDE
+            list_threads (int): The number of directories to list concurrently
             src_fs (fs): The fs instance or None
         """
         super(PyFsWalker, self).__init__('/', ignore_dot_files=ignore_dot_files,
                 follow_symlinks=follow_symlinks, filter=filter, exclude=exclude,
-                filter_dirs=filter_dirs, exclude_dirs=exclude_dirs)
+                filter_dirs=filter_dirs, exclude_dirs=exclude_dirs, list_threads=list_threads)
 
         self.fs_url = fs_url
+        self._owns_fs = src_fs is None
         self.src_fs = src_fs or fs.open_fs(fs_url)
 
     def _listdir(self, path):
@@ -52,3 +54,7 @@ class PyFsWalker(AbstractWalker):
 
     def get_fs_url(self):
         return self.fs_url
+
+    def can_reopen(self):
+        # In-memory filesystems and explicitly provided filesystems can't be recreated from the url
+        return self._owns_fs and not self.fs_url.startswith('mem://')
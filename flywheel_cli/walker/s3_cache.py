@@ -0,0 +1,172 @@
+"""Provides a size-bounded local staging cache for S3 objects"""
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DOWNLOAD_THREADS = 4
+
+
+class S3StagingCache(object):
+    """Downloads S3 objects to a local directory, keeping at most max_size bytes on disk.
+
+    Released objects are evicted right away, other objects are evicted least recently used
+    first. Objects that will be needed soon can be prefetched on a small thread pool, as
+    long as there is room in the cache.
+    """
+    def __init__(self, client, bucket, dirname, max_size, download_threads=DEFAULT_DOWNLOAD_THREADS):
+        """Initialize the cache
+
+        Arguments:
+            client (boto3.client): The S3 client
+            bucket (str): The bucket name
+            dirname (str): The directory to stage files in
+            max_size (int): The maximum number of bytes to keep on disk
+            download_threads (int): The number of concurrent prefetch downloads
+        """
+        self.client = client
+        self.bucket = bucket
+        self.dirname = dirname
+        self.max_size = max_size
+        self.download_threads = download_threads
+
+        self.used = 0
+        # Map of key to size of the staged objects, least recently used first
+        self._entries = collections.OrderedDict()
+        # Map of key to Future for downloads in progress
+        self._downloads = {}
+        # Keys to prefetch when there is room
+        self._pending = collections.deque()
+        self._pending_keys = set()
+
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def get_path(self, key):
+        """Get the local path where key is staged"""
+        return os.path.join(self.dirname, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def open(self, key, mode='rb', **kwargs):
+        """Open the staged copy of key, downloading it if necessary
+
+        Arguments:
+            key (str): The object key
+            mode (str): The open mode, either 'r' or 'rb'
+            kwargs: Additional arguments to pass to open (e.g. buffering)
+
+        Returns:
+            file: The opened local copy
+        """
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    # Opened files remain readable after eviction
+                    self._entries.move_to_end(key)
+                    return open(self.get_path(key), mode, **kwargs)
+
+                self._pending_keys.discard(key)
+                future = self._downloads.get(key)
+                download = future is None
+                if download:
+                    future = self._downloads[key] = concurrent.futures.Future()
+
+            if download:
+                self._download(key, future)
+            future.result()
+
+    def prefetch(self, keys):
+        """Download the given keys in the background, when there is room in the cache
+
+        Arguments:
+            keys (list): The object keys that will be read soon
+        """
+        with self._lock:
+            for key in keys:
+                if key in self._entries or key in self._downloads or key in self._pending_keys:
+                    continue
+                self._pending.append(key)
+                self._pending_keys.add(key)
+            self._start_prefetch()
+
+    def release(self, keys):
+        """Evict the given keys, which will not be read again
+
+        Arguments:
+            keys (list): The object keys that are no longer needed
+        """
+        with self._lock:
+            for key in keys:
+                self._pending_keys.discard(key)
+                if key in self._entries:
+                    self._remove(key)
+            self._start_prefetch()
+
+    def close(self):
+        """Stop prefetching, and wait for downloads in progress"""
+        with self._lock:
+            self._pending.clear()
+            self._pending_keys.clear()
+            executor = self._executor
+            self._executor = None
+
+        if executor is not None:
+            executor.shutdown()
+
+    def _start_prefetch(self):
+        """Start pending prefetch downloads while there is room (called with the lock held)"""
+        while self._pending and len(self._downloads) < self.download_threads and self.used < self.max_size:
+            key = self._pending.popleft()
+            if key not in self._pending_keys:
+                continue
+            self._pending_keys.discard(key)
+
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.download_threads)
+
+            future = self._downloads[key] = concurrent.futures.Future()
+            self._executor.submit(self._download, key, future)
+
+    def _download(self, key, future):
+        """Download key to the cache directory, completing future"""
+        path = self.get_path(key)
+        tmp_path = path + '.part'
+        try:
+            self.client.download_file(self.bucket, key, tmp_path)
+            os.rename(tmp_path, path)
+            size = os.path.getsize(path)
+        except Exception as exc:  # pylint: disable=broad-except
+            log.debug('Could not stage s3://%s/%s', self.bucket, key, exc_info=True)
+            with self._lock:
+                del self._downloads[key]
+                self._start_prefetch()
+            future.set_exception(exc)
+            return
+
+        with self._lock:
+            del self._downloads[key]
+            self._entries[key] = size
+            self.used += size
+            self._evict(keep=key)
+            self._start_prefetch()
+        future.set_result(path)
+
+    def _evict(self, keep):
+        """Evict least recently used entries until the cache fits (called with the lock held)"""
+        for key in list(self._entries):
+            if self.used <= self.max_size:
+                break
+            if key != keep:
+                self._remove(key)
+
+    def _remove(self, key):
+        """Remove a staged object (called with the lock held)"""
+        size = self._entries.pop(key)
+        self.used -= size
+        try:
+            os.remove(self.get_path(key))
+        except OSError:
+            log.debug('Could not remove staged file for %s', key, exc_info=True)
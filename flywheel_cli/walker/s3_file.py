@@ -0,0 +1,155 @@
+"""Provides a seekable, read-only file object backed by S3 ranged GET requests"""
+import io
+import re
+
+from botocore.exceptions import ClientError
+
+MIN_READ_AHEAD = 64 * 1024 # Start by reading 64kb, enough for most dicom headers
+MAX_READ_AHEAD = 8 * (2 ** 20) # Grow read ahead on sequential reads, up to 8mb
+
+CONTENT_RANGE_RE = re.compile(r'bytes \d+-\d+/(\d+)')
+
+
+class S3RangeFile(io.RawIOBase):
+    """File object that reads an S3 object with ranged GETs.
+
+    Data is read ahead in blocks that double in size while reads are sequential,
+    so reading a header only fetches the first block, while reading a whole object
+    takes few requests.
+    """
+    def __init__(self, client, bucket, key, name=None):
+        """Open the object, fetching the first block
+
+        Arguments:
+            client (boto3.client): The S3 client
+            bucket (str): The bucket name
+            key (str): The object key
+            name (str): The name to report for the file
+        """
+        super(S3RangeFile, self).__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.name = name or key
+
+        self._pos = 0
+        self._size = None
+        self._buffer = b''
+        self._buffer_offset = 0
+        self._read_ahead = MIN_READ_AHEAD
+        self.request_count = 0
+
+        self._fetch(0, MIN_READ_AHEAD)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    @property
+    def size(self):
+        """The size of the object, in bytes"""
+        return self._size
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError('Invalid whence ({})'.format(whence))
+
+        if pos < 0:
+            raise ValueError('Negative seek position {}'.format(pos))
+
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        data = self._read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.readall()
+        return self._read(size)
+
+    def readall(self):
+        return self._read(max(0, self._size - self._pos))
+
+    def _read(self, size):
+        """Read up to size bytes from the current position"""
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+
+        size = min(size, max(0, self._size - self._pos))
+        if size <= 0:
+            return b''
+
+        buffer_end = self._buffer_offset + len(self._buffer)
+        if not (self._buffer_offset <= self._pos and self._pos + size <= buffer_end):
+            # Grow the read ahead while reads continue where the last block ended
+            if self._pos == buffer_end:
+                self._read_ahead = min(2 * self._read_ahead, MAX_READ_AHEAD)
+            else:
+                self._read_ahead = MIN_READ_AHEAD
+
+            # Keep the part of the buffer that is still ahead of the position
+            if self._buffer_offset <= self._pos < buffer_end:
+                head = self._buffer[self._pos - self._buffer_offset:]
+            else:
+                head = b''
+
+            start = self._pos + len(head)
+            self._fetch(start, max(size - len(head), self._read_ahead))
+            self._buffer = head + self._buffer
+            self._buffer_offset = self._pos
+
+        offset = self._pos - self._buffer_offset
+        data = self._buffer[offset:offset+size]
+        self._pos += len(data)
+        return data
+
+    def _fetch(self, start, size):
+        """Fetch size bytes starting at start into the buffer"""
+        self._buffer = b''
+        self._buffer_offset = start
+
+        if self._size is not None:
+            size = min(size, self._size - start)
+            if size <= 0:
+                return
+
+        self.request_count += 1
+        try:
+            resp = self.client.get_object(Bucket=self.bucket, Key=self.key,
+                Range='bytes={}-{}'.format(start, start + size - 1))
+        except ClientError as exc:
+            code = exc.response.get('Error', {}).get('Code')
+            if code in ('NoSuchKey', '404'):
+                raise FileNotFoundError('File {} not found'.format(self.name))
+            if code == 'InvalidRange' and start == 0:
+                # Empty objects cannot satisfy any range
+                self._size = 0
+                return
+            raise
+
+        if self._size is None:
+            match = CONTENT_RANGE_RE.match(resp.get('ContentRange', ''))
+            if match:
+                self._size = int(match.group(1))
+            else:
+                self._size = resp['ContentLength']
+
+        body = resp['Body']
+        try:
+            self._buffer = body.read()
+        finally:
+            body.close()
@@ -1,19 +1,23 @@
-import os
+import collections
+import io
 import shutil
 import tempfile
+import threading
 from urllib.parse import urlparse
 
 import boto3
-import fs
+from botocore.exceptions import ClientError
 
 from .abstract_walker import AbstractWalker, FileInfo
+from .s3_cache import S3StagingCache
+from .s3_file import S3RangeFile
 
 
 class S3Walker(AbstractWalker):
     """Walker that is implemented in terms of S3"""
     """By default, use '/' for S3 list objects path delimiter"""
     def __init__(self, fs_url, ignore_dot_files=True, follow_symlinks=False, filter=None, exclude=None,
-                 filter_dirs=None, exclude_dirs=None):
+                 filter_dirs=None, exclude_dirs=None, list_threads=1, flat_listing=False, cache_size=0):
         """Initialize the abstract walker
 
         Args:
@@ -24,6 +28,10 @@ class S3Walker(AbstractWalker):
             exclude (list): An optional list of filename patterns to EXCLUDE
             filter_dirs (list): An optional list of directories to INCLUDE
             exclude_dirs (list): An optional list of patterns of directories to EXCLUDE
+            list_threads (int): The number of directories to list concurrently
+            flat_listing (bool): Whether to list the whole tree with one recursive listing on the first walk
+            cache_size (int): If set, stage objects in a local cache of up to this many bytes,
+                instead of reading them with ranged requests
         """
         schema, bucket, path, *_ = urlparse(fs_url)
 
@@ -31,44 +39,100 @@ class S3Walker(AbstractWalker):
 
         super(S3Walker, self).__init__(sanitized_path, ignore_dot_files=ignore_dot_files,
                                        follow_symlinks=follow_symlinks, filter=filter, exclude=exclude,
-                                       filter_dirs=filter_dirs, exclude_dirs=exclude_dirs)
+                                       filter_dirs=filter_dirs, exclude_dirs=exclude_dirs, list_threads=list_threads)
         self.bucket = bucket
         self.client = boto3.client('s3')
         self.fs_url = fs_url
         self.tmp_dir_path = tempfile.mkdtemp()
 
+        self.flat_listing = flat_listing
+        # The prefix covered by the directory index, and the index of prefix to listing
+        self._index_prefix = None
+        self._index = None
+        self._index_lock = threading.Lock()
+
+        self.cache_size = cache_size
+        self._cache = None
+        if cache_size:
+            self._cache = S3StagingCache(self.client, self.bucket, self.tmp_dir_path, cache_size)
+
     def get_fs_url(self):
         return self.fs_url
 
+    def get_options(self):
+        options = super(S3Walker, self).get_options()
+        options['flat_listing'] = self.flat_listing
+        options['cache_size'] = self.cache_size
+        return options
+
+    def walk(self, subdir=None, max_depth=None):
+        if self.flat_listing:
+            if subdir:
+                walk_root = self.combine(self.root, subdir)
+            else:
+                walk_root = self.root
+            self._build_index(walk_root)
+
+        for result in super(S3Walker, self).walk(subdir=subdir, max_depth=max_depth):
+            yield result
+
+    def can_reopen(self):
+        return True
+
     def close(self):
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
         if self.tmp_dir_path is not None:
             shutil.rmtree(self.tmp_dir_path)
             self.tmp_dir_path = None
 
-    def open(self, path, mode='rb', **kwargs):
-        file_path = os.path.join(self.tmp_dir_path, self.root.lstrip('/'), path.lstrip('/'))
+    def prefetch(self, paths):
+        if self._cache is not None:
+            self._cache.prefetch([self._get_key(path) for path in paths])
 
-        if not os.path.isfile(file_path):
-            prefix_dir = '' if path.count('/') == 1 else path.rsplit('/', 1)[0]
-            file_dir = os.path.join(self.tmp_dir_path, self.root.lstrip('/'), prefix_dir.lstrip('/'))
-            os.makedirs(file_dir, exist_ok=True)
+    def release(self, paths):
+        if self._cache is not None:
+            self._cache.release([self._get_key(path) for path in paths])
 
-            prefix_path = (self.root + path).lstrip('/')
+    def _get_key(self, path):
+        """Get the object key for path"""
+        return self.combine(self.root, path).lstrip('/')
 
-            self.client.download_file(self.bucket, prefix_path, file_path)
+    def open(self, path, mode='rb', **kwargs):
+        """Open the object at path.
 
-        try:
-            return open(file_path, mode, **kwargs)
-        except fs.errors.ResourceNotFound:
-            raise FileNotFoundError('File {} not found'.format(path))
+        Objects are staged in the local cache if one is configured, otherwise they are read
+        with ranged GET requests, so that only the parts that are read are fetched from S3.
+        """
+        key = self._get_key(path)
+        if self._cache is not None:
+            try:
+                return self._cache.open(key, mode, **kwargs)
+            except ClientError as exc:
+                if exc.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                    raise FileNotFoundError('File {} not found'.format(path))
+                raise
+
+        fileobj = S3RangeFile(self.client, self.bucket, key, name=path)
+        if 'b' in mode:
+            return fileobj
+
+        text_kwargs = {key: kwargs[key] for key in ('encoding', 'errors', 'newline') if key in kwargs}
+        return io.TextIOWrapper(io.BufferedReader(fileobj), **text_kwargs)
 
     def _listdir(self, path):
-        if path == '/' or path == '':
-            prefix_path = ''
-        elif path.endswith('/'):
-            prefix_path = path.lstrip('/')
-        else:
-            prefix_path = path.lstrip('/') + '/'
+        prefix_path = self._get_list_prefix(path)
+
+        index = self._get_index(prefix_path)
+        if index is not None:
+            listing = index.get(prefix_path)
+            if listing is not None:
+                for dir_info in listing[0].values():
+                    yield dir_info
+                for file_info in listing[1]:
+                    yield file_info
+            return
 
         paginator = self.client.get_paginator('list_objects')
         page_iterator = paginator.paginate(Bucket=self.bucket, Prefix=prefix_path, Delimiter='/')
@@ -87,3 +151,82 @@ class S3Walker(AbstractWalker):
                     last_modified = content['LastModified']
                     size = content['Size']
                     yield FileInfo(file_name, False, modified=last_modified, size=size)
+
+    @staticmethod
+    def _get_list_prefix(path):
+        """Get the key prefix for listing the given directory"""
+        if path == '/' or path == '':
+            return ''
+        if path.endswith('/'):
+            return path.lstrip('/')
+        return path.lstrip('/') + '/'
+
+    def _get_index(self, prefix_path):
+        """Get the directory index, if it covers prefix_path"""
+        if self._index is not None and prefix_path.startswith(self._index_prefix):
+            return self._index
+        return None
+
+    def _build_index(self, walk_root):
+        """List every key under walk_root with a single recursive listing, and index them by directory.
+
+        Entries that the walk filters would skip are left out of the index. Walks of
+        any directory below walk_root are then answered from the index.
+
+        Args:
+            walk_root (str): The path of the directory being walked
+        """
+        prefix_path = self._get_list_prefix(walk_root)
+
+        with self._index_lock:
+            if self._get_index(prefix_path) is not None:
+                return
+
+            # Map of prefix to (OrderedDict of directory name to FileInfo, list of file FileInfo)
+            index = {}
+            dir_included = {}
+
+            def get_listing(prefix):
+                listing = index.get(prefix)
+                if listing is None:
+                    listing = index[prefix] = (collections.OrderedDict(), [])
+                return listing
+            get_listing(prefix_path)
+
+            def include_dir(walk_path, name):
+                included = dir_included.get(walk_path)
+                if included is None:
+                    included = self._should_include_dir(self.get_prefix_path(walk_path), FileInfo(name, True))
+                    dir_included[walk_path] = included
+                return included
+
+            paginator = self.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix_path):
+                for content in page.get('Contents', []):
+                    parts = content['Key'][len(prefix_path):].split('/')
+                    file_name = parts.pop()
+
+                    # Add each parent directory to its parent's listing
+                    parent_prefix = prefix_path
+                    walk_path = walk_root
+                    included = True
+                    for part in parts:
+                        walk_path = self.combine(walk_path, part)
+                        if not include_dir(walk_path, part):
+                            included = False
+                            break
+                        subdirs = get_listing(parent_prefix)[0]
+                        if part not in subdirs:
+                            subdirs[part] = FileInfo(part, True)
+                        parent_prefix = parent_prefix + part + '/'
+
+                    # Directory placeholder keys have no file name
+                    if not included or not file_name:
+                        continue
+
+                    file_info = FileInfo(file_name, False, modified=content['LastModified'], size=content['Size'])
+                    if self._should_include_file(file_info):
+                        get_listing(parent_prefix)[1].append(file_info)
+
+            self._index = index
+            self._index_prefix = prefix_path
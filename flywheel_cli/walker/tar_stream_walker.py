@@ -0,0 +1,249 @@
+"""Walker that reads a (possibly compressed) tar archive in a single sequential pass"""
+import datetime
+import io
+import itertools
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import weakref
+
+import fs.errors
+import fs.opener
+import fs.path
+
+from .abstract_walker import AbstractWalker, FileInfo
+from .archive_index import ArchiveIndex, normpath
+
+log = logging.getLogger(__name__)
+
+
+class TarStreamWalker(AbstractWalker):
+    """Walker for tar archives that only reads the archive sequentially.
+
+    Random access to members of compressed tar files restarts decompression for every
+    backwards seek. Instead, on first use the member headers are read in order and indexed
+    by directory, without writing any file data, so listing the archive needs no scratch space.
+
+    File data is staged to a temporary directory by a second sequential pass, which only
+    advances as far as the member being opened. Members that are passed before they are
+    opened are staged along the way, and staged copies are removed as soon as they are
+    released. Opening a member that was already passed restarts the pass. If the archive
+    can't be read again (a non-seekable fileobj), all members are staged by the first pass.
+
+    As with tarfile extraction, only the last of several members with the same name is kept.
+    """
+    def __init__(self, fs_url, ignore_dot_files=True, follow_symlinks=False, filter=None, exclude=None,
+            filter_dirs=None, exclude_dirs=None, list_threads=1, fileobj=None, tmp_dir=None):
+        """Initialize the tar walker
+
+        Args:
+            fs_url (str): The tar:// url of the archive, or its path when fileobj is given
+            ignore_dot_files (bool): Whether or not to ignore files starting with '.'
+            follow_symlinks(bool): Whether or not to follow symlinks
+            filter (list): An optional list of filename patterns to INCLUDE
+            exclude (list): An optional list of filename patterns to EXCLUDE
+            filter_dirs (list): An optional list of directories to INCLUDE
+            exclude_dirs (list): An optional list of patterns of directories to EXCLUDE
+            list_threads (int): The number of directories to list concurrently
+            fileobj (file): The opened archive, instead of opening it from fs_url
+            tmp_dir (str): The directory to stage file data in, instead of the system temp directory
+        """
+        super(TarStreamWalker, self).__init__('/', ignore_dot_files=ignore_dot_files,
+                follow_symlinks=follow_symlinks, filter=filter, exclude=exclude,
+                filter_dirs=filter_dirs, exclude_dirs=exclude_dirs, list_threads=list_threads)
+
+        self.fs_url = fs_url
+        self._fileobj = fileobj
+
+        self._index = None
+        # Map of file path to the position of its (last) member in the archive
+        self._positions = {}
+        # Map of file path to staged file path
+        self._staged = {}
+        self._staged_names = itertools.count()
+        # Files that were released, and don't need to be staged by the current pass
+        self._released = set()
+        # The current data pass: the open archive, its member iterator and the next position
+        self._archive = None
+        self._members = None
+        self._position = 0
+        self._lock = threading.RLock()
+
+        self.tmp_dir_path = tempfile.mkdtemp(dir=tmp_dir)
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.tmp_dir_path, ignore_errors=True)
+
+    def get_fs_url(self):
+        return self.fs_url
+
+    def close(self):
+        with self._lock:
+            self._end_pass()
+            self._cleanup()
+            if self._fileobj is not None:
+                self._fileobj.close()
+                self._fileobj = None
+
+    def walk(self, subdir=None, max_depth=None):
+        self._read_index()
+        for result in super(TarStreamWalker, self).walk(subdir=subdir, max_depth=max_depth):
+            yield result
+
+    def _listdir(self, path):
+        self._read_index()
+
+        return self._index.listdir(path)
+
+    def open(self, path, mode='rb', **kwargs):
+        self._read_index()
+
+        path = normpath(path)
+        with self._lock:
+            self._released.discard(path)
+            staged_path = self._staged.get(path)
+            if staged_path is None and path in self._positions:
+                staged_path = self._stage_until(path)
+        if staged_path is None:
+            raise FileNotFoundError('File {} not found'.format(path))
+        return io.open(staged_path, mode, **kwargs)
+
+    def release(self, paths):
+        with self._lock:
+            for path in paths:
+                path = normpath(path)
+                self._released.add(path)
+                staged_path = self._staged.pop(path, None)
+                if staged_path is not None:
+                    try:
+                        os.remove(staged_path)
+                    except OSError:
+                        log.debug('Could not remove staged file %s', staged_path, exc_info=True)
+
+    def _can_reread(self):
+        """Check if the archive can be read again, for the data pass"""
+        if self._fileobj is None:
+            return True
+        try:
+            return self._fileobj.seekable()
+        except (AttributeError, ValueError):
+            return False
+
+    def _open_archive(self):
+        """Open the archive for a sequential pass from the start"""
+        if self._fileobj is None:
+            return tarfile.open(fs.opener.parse(self.fs_url).resource, mode='r|*')
+        if self._index is not None:
+            self._fileobj.seek(0)
+        return tarfile.open(fileobj=self._fileobj, mode='r|*')
+
+    def _iter_files(self, archive):
+        """Iterate over the regular file members of archive
+
+        Returns:
+            generator: (position, path, TarInfo) tuples
+        """
+        for position, member in enumerate(archive):
+            try:
+                path = normpath(member.name)
+            except fs.errors.IllegalBackReference:
+                log.debug('Skipping tar member %s outside of the archive', member.name)
+                continue
+            if not path:
+                continue
+
+            if member.isdir():
+                yield position, path, member
+                continue
+
+            if not member.isfile():
+                # Links can't be resolved without seeking back in the archive
+                log.debug('Skipping tar member %s of type %s', member.name, member.type)
+                continue
+
+            yield position, path, member
+
+    def _read_index(self):
+        """Read the member headers in a single pass, indexing them by directory"""
+        if self._index is not None:
+            return
+
+        with self._lock:
+            if self._index is not None:
+                return
+
+            # Without a second pass, file data has to be staged while reading the headers
+            stage = not self._can_reread()
+
+            index = ArchiveIndex()
+            with self._open_archive() as archive:
+                for position, path, member in self._iter_files(archive):
+                    if member.isdir():
+                        index.add_dir(path)
+                        continue
+
+                    # Later members with the same name replace earlier ones
+                    self._positions[path] = position
+                    if stage:
+                        self._stage(archive, path, member)
+
+                    modified = datetime.datetime.fromtimestamp(member.mtime, datetime.timezone.utc)
+                    index.add_file(path, FileInfo(fs.path.basename(path), False, modified=modified,
+                        size=member.size))
+
+            self._index = index
+
+    def _stage(self, archive, path, member):
+        """Copy the data of member to the staging directory (called with the lock held)
+
+        Returns:
+            str: The staged file path
+        """
+        replaced_path = self._staged.pop(path, None)
+        if replaced_path is not None:
+            os.remove(replaced_path)
+
+        staged_path = os.path.join(self.tmp_dir_path, str(next(self._staged_names)))
+        with archive.extractfile(member) as src, open(staged_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        self._staged[path] = staged_path
+        return staged_path
+
+    def _stage_until(self, path):
+        """Advance the data pass until path is staged (called with the lock held)
+
+        Returns:
+            str: The staged file path, or None if it was staged by the first pass and released
+        """
+        target = self._positions[path]
+        if self._archive is not None and self._position > target:
+            self._end_pass()
+        if self._archive is None:
+            if not self._can_reread():
+                return None
+            self._archive = self._open_archive()
+            self._members = self._iter_files(self._archive)
+            self._position = 0
+
+        for position, member_path, member in self._members:
+            self._position = position + 1
+            if self._positions.get(member_path) != position:
+                # Directories, and members that are replaced by a later one
+                continue
+
+            if member_path == path:
+                return self._stage(self._archive, member_path, member)
+            if member_path not in self._staged and member_path not in self._released:
+                self._stage(self._archive, member_path, member)
+
+        self._end_pass()
+        return None
+
+    def _end_pass(self):
+        """Close the current data pass (called with the lock held)"""
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+            self._members = None
+            self._position = 0
@@ -0,0 +1,132 @@
+"""Walker for zip archives that can also provide the compressed data of members"""
+import datetime
+import io
+import struct
+import zipfile
+
+import fs.opener
+import fs.path
+
+from .abstract_walker import AbstractWalker, FileInfo
+from .archive_index import ArchiveIndex, normpath
+
+
+class ZipWalker(AbstractWalker):
+    """Walker for zip archives, implemented directly on zipfile.ZipFile"""
+    def __init__(self, fs_url, ignore_dot_files=True, follow_symlinks=False, filter=None, exclude=None,
+            filter_dirs=None, exclude_dirs=None, list_threads=1, fileobj=None):
+        """Initialize the zip walker
+
+        Args:
+            fs_url (str): The zip:// url of the archive, or its path when fileobj is given
+            ignore_dot_files (bool): Whether or not to ignore files starting with '.'
+            follow_symlinks(bool): Whether or not to follow symlinks
+            filter (list): An optional list of filename patterns to INCLUDE
+            exclude (list): An optional list of filename patterns to EXCLUDE
+            filter_dirs (list): An optional list of directories to INCLUDE
+            exclude_dirs (list): An optional list of patterns of directories to EXCLUDE
+            list_threads (int): The number of directories to list concurrently
+            fileobj (file): The opened (seekable) archive, instead of opening it from fs_url
+        """
+        super(ZipWalker, self).__init__('/', ignore_dot_files=ignore_dot_files,
+                follow_symlinks=follow_symlinks, filter=filter, exclude=exclude,
+                filter_dirs=filter_dirs, exclude_dirs=exclude_dirs, list_threads=list_threads)
+
+        self.fs_url = fs_url
+        if fileobj is None:
+            fileobj = open(fs.opener.parse(fs_url).resource, 'rb')
+        self._fileobj = fileobj
+        self._zipfile = zipfile.ZipFile(fileobj)
+
+        # Map of file path to ZipInfo
+        self._members = {}
+        self._index = ArchiveIndex()
+        for info in self._zipfile.infolist():
+            path = normpath(info.filename)
+            if not path:
+                continue
+            if info.filename.endswith('/'):
+                self._index.add_dir(path)
+                continue
+
+            self._members[path] = info
+            modified = datetime.datetime(*info.date_time, tzinfo=datetime.timezone.utc)
+            self._index.add_file(path, FileInfo(fs.path.basename(path), False, modified=modified,
+                size=info.file_size))
+
+    def get_fs_url(self):
+        return self.fs_url
+
+    def close(self):
+        self._zipfile.close()
+        self._fileobj.close()
+
+    def _listdir(self, path):
+        return self._index.listdir(path)
+
+    def _get_member(self, path):
+        info = self._members.get(normpath(path))
+        if info is None:
+            raise FileNotFoundError('File {} not found'.format(path))
+        return info
+
+    def open(self, path, mode='rb', **kwargs):
+        fileobj = self._zipfile.open(self._get_member(path))
+        if 'b' in mode:
+            return fileobj
+
+        text_kwargs = {key: kwargs[key] for key in ('encoding', 'errors', 'newline') if key in kwargs}
+        return io.TextIOWrapper(fileobj, **text_kwargs)
+
+    def can_open_compressed(self):
+        return True
+
+    def open_compressed(self, path):
+        info = self._get_member(path)
+
+        # Encrypted members can't be repacked as-is
+        if info.flag_bits & 0x1:
+            return None, None
+
+        # Read the local header to find where the compressed data starts
+        with self._zipfile._lock:  # pylint: disable=protected-access
+            self._fileobj.seek(info.header_offset)
+            header = self._fileobj.read(zipfile.sizeFileHeader)
+
+        if len(header) != zipfile.sizeFileHeader:
+            raise zipfile.BadZipFile('Truncated file header for {}'.format(path))
+        header = struct.unpack(zipfile.structFileHeader, header)
+        if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:  # pylint: disable=protected-access
+            raise zipfile.BadZipFile('Bad magic number for file header of {}'.format(path))
+
+        offset = (info.header_offset + zipfile.sizeFileHeader
+            + header[zipfile._FH_FILENAME_LENGTH]  # pylint: disable=protected-access
+            + header[zipfile._FH_EXTRA_FIELD_LENGTH])  # pylint: disable=protected-access
+        return info, _MemberDataFile(self._zipfile, self._fileobj, offset, info.compress_size)
+
+
+class _MemberDataFile(io.RawIOBase):
+    """Reads a byte range of the archive, sharing the file position with zipfile"""
+    def __init__(self, zip_file, fileobj, offset, size):
+        super(_MemberDataFile, self).__init__()
+        self._zipfile = zip_file
+        self._fileobj = fileobj
+        self._pos = offset
+        self._end = offset + size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = min(len(b), self._end - self._pos)
+        if size <= 0:
+            return 0
+
+        # zipfile seeks before every read, under the same lock
+        with self._zipfile._lock:  # pylint: disable=protected-access
+            self._fileobj.seek(self._pos)
+            data = self._fileobj.read(size)
+
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
@@ -0,0 +1,44 @@
+"""Micro-benchmark for walker filename filtering.
+
+Compares the compiled PatternMatcher against one fnmatch call per pattern.
+
+Run with: python -m tests.benchmarks.bench_filters
+"""
+import fnmatch
+import timeit
+
+from flywheel_cli.walker.filters import PatternMatcher
+
+PATTERNS = ['*.dcm', '*.DCM', '*.IMA', '*.nii', '*.nii.gz', '*.par', '*.rec', '*.json',
+    '*.txt', 'Thumbs.db', '.*', 'scan_??.*']
+
+NAMES = ['MR.1.2.840.{}.dcm'.format(i) for i in range(500)] + \
+    ['image{}.png'.format(i) for i in range(300)] + \
+    ['scan_{:02d}.raw'.format(i) for i in range(100)] + \
+    ['notes{}.csv'.format(i) for i in range(100)]
+
+
+def fnmatch_filter(names, patterns):
+    return [name for name in names if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+
+
+def compiled_filter(names, matcher):
+    return [name for name in names if matcher.match(name)]
+
+
+def main(number=50):
+    matcher = PatternMatcher(PATTERNS)
+    assert fnmatch_filter(NAMES, PATTERNS) == compiled_filter(NAMES, matcher)
+
+    fnmatch_time = timeit.timeit(lambda: fnmatch_filter(NAMES, PATTERNS), number=number)
+    compiled_time = timeit.timeit(lambda: compiled_filter(NAMES, matcher), number=number)
+
+    count = number * len(NAMES)
+    print('{} names x {} patterns'.format(len(NAMES), len(PATTERNS)))
+    print('fnmatch:  {:.2f} us/name'.format(1e6 * fnmatch_time / count))
+    print('compiled: {:.2f} us/name'.format(1e6 * compiled_time / count))
+    print('speedup:  {:.1f}x'.format(fnmatch_time / compiled_time))
+
+
+if __name__ == '__main__':
+    main()
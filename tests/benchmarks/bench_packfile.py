@@ -0,0 +1,78 @@
+"""Benchmark for building packfiles from a large series.
+
+Compares the zipfile-based StreamingZipWriter used by create_zip_packfile against
+building the same packfile through PyFilesystem's ZipFS, as packfiles were built before.
+
+Run with: python -m tests.benchmarks.bench_packfile [member_count]
+"""
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+import fs.path
+from fs.zipfs import ZipFS
+
+from flywheel_cli.importers.packfile import create_zip_packfile, get_packfile_paths
+from flywheel_cli.walker import create_walker
+
+MEMBER_SIZE = 4096
+
+
+def create_series(dirname, member_count):
+    """Create a series of small, partially compressible files"""
+    series_dir = os.path.join(dirname, 'series')
+    os.makedirs(series_dir)
+    for i in range(member_count):
+        with open(os.path.join(series_dir, 'MR.{}.dcm'.format(i)), 'wb') as f:
+            f.write(os.urandom(MEMBER_SIZE // 2) + b'\0' * (MEMBER_SIZE // 2))
+
+
+def zipfs_packfile(dst_file, walker, paths):
+    """Build a packfile the way create_packfile did with a ZipFS destination"""
+    total_bytes = 0
+    with ZipFS(dst_file, write=True, compression=zipfile.ZIP_DEFLATED) as dst_fs:
+        for path in paths:
+            dst_fs.makedirs(fs.path.dirname(path), recreate=True)
+            with walker.open(path, 'rb') as src_file:
+                dst_fs.upload(path, src_file)
+            total_bytes += dst_fs.getsize(path)
+    return total_bytes
+
+
+def writer_packfile(dst_file, walker, paths):
+    progress = []
+    create_zip_packfile(dst_file, walker, paths=paths, progress_callback=progress.append)
+    return progress[-1]
+
+
+def run(fn, walker, paths, number):
+    """Build number packfiles with fn, returning the packfiles per second"""
+    start = time.perf_counter()
+    for _ in range(number):
+        with tempfile.TemporaryFile() as dst_file:
+            assert fn(dst_file, walker, paths) == len(paths) * MEMBER_SIZE
+            dst_file.seek(0)
+            with zipfile.ZipFile(dst_file) as zf:
+                assert len(zf.namelist()) == len(paths) + 1
+    return number / (time.perf_counter() - start)
+
+
+def main(member_count=10000, number=3):
+    with tempfile.TemporaryDirectory() as dirname:
+        create_series(dirname, member_count)
+        walker = create_walker('osfs://{}'.format(dirname))
+        paths = get_packfile_paths(walker)
+
+        zipfs_rate = run(zipfs_packfile, walker, paths, number)
+        writer_rate = run(writer_packfile, walker, paths, number)
+
+    print('{} members of {} bytes per packfile'.format(member_count, MEMBER_SIZE))
+    print('ZipFS:              {:.2f} packfiles/s ({:.0f} members/s)'.format(zipfs_rate, zipfs_rate * member_count))
+    print('StreamingZipWriter: {:.2f} packfiles/s ({:.0f} members/s)'.format(writer_rate, writer_rate * member_count))
+    print('speedup:            {:.1f}x'.format(writer_rate / zipfs_rate))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,122 @@
+import io
+import os
+import pickle
+import zipfile
+import zlib
+
+import pydicom
+import pydicom.encaps
+import pytest
+
+from flywheel_cli.importers.compression_policy import CompressionPolicy, get_transfer_syntax
+from flywheel_cli.importers.packfile import create_zip_packfile, ParallelCompressor
+from flywheel_cli.walker import PyFsWalker
+
+
+def make_dicom(transfer_syntax):
+    file_meta = pydicom.dataset.Dataset()
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    file_meta.MediaStorageSOPInstanceUID = '1.2.3.4'
+    file_meta.TransferSyntaxUID = transfer_syntax
+    file_meta.ImplementationClassUID = '1.2.3'
+
+    ds = pydicom.dataset.FileDataset('test.dcm', {}, file_meta=file_meta, preamble=b'\0' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = transfer_syntax == '1.2.840.10008.1.2'
+    ds.PatientName = 'Test'
+    ds.BitsAllocated = 8
+    if pydicom.uid.UID(transfer_syntax).is_compressed:
+        ds.PixelData = pydicom.encaps.encapsulate([os.urandom(4096)])
+    else:
+        ds.PixelData = b'\0' * 4096
+
+    data = io.BytesIO()
+    ds.save_as(data)
+    return data.getvalue()
+
+
+def test_get_transfer_syntax():
+    assert get_transfer_syntax(make_dicom('1.2.840.10008.1.2.4.90')) == '1.2.840.10008.1.2.4.90'
+    assert get_transfer_syntax(make_dicom('1.2.840.10008.1.2')) == '1.2.840.10008.1.2'
+    assert get_transfer_syntax(b'not a dicom file') is None
+    assert get_transfer_syntax(make_dicom('1.2.840.10008.1.2')[:140]) is None
+
+
+@pytest.mark.parametrize('path, head, trial, expected', [
+    ('a/image.nii.gz', b'data', False, zipfile.ZIP_STORED),
+    ('a/IMAGE.JPG', b'data', False, zipfile.ZIP_STORED),
+    ('a/notes.txt', b'data', False, zipfile.ZIP_DEFLATED),
+    ('a/j2k.dcm', make_dicom('1.2.840.10008.1.2.4.90'), False, zipfile.ZIP_STORED),
+    ('a/rle.dcm', make_dicom('1.2.840.10008.1.2.5'), False, zipfile.ZIP_STORED),
+    ('a/raw.dcm', make_dicom('1.2.840.10008.1.2.1'), False, zipfile.ZIP_DEFLATED),
+    ('a/random.bin', os.urandom(8192), False, zipfile.ZIP_DEFLATED),
+    ('a/random.bin', os.urandom(8192), True, zipfile.ZIP_STORED),
+    ('a/small.bin', os.urandom(100), True, zipfile.ZIP_DEFLATED),
+    ('a/zeros.bin', b'\0' * 8192, True, zipfile.ZIP_DEFLATED),
+])
+def test_compression_policy_choose(path, head, trial, expected):
+    assert CompressionPolicy(trial=trial).choose(path, head) == expected
+
+
+def test_compression_policy_stats():
+    policy = CompressionPolicy()
+    policy.add_member(zipfile.ZIP_DEFLATED, 1000, 100)
+    policy.add_member(zipfile.ZIP_STORED, 2000, 2000)
+
+    # Statistics are not pickled with the policy
+    copy = pickle.loads(pickle.dumps(policy))
+    assert copy.stored_count == 0
+    copy.add_member(zipfile.ZIP_STORED, 500, 500)
+    policy.add_stats(copy.get_stats())
+
+    stats = policy.get_stats()
+    assert stats['deflated_count'] == 1
+    assert stats['deflated_saved_bytes'] == 900
+    assert stats['stored_count'] == 2
+    assert stats['stored_bytes'] == 2500
+    assert stats['cpu_seconds_avoided'] > 0
+    assert 'Stored 2 already compressed file(s)' in policy.get_summary()
+
+
+
+def test_compression_policy_measures_throughput_once(monkeypatch):
+    policy = CompressionPolicy()
+    throughput = policy.get_deflate_throughput()
+    assert throughput > 0
+
+    # Later members are estimated from the measured throughput, without deflating anything
+    monkeypatch.setattr(zlib, 'compressobj', None)
+    policy.add_member(zipfile.ZIP_STORED, 1000, 1000)
+    policy.add_member(zipfile.ZIP_STORED, 3000, 3000)
+    assert policy.get_stats()['cpu_seconds_avoided'] == pytest.approx(4000 / throughput)
+
+@pytest.mark.parametrize('threads', [0, 2])
+def test_create_zip_packfile_with_policy(temp_fs, threads):
+    jpeg_dicom = make_dicom('1.2.840.10008.1.2.4.50')
+    tmpfs, tmpfs_url = temp_fs({
+        'acq': [('1.dcm', jpeg_dicom), ('2.dcm', make_dicom('1.2.840.10008.1.2.1')),
+            ('3.nii.gz', b'x' * 1000), ('4.txt', b'y' * 1000)],
+    })
+    walker = PyFsWalker(tmpfs_url, src_fs=tmpfs)
+    policy = CompressionPolicy()
+    compressor = ParallelCompressor(threads) if threads else None
+
+    dst_file = io.BytesIO()
+    try:
+        assert create_zip_packfile(dst_file, walker, packfile_type='dicom', compressor=compressor, policy=policy) == 4
+    finally:
+        if compressor:
+            compressor.shutdown()
+
+    dst_file.seek(0)
+    with zipfile.ZipFile(dst_file) as zf:
+        assert zf.testzip() is None
+        assert zf.getinfo('acq/1.dcm').compress_type == zipfile.ZIP_STORED
+        assert zf.getinfo('acq/2.dcm').compress_type == zipfile.ZIP_DEFLATED
+        assert zf.getinfo('acq/3.nii.gz').compress_type == zipfile.ZIP_STORED
+        assert zf.getinfo('acq/4.txt').compress_type == zipfile.ZIP_DEFLATED
+        assert zf.read('acq/1.dcm') == jpeg_dicom
+
+    stats = policy.get_stats()
+    assert stats['stored_count'] == 2
+    assert stats['deflated_count'] == 2
@@ -0,0 +1,181 @@
+import datetime
+
+import pytest
+
+from flywheel_cli.config import concurrency_argument
+from flywheel_cli.importers.concurrency_controller import AdaptiveConcurrencyController, is_throttle_error
+from flywheel_cli.importers.work_queue import WorkQueue
+from .test_work_queue import MockTask
+
+
+class MockHTTPError(Exception):
+    def __init__(self, status_code):
+        self.response = type('Response', (), {'status_code': status_code})()
+
+
+class MockApiException(Exception):
+    def __init__(self, status):
+        self.status = status
+
+
+class SampleClock(object):
+    def __init__(self):
+        self.now = datetime.datetime(2019, 1, 1)
+
+    def __call__(self, seconds=1):
+        self.now = self.now + datetime.timedelta(seconds=seconds)
+        return self.now
+
+
+def make_saturated_queue(threads=8):
+    queue = WorkQueue({'upload': threads})
+    queue.running = True
+    for _ in range(100):
+        queue.enqueue(MockTask('upload'))
+    return queue
+
+
+def fill_active(queue):
+    while queue.active['upload'] < queue.limits['upload']:
+        queue.take('upload')
+
+
+def sample(controller, queue, clock, rate):
+    queue.stats['upload']['completed_bytes'] += rate
+    fill_active(queue)
+    controller.sample(clock())
+
+
+def test_is_throttle_error():
+    assert is_throttle_error(MockHTTPError(429))
+    assert is_throttle_error(MockHTTPError(503))
+    assert is_throttle_error(MockApiException(429))
+    assert not is_throttle_error(MockHTTPError(500))
+    assert not is_throttle_error(MockApiException(404))
+    assert not is_throttle_error(ValueError('test'))
+
+
+def test_concurrency_argument():
+    assert concurrency_argument('auto') == 'auto'
+    assert concurrency_argument('AUTO') == 'auto'
+    assert concurrency_argument('8') == 8
+
+    with pytest.raises(Exception):
+        concurrency_argument('0')
+
+    with pytest.raises(Exception):
+        concurrency_argument('many')
+
+
+def test_set_concurrency_limits_take():
+    queue = make_saturated_queue(threads=4)
+    assert queue.set_concurrency('upload', 2) == 2
+    assert queue.set_concurrency('upload', 10) == 4
+    assert queue.set_concurrency('upload', 0) == 1
+    assert queue.get_concurrency('upload') == 1
+
+
+def test_controller_grows_while_throughput_improves():
+    clock = SampleClock()
+    queue = make_saturated_queue()
+    controller = AdaptiveConcurrencyController(queue, 'upload', initial_count=1)
+    controller.limit = queue.set_concurrency('upload', controller.limit)
+
+    sample(controller, queue, clock, 0)
+    rate = 100
+    for expected in range(2, 6):
+        sample(controller, queue, clock, rate)
+        assert controller.limit == expected
+        rate = rate * 2
+
+    assert queue.limits['upload'] == 5
+
+
+def test_controller_reverts_step_without_improvement():
+    clock = SampleClock()
+    queue = make_saturated_queue()
+    controller = AdaptiveConcurrencyController(queue, 'upload', initial_count=2, hold_samples=2)
+    controller.limit = queue.set_concurrency('upload', controller.limit)
+
+    sample(controller, queue, clock, 0)
+    sample(controller, queue, clock, 100)
+    assert controller.limit == 3
+
+    # Flat throughput, undo the last step and hold
+    sample(controller, queue, clock, 100)
+    assert controller.limit == 2
+    sample(controller, queue, clock, 100)
+    sample(controller, queue, clock, 100)
+    assert controller.limit == 2
+
+    # Probe again after holding
+    sample(controller, queue, clock, 100)
+    assert controller.limit == 3
+
+
+def test_controller_backs_off_on_throttle():
+    clock = SampleClock()
+    queue = make_saturated_queue()
+    controller = AdaptiveConcurrencyController(queue, 'upload', initial_count=8)
+    controller.limit = queue.set_concurrency('upload', controller.limit)
+
+    sample(controller, queue, clock, 0)
+    controller.record_throttle()
+    sample(controller, queue, clock, 100)
+    assert controller.limit == 4
+    assert queue.limits['upload'] == 4
+
+
+def test_controller_backs_off_on_errors():
+    clock = SampleClock()
+    queue = make_saturated_queue()
+    controller = AdaptiveConcurrencyController(queue, 'upload', initial_count=6, error_threshold=2)
+    controller.limit = queue.set_concurrency('upload', controller.limit)
+
+    sample(controller, queue, clock, 0)
+    queue.stats['upload']['errors'] += 2
+    sample(controller, queue, clock, 100)
+    assert controller.limit == 3
+
+
+def test_controller_does_not_grow_when_idle():
+    clock = SampleClock()
+    queue = WorkQueue({'upload': 8})
+    controller = AdaptiveConcurrencyController(queue, 'upload', initial_count=2)
+    controller.limit = queue.set_concurrency('upload', controller.limit)
+
+    controller.sample(clock())
+    controller.sample(clock())
+    assert controller.limit == 2
+
+
+class StatsOnlyQueue(object):
+    """Queue that only exposes the public interface used by the controller"""
+    def __init__(self, threads):
+        self.groups = {'upload': threads}
+        self.stats = {'completed': 0, 'completed_bytes': 0, 'skipped': 0, 'errors': 0,
+            'active': 0, 'limit': threads, 'waiting': 0}
+
+    def get_stats(self):
+        return {'upload': dict(self.stats)}
+
+    def set_concurrency(self, group, count):
+        self.stats['limit'] = max(1, min(count, self.groups[group]))
+        return self.stats['limit']
+
+
+def test_controller_reads_saturation_from_stats():
+    clock = SampleClock()
+    queue = StatsOnlyQueue(threads=8)
+    controller = AdaptiveConcurrencyController(queue, 'upload', initial_count=2)
+    controller.limit = queue.set_concurrency('upload', controller.limit)
+    controller.sample(clock())
+
+    # Busy workers without waiting jobs are not saturated
+    queue.stats.update(active=2, completed_bytes=100)
+    controller.sample(clock())
+    assert controller.limit == 2
+
+    queue.stats.update(waiting=5, completed_bytes=200)
+    controller.sample(clock())
+    assert controller.limit == 3
@@ -1,5 +1,7 @@
 import copy
+import pytest
 from flywheel_cli.importers.container_factory import ContainerFactory, ContainerResolver
+from flywheel_cli.importers.work_queue import WorkQueue
 
 class MockContainerResolver(ContainerResolver):
     def __init__(self, paths=None):
@@ -218,3 +220,64 @@ def test_get_first_project():
     result = factory.get_first_project()
     assert result is not None
     assert result.label == 'Project1'
+
+def test_parallel_creation():
+    resolver = MockContainerResolver({
+        'scitran': ('scitran', None),
+        'scitran/Project1': ('project1', None)
+    })
+
+    factory = ContainerFactory(resolver)
+    for i in range(4):
+        for j in range(3):
+            factory.resolve({
+                'group': {'_id': 'scitran'},
+                'project': {'label': 'Project1'},
+                'subject': {'label': 'Subject{}'.format(i)},
+                'session': {'label': 'Session{}'.format(i)},
+                'acquisition': {'label': 'Acquisition{}_{}'.format(i, j)}
+            })
+
+    factory.create_containers(max_workers=4)
+
+    # Every container is created after its parent
+    created = [child for _, child in resolver.created_nodes]
+    assert len(created) == 20
+    for parent, child in resolver.created_nodes:
+        assert child.exists
+        assert child.id == 'created_' + child.label.lower()
+        if parent.container_type != 'project':
+            assert created.index(parent) < created.index(child)
+
+def test_creation_error():
+    resolver = MockContainerResolver({'scitran': ('scitran', None)})
+    def create_container(parent, container):
+        raise ValueError('Cannot create')
+    resolver.create_container = create_container
+
+    factory = ContainerFactory(resolver)
+    factory.resolve({'group': {'_id': 'scitran'}, 'project': {'label': 'Project1'}})
+
+    with pytest.raises(ValueError):
+        factory.create_containers(max_workers=2)
+
+def test_create_containers_reuses_queue():
+    resolver = MockContainerResolver({'scitran': ('scitran', None)})
+    factory = ContainerFactory(resolver)
+
+    queue = WorkQueue({'create': 2})
+    queue.start()
+    try:
+        factory.resolve({'group': {'_id': 'scitran'}, 'project': {'label': 'Project1'}})
+        factory.create_containers(queue=queue)
+        threads = list(queue._work_threads)
+
+        factory.resolve({'group': {'_id': 'scitran'}, 'project': {'label': 'Project2'}})
+        factory.create_containers(queue=queue)
+
+        # The queue keeps running between calls
+        assert queue.running
+        assert queue._work_threads == threads
+        assert len(resolver.created_nodes) == 2
+    finally:
+        queue.shutdown()
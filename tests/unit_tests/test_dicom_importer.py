@@ -1,11 +1,16 @@
 import copy
+import json
+import os
+import sqlite3
 import pytest
 import pydicom
 from flywheel_migration import DicomFile
 
 from flywheel_cli.importers import DicomScanner
+from flywheel_cli.importers import dicom_scan
 from flywheel_cli.config import Config
-from flywheel_cli.walker import PyFsWalker
+from flywheel_cli.importers.container_factory import ContainerFactory
+from flywheel_cli.walker import PyFsWalker, create_walker
 
 from .test_container_factory import MockContainerResolver
 
@@ -173,3 +178,107 @@ def test_resolve_acquisition_malformed_secondary():
 
     assert dicom_scanner.sessions['1'].acquisitions['1'] == acquisition
 
+
+
+def test_read_headers_in_processes(temp_fs, dicom_data, monkeypatch):
+    dicom_dir = os.path.join('tests', 'data', 'DICOM', '16844_1_1_dicoms')
+    files = [(name, dicom_data('16844_1_1_dicoms', name)) for name in sorted(os.listdir(dicom_dir))]
+    _, tmpfs_url = temp_fs({'dicom': files + [('notes.txt', b'Not a DICOM')]})
+    monkeypatch.setattr(dicom_scan, 'SCAN_CHUNK_SIZE', 2)
+    tags = [pydicom.tag.Tag(pydicom.datadict.tag_for_keyword(keyword)) for keyword in dicom_scan.DICOM_TAGS]
+
+    def scan(scan_processes):
+        config = Config()
+        config.scan_processes = scan_processes
+        config.cpu_count = 2
+        dicom_scanner = DicomScanner(config)
+        walker = create_walker(tmpfs_url)
+        paths = list(walker.files())
+        assert (dicom_scanner.get_scan_process_count(walker) > 0) == scan_processes
+
+        results = list(dicom_scanner.read_headers(walker, paths, tags))
+        assert [path for path, _, _ in results] == paths
+        return [(path, dcm and dcm.get('SOPInstanceUID'), dcm and dcm.get_manufacturer(), dcm and dcm.acq_no,
+            type(exc)) for path, dcm, exc in results]
+
+    serial = scan(False)
+    assert scan(True) == serial
+    assert ('dicom/notes.txt', None, None, None, dicom_scan.DicomFileError) in serial
+    assert len([result for result in serial if result[1]]) == 3
+    assert all(result[3] for result in serial if result[1])
+
+
+def test_create_scan_error():
+    error = dicom_scan.create_scan_error(('DicomFileError', 'Not a DICOM'))
+    assert isinstance(error, dicom_scan.DicomFileError)
+    assert str(error) == 'Not a DICOM'
+
+    error = dicom_scan.create_scan_error(('PermissionError', 'Access denied'))
+    assert not isinstance(error, dicom_scan.DicomFileError)
+    assert str(error) == 'PermissionError: Access denied'
+
+
+def test_scan_headers_uses_cache(temp_fs, dicom_data, tmpdir, monkeypatch):
+    dicom_dir = os.path.join('tests', 'data', 'DICOM', '16844_1_1_dicoms')
+    files = [(name, dicom_data('16844_1_1_dicoms', name)) for name in sorted(os.listdir(dicom_dir))]
+    tmpfs, tmpfs_url = temp_fs({'dicom': files + [('notes.txt', b'Not a DICOM')]})
+    tags = [pydicom.tag.Tag(pydicom.datadict.tag_for_keyword(keyword)) for keyword in dicom_scan.DICOM_TAGS]
+
+    read_paths = []
+    read_dicom_header = dicom_scan.read_dicom_header
+    def counting_read(walker, path, *args, **kwargs):
+        read_paths.append(path)
+        return read_dicom_header(walker, path, *args, **kwargs)
+    monkeypatch.setattr(dicom_scan, 'read_dicom_header', counting_read)
+
+    def scan():
+        config = Config()
+        config.header_cache = True
+        config.header_cache_path = str(tmpdir.join('cache', 'headers.db'))
+        walker = create_walker(tmpfs_url)
+        results = DicomScanner(config).scan_headers(walker, list(walker.file_infos()), tags)
+        return [(path, dcm and dcm.get('SOPInstanceUID'), type(exc)) for path, dcm, exc in results]
+
+    first = scan()
+    assert len(read_paths) == 4
+
+    # Unchanged files are not read again
+    del read_paths[:]
+    assert scan() == first
+    assert read_paths == []
+
+    # Modified files are
+    with tmpfs.open('dicom/notes.txt', 'wb') as f:
+        f.write(b'Still not a DICOM')
+    assert scan() == first
+    assert read_paths == ['dicom/notes.txt']
+
+    # Headers are stored as JSON, unreadable entries are read again
+    db = sqlite3.connect(str(tmpdir.join('cache', 'headers.db')))
+    rows = db.execute('SELECT path, headers FROM scan_headers WHERE headers IS NOT NULL').fetchall()
+    assert len(rows) == 3
+    assert all(isinstance(json.loads(headers), dict) for _, headers in rows)
+    db.execute('UPDATE scan_headers SET headers=? WHERE path=?', ('not json', rows[0][0]))
+    db.commit()
+    db.close()
+
+    del read_paths[:]
+    assert scan() == first
+    assert read_paths == [rows[0][0]]
+
+
+def test_discover_calls_checkpoint(temp_fs, dicom_data):
+    dicom_dir = os.path.join('tests', 'data', 'DICOM', '16844_1_1_dicoms')
+    files = [(name, dicom_data('16844_1_1_dicoms', name)) for name in sorted(os.listdir(dicom_dir))]
+    _, tmpfs_url = temp_fs({'dicom': files})
+
+    checkpoints = []
+    dicom_scanner = DicomScanner(Config())
+    dicom_scanner.checkpoint = lambda: checkpoints.append(len(dicom_scanner.sessions))
+
+    resolver = MockContainerResolver({'scitran': ('scitran', None)})
+    context = {'group': {'_id': 'scitran'}, 'project': {'label': 'Project1'}}
+    dicom_scanner.discover(create_walker(tmpfs_url), context, ContainerFactory(resolver))
+
+    # Called once for every scanned file
+    assert len(checkpoints) == len(files)
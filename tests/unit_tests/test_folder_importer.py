@@ -307,3 +307,39 @@ def test_nested_packfiles():
     except StopIteration:
         pass
 
+
+def test_pipelined_import(temp_fs, monkeypatch, tmpdir):
+    from flywheel_cli.folder_impl import FSWrapper
+    from flywheel_cli.importers import abstract_importer, upload_queue
+
+    _, src_url = temp_fs(collections.OrderedDict([
+        ('subject1/session1/acq1', ['a.txt', 'b.txt']),
+        ('subject1/session1/acq1/dicom', ['1.dcm', '2.dcm']),
+        ('subject2/session2/acq2', ['c.txt']),
+    ]))
+
+    # Queue discovered files after every folder
+    monkeypatch.setattr(abstract_importer, 'PIPELINE_FLUSH_INTERVAL', 0)
+    add_counts = []
+    monkeypatch.setattr(upload_queue.UploadQueue, 'add_counts',
+        lambda self, upload_count=0, packfile_count=0: add_counts.append((upload_count, packfile_count)))
+
+    output_dir = str(tmpdir.join('output'))
+    config = make_config(FSWrapper(output_dir), args={'yes': True, 'pipeline': True, 'no_audit_log': True,
+        'jobs': 1, 'concurrent_uploads': 2, 'compression_level': 1})
+    importer = FolderImporter(group='group', project='project', config=config)
+    importer.add_template_node(StringMatchNode('subject'))
+    importer.add_template_node(StringMatchNode('session'))
+    importer.add_template_node(StringMatchNode('acquisition'))
+
+    importer.interactive_import(src_url[len('osfs://'):])
+
+    # Files were queued in several steps, with each packfile queued once its folder was complete
+    assert len(add_counts) > 1
+    assert sum(count for count, _ in add_counts) == 3
+    assert sum(count for _, count in add_counts) == 1
+
+    output = fs.open_fs('osfs://' + output_dir)
+    assert output.exists('group/project/subject1/session1/acq1/a.txt')
+    assert output.exists('group/project/subject1/session1/acq1/acq1.dicom.zip')
+    assert output.exists('group/project/subject2/session2/acq2/c.txt')
@@ -0,0 +1,149 @@
+import collections
+import tempfile
+import threading
+
+from unittest import mock
+
+from flywheel_cli.importers.memory_budget import BudgetedSpooledFile, MemoryBudget, SPOOL_RESERVE_SIZE
+from flywheel_cli.importers.upload_queue import UploadTask
+from flywheel_cli.walker import PyFsWalker
+from .test_upload_queue import make_packfile_task
+
+
+def test_memory_budget_acquire_release():
+    budget = MemoryBudget(100)
+
+    assert budget.acquire(60) == 60
+    assert not budget.try_acquire(50)
+    assert budget.try_acquire(40)
+    assert budget.used == 100
+
+    budget.release(60)
+    assert budget.used == 40
+
+    # Oversized requests are clamped to the whole budget
+    budget.release(40)
+    assert budget.acquire(1000) == 100
+    budget.release(100)
+    assert budget.used == 0
+
+
+def test_memory_budget_acquire_blocks():
+    budget = MemoryBudget(100)
+    budget.acquire(80)
+
+    acquired = threading.Event()
+    def acquire():
+        budget.acquire(50)
+        acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not acquired.wait(0.1)
+
+    budget.release(80)
+    assert acquired.wait(5)
+    thread.join()
+    assert budget.used == 50
+
+
+def test_upload_task_streams_when_budget_exhausted():
+    budget = MemoryBudget(10)
+    budget.acquire(10)
+
+    fileobj = tempfile.TemporaryFile()
+    fileobj.write(b'12345')
+
+    uploader = mock.MagicMock()
+    task = UploadTask(uploader, mock.MagicMock(), mock.MagicMock(), 'test.txt',
+        fileobj=fileobj, memory_budget=budget)
+    task.execute()
+
+    # The file object is passed through rather than read into memory
+    uploader.upload.assert_called_once()
+    assert uploader.upload.call_args[0][2] is task.fileobj
+    assert budget.used == 10
+
+
+def test_packfile_reservation_released_after_upload(temp_fs):
+    tmpfs, tmpfs_url = temp_fs(collections.OrderedDict({
+        'acq/dicom': ['001.dcm', '002.dcm'],
+    }))
+
+    budget = MemoryBudget(1024 * 1024)
+    task = make_packfile_task(PyFsWalker(tmpfs_url, src_fs=tmpfs), subdir='/acq/dicom',
+        max_spool=64 * 1024, memory_budget=budget)
+
+    next_task, _ = task.execute()
+
+    # The in-memory packfile is held until upload
+    tmpfile = next_task.fileobj.fileobj
+    assert not tmpfile.rolled
+    assert 0 < tmpfile.reserved_bytes <= 64 * 1024
+    assert budget.used == tmpfile.reserved_bytes
+
+    next_task.execute()
+    assert budget.used == 0
+    assert next_task._data is None
+
+
+def test_upload_task_release_memory_on_error(temp_fs):
+    tmpfs, tmpfs_url = temp_fs({'acq/dicom': ['001.dcm']})
+
+    budget = MemoryBudget(1024 * 1024)
+    task = make_packfile_task(PyFsWalker(tmpfs_url, src_fs=tmpfs), subdir='/acq/dicom',
+        max_spool=64 * 1024, memory_budget=budget)
+    next_task, _ = task.execute()
+
+    next_task.uploader.upload.side_effect = IOError('upload failed')
+    try:
+        next_task.execute()
+    except IOError:
+        next_task.release_memory()
+
+    # Memory is released and the packfile moved to disk for the retry
+    assert budget.used == 0
+    assert next_task.fileobj.fileobj.rolled
+
+
+def test_budgeted_spooled_file_reserves_incrementally():
+    budget = MemoryBudget(3 * SPOOL_RESERVE_SIZE)
+    tmpfile = BudgetedSpooledFile(budget, 2 * SPOOL_RESERVE_SIZE)
+    assert budget.used == 0
+
+    tmpfile.write(b'x' * 10)
+    assert budget.used == SPOOL_RESERVE_SIZE
+    tmpfile.write(b'x' * SPOOL_RESERVE_SIZE)
+    assert budget.used == 2 * SPOOL_RESERVE_SIZE
+    assert not tmpfile.rolled
+
+    # Writing past max_size moves the data to disk
+    tmpfile.write(b'x' * SPOOL_RESERVE_SIZE)
+    assert tmpfile.rolled
+    assert budget.used == 0
+
+    tmpfile.seek(0)
+    assert len(tmpfile.read()) == 2 * SPOOL_RESERVE_SIZE + 10
+    tmpfile.close()
+
+
+def test_budgeted_spooled_file_rolls_over_when_budget_exhausted():
+    budget = MemoryBudget(SPOOL_RESERVE_SIZE)
+    assert budget.try_acquire(SPOOL_RESERVE_SIZE // 2)
+
+    tmpfile = BudgetedSpooledFile(budget, 4 * SPOOL_RESERVE_SIZE)
+    tmpfile.write(b'data')
+    assert tmpfile.rolled
+    assert budget.used == SPOOL_RESERVE_SIZE // 2
+
+    tmpfile.seek(0)
+    assert tmpfile.read() == b'data'
+    tmpfile.close()
+
+
+def test_budgeted_spooled_file_close_releases():
+    budget = MemoryBudget(4 * SPOOL_RESERVE_SIZE)
+    with BudgetedSpooledFile(budget, 4 * SPOOL_RESERVE_SIZE) as tmpfile:
+        tmpfile.write(b'data')
+        assert budget.used == SPOOL_RESERVE_SIZE
+    assert budget.used == 0
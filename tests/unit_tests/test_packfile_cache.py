@@ -0,0 +1,100 @@
+import datetime
+import io
+import os
+import time
+import zipfile
+
+from unittest import mock
+
+from flywheel_cli.importers import packfile
+from flywheel_cli.importers.container_factory import ContainerNode
+from flywheel_cli.importers.packfile_cache import PackfileCache
+from flywheel_cli.importers.upload_queue import PackfileTask, UploadTask
+from flywheel_cli.walker import FileInfo, OsWalker
+
+
+def make_members(*sizes, modified=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)):
+    return [('acq/{}.dcm'.format(i), FileInfo('{}.dcm'.format(i), False, modified=modified, size=size))
+        for i, size in enumerate(sizes)]
+
+
+def get_key(members, **kwargs):
+    options = {'fs_url': 'osfs:///data', 'packfile_type': 'dicom', 'deid_profile': None,
+        'compression': zipfile.ZIP_DEFLATED, 'compression_level': 1, 'policy': None}
+    options.update(kwargs)
+    return PackfileCache.get_key(members=members, **options)
+
+
+def test_packfile_cache_key():
+    key = get_key(make_members(10, 20))
+
+    assert key == get_key(list(reversed(make_members(10, 20))))
+    assert key != get_key(make_members(10, 21))
+    assert key != get_key(make_members(10, 20, modified=datetime.datetime(2020, 1, 2, tzinfo=datetime.timezone.utc)))
+    assert key != get_key(make_members(10, 20), compression_level=5)
+    assert key != get_key(make_members(10, 20), packfile_type='zip')
+    assert key != get_key(make_members(10, 20), fs_url='osfs:///other')
+
+    deid_profile = mock.MagicMock()
+    deid_profile.to_config.return_value = {'name': 'minimal'}
+    assert key != get_key(make_members(10, 20), deid_profile=deid_profile)
+
+    # Unknown file info can't be cached
+    assert get_key(make_members(10) + [('acq/missing.dcm', None)]) is None
+    assert get_key([('acq/1.dcm', FileInfo('1.dcm', False, size=10))]) is None
+
+
+def test_packfile_cache_put_open_evict(tmpdir):
+    cache = PackfileCache(str(tmpdir.join('cache')), max_size=25)
+    assert cache.open('a') is None
+
+    cache.put('a', io.BytesIO(b'a' * 10))
+    cache.put('b', io.BytesIO(b'b' * 10))
+    # Use a, so b is evicted first
+    os.utime(cache.get_path('b'), (time.time() - 60, time.time() - 60))
+    with cache.open('a') as f:
+        assert f.read() == b'a' * 10
+
+    cache.put('c', io.BytesIO(b'c' * 10))
+    assert cache.open('b') is None
+    assert cache.open('c') is not None
+
+    # Packfiles larger than the cache are not added
+    cache.put('d', io.BytesIO(b'd' * 30))
+    assert cache.open('d') is None
+    assert sorted(os.listdir(cache.dirname)) == [os.path.basename(cache.get_path(key)) for key in 'ac']
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_packfile_task_uses_cache(tmpdir, monkeypatch):
+    tmpdir.join('acq', '001.dcm').write('001', ensure=True)
+    tmpdir.join('acq', '002.dcm').write('002', ensure=True)
+    cache = PackfileCache(str(tmpdir.join('cache')), max_size=1024 * 1024)
+    create_zip_packfile = mock.MagicMock(side_effect=packfile.create_zip_packfile)
+    monkeypatch.setattr('flywheel_cli.importers.upload_queue.create_zip_packfile', create_zip_packfile)
+
+    def run(expected=b'002', **kwargs):
+        walker = OsWalker('osfs://{}'.format(tmpdir.join('acq')))
+        container = ContainerNode('acquisition', cid='acq_id', label='acq')
+        task = PackfileTask(mock.MagicMock(), mock.MagicMock(), walker, 'dicom', None,
+            container, 'acq.dicom.zip', packfile_cache=cache, **kwargs)
+        next_task, _ = task.execute()
+        assert isinstance(next_task, UploadTask)
+        assert next_task.metadata['zip_member_count'] == 2
+        with zipfile.ZipFile(next_task.fileobj.fileobj) as zf:
+            assert zf.read('002.dcm') == expected
+        next_task.fileobj.fileobj.close()
+
+    run(paths=['001.dcm', '002.dcm'])
+    assert create_zip_packfile.call_count == 1
+
+    # Same members as a subdir packfile, or a streamed packfile
+    run()
+    run(paths=['001.dcm', '002.dcm'], stream_queue=mock.MagicMock())
+    assert create_zip_packfile.call_count == 1
+    assert cache.hits == 2
+
+    # Changed files are packed again
+    tmpdir.join('acq', '002.dcm').write('0002')
+    run(expected=b'0002', paths=['001.dcm', '002.dcm'])
+    assert create_zip_packfile.call_count == 2
@@ -0,0 +1,173 @@
+import threading
+
+from unittest import mock
+
+import pytest
+
+from flywheel_cli.importers.container_factory import ContainerNode
+from flywheel_cli import sdk_impl
+from flywheel_cli.sdk_impl import SdkUploadWrapper
+
+
+def make_wrapper(files_by_id):
+    fw = mock.MagicMock()
+    fw.get.side_effect = lambda cid: {'files': [{'name': name} for name in files_by_id[cid]]}
+    fw.get_config.return_value = {'features': {'signed_url': False}}
+    return SdkUploadWrapper(fw)
+
+
+def test_file_exists_fetches_once_per_container():
+    uploader = make_wrapper({'acq1': ['a.dcm', 'b.dcm']})
+    container = ContainerNode('acquisition', cid='acq1', exists=True)
+
+    assert uploader.file_exists(container, 'a.dcm')
+    assert uploader.file_exists(container, 'b.dcm')
+    assert not uploader.file_exists(container, 'c.dcm')
+    uploader.fw.get.assert_called_once_with('acq1')
+
+
+def test_prefetch_files():
+    files_by_id = {'acq{}'.format(i): ['{}.dcm'.format(i)] for i in range(20)}
+    uploader = make_wrapper(files_by_id)
+    containers = [ContainerNode('acquisition', cid=cid, exists=True) for cid in files_by_id]
+
+    uploader.prefetch_files(containers)
+    assert uploader.fw.get.call_count == 20
+
+    assert uploader.file_exists(containers[3], '3.dcm')
+    assert not uploader.file_exists(containers[3], '4.dcm')
+
+    # Already cached containers are not fetched again
+    uploader.prefetch_files(containers)
+    assert uploader.fw.get.call_count == 20
+
+
+def test_file_names_updated_on_create_and_upload():
+    uploader = make_wrapper({})
+    uploader.fw.add_acquisition.return_value = 'acq2'
+
+    container = ContainerNode('acquisition', label='acq2')
+    container.context = {'acquisition': {'label': 'acq2'}}
+    container.id = uploader.create_container(ContainerNode('session', cid='ses1'), container)
+
+    assert not uploader.file_exists(container, 'a.dcm')
+    uploader.upload(container, 'a.dcm', b'data')
+    assert uploader.file_exists(container, 'a.dcm')
+
+    # New containers never need to be fetched
+    uploader.fw.get.assert_not_called()
+
+
+def test_upload_batch_uses_one_ticket():
+    uploader = make_wrapper({'acq1': []})
+    uploader.fw.api_client.call_api.return_value = {
+        'ticket': 'ticket1',
+        'urls': {'a.txt': 'http://a', 'b.txt': 'http://b'}
+    }
+    uploader._upload_session = mock.MagicMock()
+    container = ContainerNode('acquisition', cid='acq1', exists=True)
+    assert not uploader.file_exists(container, 'b.txt')
+
+    uploader.upload_batch(container, [('a.txt', b'a'), ('b.txt', b'b')])
+
+    # Create and complete ticket
+    assert uploader.fw.api_client.call_api.call_count == 2
+    body = uploader.fw.api_client.call_api.call_args_list[0][1]['body']
+    assert body['filenames'] == ['a.txt', 'b.txt']
+
+    puts = sorted(call[0][0] for call in uploader._upload_session.put.call_args_list)
+    assert puts == ['http://a', 'http://b']
+    assert uploader.file_exists(container, 'b.txt')
+
+
+def test_upload_batch_puts_concurrently():
+    uploader = make_wrapper({'acq1': []})
+    names = ['{}.txt'.format(i) for i in range(6)]
+    uploader.fw.api_client.call_api.return_value = {
+        'ticket': 'ticket1',
+        'urls': {name: 'http://' + name for name in names}
+    }
+
+    lock = threading.Lock()
+    started = [0]
+    active = [0]
+    max_active = [0]
+    all_started = threading.Barrier(3, timeout=5)
+
+    def put(url, data=None):
+        with lock:
+            started[0] += 1
+            first_round = started[0] <= 3
+            active[0] += 1
+            max_active[0] = max(max_active[0], active[0])
+        try:
+            # The first PUTs only finish once max_workers of them run at once
+            if first_round:
+                all_started.wait()
+        finally:
+            with lock:
+                active[0] -= 1
+        return mock.MagicMock()
+
+    uploader._upload_session = mock.MagicMock()
+    uploader._upload_session.put.side_effect = put
+    container = ContainerNode('acquisition', cid='acq1', exists=True)
+
+    uploader.upload_batch(container, [(name, b'x') for name in names], max_workers=3)
+
+    assert uploader._upload_session.put.call_count == 6
+    assert max_active[0] == 3
+    # The ticket is completed once, after all uploads
+    assert uploader.fw.api_client.call_api.call_count == 2
+
+
+class MockContainer(dict):
+    def __init__(self, cid, label, uid=None):
+        super(MockContainer, self).__init__(uid=uid)
+        self.id = cid
+        self.label = label
+
+
+def test_bulk_resolve_lists_children_once(monkeypatch):
+    monkeypatch.setattr(sdk_impl, 'RESOLVE_PAGE_SIZE', 2)
+
+    fw = mock.MagicMock()
+    subjects = [MockContainer('sub{}'.format(i), 'subject{}'.format(i)) for i in range(5)]
+    def get_project_subjects(project_id, limit=None, after_id=None):
+        start = 0
+        if after_id:
+            start = [s.id for s in subjects].index(after_id) + 1
+        return subjects[start:start+limit]
+    fw.get_project_subjects.side_effect = get_project_subjects
+    fw.get_subject_sessions.return_value = [MockContainer('ses1', 'session1', uid='1.2.3')]
+
+    uploader = SdkUploadWrapper(fw, bulk_resolve=True, resolve_threads=2)
+    assert uploader.resolve_path('subject', 'group/<id:proj>/subject3') == ('sub3', None)
+    assert uploader.resolve_path('subject', 'group/<id:proj>/subject4') == ('sub4', None)
+    assert uploader.resolve_path('subject', 'group/<id:proj>/missing') == (None, None)
+    assert fw.get_project_subjects.call_count == 3
+
+    assert uploader.resolve_path('session', 'group/<id:proj>/<id:sub3>/session1') == ('ses1', '1.2.3')
+    # Sessions of resolved subjects are listed in the background
+    uploader._child_indexes['sub4'].result()
+    assert sorted(call[0][0] for call in fw.get_subject_sessions.call_args_list) == ['sub3', 'sub4']
+    fw.resolve.assert_not_called()
+
+    # The listing threads are sized by the uploader, and stopped when the import finishes
+    executor = uploader._resolve_executor
+    assert executor._max_workers == 2
+    uploader.close()
+    assert uploader._resolve_executor is None
+    with pytest.raises(RuntimeError):
+        executor.submit(lambda: None)
+
+
+def test_bulk_resolve_falls_back_to_resolve():
+    fw = mock.MagicMock()
+    fw.resolve.return_value.path = [MockContainer('grp', 'grp')]
+
+    uploader = SdkUploadWrapper(fw, bulk_resolve=True)
+    assert uploader.resolve_path('group', 'grp') == ('grp', None)
+    # Parent that was not resolved by id
+    uploader.resolve_path('session', 'group/project/subject/session1')
+    assert fw.resolve.call_count == 2
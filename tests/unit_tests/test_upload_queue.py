@@ -0,0 +1,535 @@
+import collections
+import io
+import os
+import threading
+import struct
+import zipfile
+
+from unittest import mock
+
+import pytest
+
+from flywheel_cli import util
+from flywheel_cli.importers.container_factory import ContainerNode
+from flywheel_cli.importers.packfile import create_zip_packfile, get_packfile_paths, ParallelCompressor, StreamingZipWriter
+from flywheel_cli.importers.stream_pipe import BoundedPipe, PipeClosedError, PipeTimeoutError
+from flywheel_cli.importers import upload_queue
+from flywheel_cli.importers.upload_queue import (PackfileTask, UploadTask, DeleteOnCloseFile, StreamingUploadTask,
+    UploadBatchTask, UploadFileWrapper, UploadQueue)
+from flywheel_cli.walker import create_walker, PyFsWalker, ZipWalker
+
+
+@pytest.fixture(scope='module')
+def process_pool():
+    pool = util.create_process_pool(2)
+    yield pool
+    pool.shutdown()
+
+
+def make_packfile_task(walker, **kwargs):
+    container = ContainerNode('acquisition', cid='acq_id', label='acq')
+    return PackfileTask(mock.MagicMock(), mock.MagicMock(), walker, 'dicom', None,
+        container, 'acq.dicom.zip', **kwargs)
+
+
+def read_zip_members(fileobj):
+    with zipfile.ZipFile(fileobj) as zf:
+        return sorted(name for name in zf.namelist() if not name.endswith('/'))
+
+
+def test_packfile_task_thread(temp_fs):
+    tmpfs, tmpfs_url = temp_fs(collections.OrderedDict({
+        'acq/dicom': ['001.dcm', '002.dcm'],
+    }))
+
+    task = make_packfile_task(PyFsWalker(tmpfs_url, src_fs=tmpfs), subdir='/acq/dicom', max_spool=1024)
+    assert not task.use_process_pool()
+
+    next_task, priority = task.execute()
+    assert isinstance(next_task, UploadTask)
+    assert priority == 5
+    assert next_task.metadata['zip_member_count'] == 2
+    assert next_task.fileobj.name == '/acq/dicom'
+    assert task.get_bytes_processed() == 22
+
+    assert read_zip_members(next_task.fileobj.fileobj) == ['acq/dicom/001.dcm', 'acq/dicom/002.dcm']
+
+
+def test_packfile_task_process_pool(temp_fs, process_pool):
+    _, tmpfs_url = temp_fs(collections.OrderedDict({
+        'acq/dicom': ['001.dcm', '002.dcm', '.hidden'],
+    }))
+
+    walker = create_walker(tmpfs_url)
+    task = make_packfile_task(walker, subdir='/acq/dicom', process_pool=process_pool, compression_level=1)
+    assert task.use_process_pool()
+
+    next_task, _ = task.execute()
+    assert next_task.metadata['zip_member_count'] == 2
+    assert task.get_bytes_processed() == 22
+
+    fileobj = next_task.fileobj.fileobj
+    assert isinstance(fileobj, DeleteOnCloseFile)
+    # The audit log reports the packfile source, not the temporary file
+    assert next_task.fileobj.name == '/acq/dicom'
+    assert fileobj.name != '/acq/dicom'
+    assert read_zip_members(fileobj) == ['acq/dicom/001.dcm', 'acq/dicom/002.dcm']
+
+    # The temporary file is removed when the upload closes it
+    path = fileobj.name
+    assert os.path.isfile(path)
+    next_task.fileobj.close()
+    assert not os.path.exists(path)
+
+
+def test_packfile_task_process_pool_requires_reopen(temp_fs, process_pool):
+    tmpfs, tmpfs_url = temp_fs({'acq/dicom': ['001.dcm']})
+
+    task = make_packfile_task(PyFsWalker(tmpfs_url, src_fs=tmpfs), subdir='/acq/dicom', process_pool=process_pool)
+    assert not task.use_process_pool()
+
+    task = make_packfile_task(create_walker(tmpfs_url), subdir='/acq/dicom', process_pool=process_pool)
+    assert task.use_process_pool()
+
+    task.deid_profile = mock.MagicMock(log=mock.MagicMock(), map_subjects=None)
+    assert not task.use_process_pool()
+
+
+def test_upload_file_wrapper_name(tmpdir):
+    path = str(tmpdir.join('upload.dat'))
+    with open(path, 'wb') as fileobj:
+        assert UploadFileWrapper(fileobj=fileobj).name == path
+        assert UploadFileWrapper(fileobj=fileobj, path='/acq/dicom').name == '/acq/dicom'
+    assert UploadFileWrapper(walker=mock.MagicMock(), path='/acq/001.dcm').name == '/acq/001.dcm'
+
+
+def test_walker_get_options_round_trip():
+    walker = create_walker('osfs://{}'.format(os.getcwd()), filter=['*.dcm'], exclude_dirs=['tmp'],
+        filter_dirs=['a/b'])
+
+    options = walker.get_options()
+    assert options['filter'] == ['*.dcm']
+    assert options['exclude_dirs'] == ['tmp']
+    assert options['filter_dirs'] == ['a/b']
+    assert options['ignore_dot_files']
+
+    copy = create_walker(walker.get_fs_url(), **options)
+    assert repr(copy) == repr(walker)
+
+
+class StreamQueue(object):
+    """Queue that runs enqueued tasks on a separate thread, like an upload worker"""
+    def __init__(self):
+        self.tasks = []
+        self.threads = []
+
+    def enqueue(self, task, priority=10):
+        def run():
+            try:
+                task.execute()
+            except Exception as ex:
+                task.error = ex
+        self.tasks.append(task)
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.threads.append(thread)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+
+def test_packfile_task_streaming(temp_fs):
+    tmpfs, tmpfs_url = temp_fs(collections.OrderedDict({
+        'acq/dicom': ['001.dcm', '002.dcm'],
+    }))
+
+    received = {}
+    def upload_stream(container, name, fileobj, metadata=None):
+        received['metadata'] = metadata
+        received['data'] = b''.join(iter(lambda: fileobj.read(7), b''))
+
+    queue = StreamQueue()
+    task = make_packfile_task(PyFsWalker(tmpfs_url, src_fs=tmpfs), subdir='/acq/dicom', stream_queue=queue)
+    task.uploader.upload_stream.side_effect = upload_stream
+
+    assert task.execute() == (None, None)
+    queue.join()
+
+    upload_task, = queue.tasks
+    assert isinstance(upload_task, StreamingUploadTask)
+    assert upload_task.get_bytes_processed() == len(received['data'])
+    assert received['metadata'] == {'name': 'acq.dicom.zip', 'zip_member_count': 2}
+    assert read_zip_members(io.BytesIO(received['data'])) == ['acq/dicom/001.dcm', 'acq/dicom/002.dcm']
+
+
+def test_packfile_task_streaming_upload_error(temp_fs):
+    tmpfs, tmpfs_url = temp_fs({'acq/dicom': ['001.dcm']})
+
+    def upload_stream(container, name, fileobj, metadata=None):
+        fileobj.read(1)
+        raise IOError('upload failed')
+
+    queue = StreamQueue()
+    task = make_packfile_task(PyFsWalker(tmpfs_url, src_fs=tmpfs), subdir='/acq/dicom', stream_queue=queue)
+    task.uploader.upload_stream.side_effect = upload_stream
+
+    # The packfile task fails with the upload, so that it will be retried
+    with pytest.raises(IOError):
+        task.execute()
+    queue.join()
+    assert isinstance(queue.tasks[0].error, IOError)
+
+
+def test_bounded_pipe_blocks_writer():
+    pipe = BoundedPipe(max_size=4)
+    pipe.write(b'abc')
+
+    written = threading.Event()
+    def write():
+        pipe.write(b'def')
+        written.set()
+        pipe.close()
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    assert not written.wait(0.1)
+
+    assert pipe.read(2) == b'ab'
+    assert pipe.read() == b'cdef'
+    assert pipe.read() == b''
+    thread.join()
+
+
+def test_bounded_pipe_errors():
+    pipe = BoundedPipe()
+    pipe.abort(ValueError('failed'))
+    with pytest.raises(IOError):
+        pipe.read()
+
+    pipe = BoundedPipe()
+    pipe.close_reader(ValueError('failed'))
+    with pytest.raises(PipeClosedError):
+        pipe.write(b'data')
+    assert isinstance(pipe.wait_for_reader(), ValueError)
+
+
+def test_bounded_pipe_timeout():
+    pipe = BoundedPipe(max_size=4, timeout=0.05)
+    pipe.write(b'abc')
+
+    # Neither the writer nor the producer can wait forever for a reader that never comes
+    with pytest.raises(PipeTimeoutError):
+        pipe.write(b'def')
+    pipe.close()
+    with pytest.raises(PipeTimeoutError):
+        pipe.wait_for_reader()
+
+
+def test_upload_queue_streaming_upload_threads():
+    config = mock.MagicMock(skip_existing_files=False, stream_packfiles=True, memory_budget=0, cpu_count=6,
+        packfile_processes=False, adaptive_uploads=False, compress_threads=1, packfile_cache_size=0)
+    config.get_uploader.return_value.supports_signed_url.return_value = False
+    config.get_uploader.return_value.supports_streaming.return_value = True
+    config.get_compression_policy.return_value = None
+
+    # Each packing thread needs an upload thread to read its pipe
+    queue = UploadQueue(config, mock.MagicMock(), show_progress=False)
+    assert queue.stream_packfiles
+    assert queue.limits == {'upload': 6, 'packfile': 6}
+
+    config.stream_packfiles = False
+    queue = UploadQueue(config, mock.MagicMock(), show_progress=False)
+    assert queue.limits == {'upload': 1, 'packfile': 6}
+
+
+def test_upload_queue_shutdown_cancels_streams():
+    config = mock.MagicMock(skip_existing_files=False, stream_packfiles=True, memory_budget=0, cpu_count=2,
+        packfile_processes=False, adaptive_uploads=False, compress_threads=1, packfile_cache_size=0)
+    config.get_uploader.return_value.supports_signed_url.return_value = False
+    config.get_uploader.return_value.supports_streaming.return_value = True
+    config.get_compression_policy.return_value = None
+    queue = UploadQueue(config, mock.MagicMock(), show_progress=False)
+    assert queue.stream_packfiles
+
+    # The streaming upload is queued, but never taken by a worker
+    pipe = BoundedPipe(max_size=4)
+    queue.enqueue(StreamingUploadTask(queue.uploader, queue.audit_log, ContainerNode('acquisition', cid='acq1'),
+        'acq.dicom.zip', pipe))
+
+    errors = []
+    def write():
+        try:
+            pipe.write(b'abc')
+            pipe.write(b'def')
+        except PipeClosedError as ex:
+            errors.append(ex)
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    queue.shutdown()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert len(errors) == 1
+
+
+def test_streaming_zip_writer_seeking_member():
+    pipe = BoundedPipe()
+    dst_fs = StreamingZipWriter(pipe)
+
+    # Members opened for writing may seek, like pydicom does
+    with dst_fs.open('/a/b/test.dcm', 'wb') as f:
+        f.write(b'xxxx5678')
+        f.seek(0)
+        f.write(b'1234')
+    assert dst_fs.getsize('/a/b/test.dcm') == 8
+
+    dst_fs.close()
+    pipe.close()
+
+    with zipfile.ZipFile(io.BytesIO(pipe.read())) as zf:
+        assert zf.namelist() == ['a/', 'a/b/', 'a/b/test.dcm']
+        assert zf.read('a/b/test.dcm') == b'12345678'
+
+
+def test_streaming_zip_writer_sized_members_skip_zip64():
+    pipe = BoundedPipe()
+    dst_fs = StreamingZipWriter(pipe)
+    dst_fs.upload('/a/sized.dcm', io.BytesIO(b'sized'), size=5)
+    dst_fs.upload('/a/unsized.dcm', io.BytesIO(b'unsized'))
+    dst_fs.close()
+    pipe.close()
+
+    data = pipe.read()
+
+    def local_extra_len(info):
+        # Extra field length of the local file header
+        return struct.unpack('<H', data[info.header_offset + 28:info.header_offset + 30])[0]
+
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.read('a/sized.dcm') == b'sized'
+        assert zf.read('a/unsized.dcm') == b'unsized'
+        assert local_extra_len(zf.getinfo('a/sized.dcm')) == 0
+        assert local_extra_len(zf.getinfo('a/unsized.dcm')) > 0
+
+
+def test_create_zip_packfile_copies_compressed_members(tmpdir):
+    src_path = str(tmpdir.join('src.zip'))
+    with zipfile.ZipFile(src_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('a/one.dcm', b'one' * 100)
+        zf.writestr('a/b/two.dcm', b'two' * 100)
+        zf.writestr('a/stored.dcm', b'stored', compress_type=zipfile.ZIP_STORED)
+
+    walker = ZipWalker(src_path, fileobj=open(src_path, 'rb'))
+    dst_file = io.BytesIO()
+    compressor = zipfile._get_compressor
+    with mock.patch('zipfile._get_compressor', side_effect=compressor) as get_compressor:
+        assert create_zip_packfile(dst_file, walker, packfile_type='dicom') == 3
+    walker.close()
+
+    # Only the directory entries and the stored member went through a compressor
+    assert get_compressor.call_count == 3
+
+    dst_file.seek(0)
+    with zipfile.ZipFile(dst_file) as zf:
+        assert zf.testzip() is None
+        assert zf.read('a/one.dcm') == b'one' * 100
+        assert zf.read('a/b/two.dcm') == b'two' * 100
+        assert zf.read('a/stored.dcm') == b'stored'
+        assert zf.getinfo('a/stored.dcm').compress_type == zipfile.ZIP_DEFLATED
+
+
+@pytest.mark.parametrize('compression', [zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED])
+def test_create_zip_packfile_parallel_compression(temp_fs, monkeypatch, compression):
+    tmpfs, tmpfs_url = temp_fs({
+        'acq': [('{}.dcm'.format(i), str(i).encode() * (i * 100)) for i in range(20)],
+    })
+    # Hold small files in memory only, larger ones are compressed in order
+    monkeypatch.setattr('flywheel_cli.importers.packfile.PARALLEL_MAX_MEMBER_SIZE', 1000)
+    walker = PyFsWalker(tmpfs_url, src_fs=tmpfs)
+    progress = []
+
+    compressor = ParallelCompressor(4)
+    dst_file = io.BytesIO()
+    try:
+        assert create_zip_packfile(dst_file, walker, packfile_type='dicom', compression=compression,
+            compressor=compressor, progress_callback=progress.append) == 20
+    finally:
+        compressor.shutdown()
+
+    dst_file.seek(0)
+    with zipfile.ZipFile(dst_file) as zf:
+        assert zf.testzip() is None
+        names = [name for name in zf.namelist() if not name.endswith('/')]
+        assert names == [path.lstrip('/') for path in get_packfile_paths(walker)]
+        for i in range(20):
+            info = zf.getinfo('acq/{}.dcm'.format(i))
+            assert info.compress_type == compression
+            assert zf.read(info) == str(i).encode() * (i * 100)
+    assert progress[-1] == sum(len(str(i)) * i * 100 for i in range(20))
+
+
+
+def test_parallel_compressor_bounds_memory(temp_fs, monkeypatch):
+    tmpfs, tmpfs_url = temp_fs({
+        'acq': [('{}.dcm'.format(i), str(i).encode() * (i * 100)) for i in range(20)],
+    })
+    monkeypatch.setattr('flywheel_cli.importers.packfile.PARALLEL_MAX_MEMBER_SIZE', 1000)
+    walker = PyFsWalker(tmpfs_url, src_fs=tmpfs)
+
+    compressor = ParallelCompressor(4, window_size=2000)
+    read_paths = []
+    max_used = []
+    read_member = compressor._read_member
+    def recording_read_member(walker, path, *args):
+        read_paths.append(path)
+        max_used.append(compressor._window_budget.used)
+        return read_member(walker, path, *args)
+    compressor._read_member = recording_read_member
+
+    dst_file = io.BytesIO()
+    try:
+        assert create_zip_packfile(dst_file, walker, packfile_type='dicom', compressor=compressor) == 20
+    finally:
+        compressor.shutdown()
+
+    # Members over the limit are not read by the compression threads
+    assert sorted(read_paths) == sorted('/acq/{}.dcm'.format(i) for i in range(20) if len(str(i)) * i * 100 <= 1000)
+    assert max(max_used) <= 2000
+    assert compressor._window_budget.used == 0
+
+    dst_file.seek(0)
+    with zipfile.ZipFile(dst_file) as zf:
+        assert zf.testzip() is None
+        for i in range(20):
+            assert zf.read('acq/{}.dcm'.format(i)) == str(i).encode() * (i * 100)
+
+class RecordingUploader(upload_queue.Uploader):
+    def __init__(self):
+        self.uploads = []
+
+    def upload(self, container, name, fileobj, metadata=None):
+        data = fileobj if isinstance(fileobj, bytes) else fileobj.read()
+        self.uploads.append((name, data, metadata))
+
+    def file_exists(self, container, name):
+        return False
+
+
+def test_uploader_default_batch_and_stream():
+    uploader = RecordingUploader()
+    container = ContainerNode('acquisition', cid='acq_id')
+
+    # Batches are uploaded file by file
+    uploader.upload_batch(container, [('a.txt', b'a'), ('b.txt', b'b')])
+    assert uploader.uploads == [('a.txt', b'a', None), ('b.txt', b'b', None)]
+
+    # Streams are uploaded from a temporary file
+    pipe = BoundedPipe()
+    pipe.write(b'streamed')
+    pipe.close()
+    uploader.upload_stream(container, 'c.zip', pipe, metadata={'name': 'c.zip'})
+    assert uploader.uploads[-1] == ('c.zip', b'streamed', {'name': 'c.zip'})
+
+
+def make_batch_task(tmpfs_url, tmpfs, names):
+    walker = PyFsWalker(tmpfs_url, src_fs=tmpfs)
+    container = ContainerNode('acquisition', cid='acq_id', label='acq')
+    task = UploadBatchTask(mock.MagicMock(), mock.MagicMock(), container, mock.MagicMock())
+    task.upload_queue.get_concurrency.return_value = 4
+    for name in names:
+        task.add_file(name, walker, '/acq/' + name)
+    return task
+
+
+def test_upload_batch_task(temp_fs, monkeypatch):
+    tmpfs, tmpfs_url = temp_fs({
+        'acq': ['a.txt', 'b.txt', ('empty.txt', b''), ('large.txt', b'x' * 64)],
+    })
+    monkeypatch.setattr(upload_queue, 'BATCH_MAX_FILE_SIZE', 32)
+
+    task = make_batch_task(tmpfs_url, tmpfs, ['a.txt', 'b.txt', 'empty.txt', 'large.txt'])
+    assert task.execute() == (None, None)
+    assert task.get_item_count() == 3
+    assert task.get_bytes_processed() == 22
+
+    # Small files share a ticket, larger files are queued as normal uploads
+    task.uploader.upload_batch.assert_called_once_with(task.container,
+        [('a.txt', b'Hello World'), ('b.txt', b'Hello World')], max_workers=4)
+    task.upload_queue.get_concurrency.assert_called_with('upload')
+    task.uploader.upload.assert_not_called()
+    assert task.skipped_files == {2}
+
+    large_task, = [args[0] for args, _ in task.upload_queue.enqueue.call_args_list]
+    assert isinstance(large_task, UploadTask)
+    assert large_task.filename == 'large.txt'
+    assert large_task.fileobj.path == '/acq/large.txt'
+
+    # Queued files are not uploaded again on retry
+    task.execute()
+    assert task.upload_queue.enqueue.call_count == 1
+
+
+def test_upload_batch_task_retry(temp_fs, monkeypatch):
+    tmpfs, tmpfs_url = temp_fs({'acq': ['a.txt', 'b.txt', 'c.txt']})
+    monkeypatch.setattr(upload_queue, 'BATCH_MAX_BYTES', 25)
+
+    task = make_batch_task(tmpfs_url, tmpfs, ['a.txt', 'b.txt', 'c.txt'])
+    task.uploader.upload_batch.side_effect = [None, IOError('failed'), None]
+    with pytest.raises(IOError):
+        task.execute()
+    assert task.finished == {0, 1}
+
+    # Only the failed batch is uploaded again
+    task.execute()
+    assert task.uploader.upload_batch.call_args_list[-1] == mock.call(task.container, [('c.txt', b'Hello World')],
+        max_workers=4)
+    assert task.finished == {0, 1, 2}
+
+
+def test_upload_queue_batches_by_container(temp_fs):
+    tmpfs, tmpfs_url = temp_fs({'acq': ['a.txt', 'b.txt', 'c.txt']})
+    walker = PyFsWalker(tmpfs_url, src_fs=tmpfs)
+
+    config = mock.MagicMock(skip_existing_files=False, stream_packfiles=False, memory_budget=0,
+        packfile_processes=False, adaptive_uploads=False, compress_threads=1, packfile_cache_size=0)
+    config.get_uploader.return_value.supports_batch_upload.return_value = True
+    config.get_compression_policy.return_value = None
+    queue = UploadQueue(config, mock.MagicMock(), show_progress=False)
+    queue.enqueue = mock.MagicMock()
+
+    acq1 = ContainerNode('acquisition', cid='acq1')
+    acq2 = ContainerNode('acquisition', cid='acq2')
+    queue.upload_file(acq1, 'a.txt', walker, '/acq/a.txt')
+    queue.upload_file(acq1, 'b.txt', walker, '/acq/b.txt')
+    queue.upload_file(acq2, 'c.txt', walker, '/acq/c.txt')
+    queue.flush_batch()
+
+    batch, single = [args[0] for args, _ in queue.enqueue.call_args_list]
+    assert isinstance(batch, UploadBatchTask)
+    assert [name for name, _ in batch.files] == ['a.txt', 'b.txt']
+
+    # Single files are not batched
+    assert isinstance(single, UploadTask)
+    assert single.filename == 'c.txt'
+
+
+def test_upload_queue_prefetches_and_releases_files(temp_fs):
+    tmpfs, tmpfs_url = temp_fs({'acq': ['a.txt']})
+    walker = PyFsWalker(tmpfs_url, src_fs=tmpfs)
+    walker.prefetch = mock.MagicMock()
+    walker.release = mock.MagicMock()
+
+    config = mock.MagicMock(skip_existing_files=False, stream_packfiles=False, memory_budget=0,
+        packfile_processes=False, adaptive_uploads=False, compress_threads=1, packfile_cache_size=0)
+    config.get_uploader.return_value.supports_batch_upload.return_value = False
+    config.get_compression_policy.return_value = None
+    queue = UploadQueue(config, mock.MagicMock(), show_progress=False)
+    queue.enqueue = mock.MagicMock()
+
+    queue.upload_file(ContainerNode('acquisition', cid='acq1'), 'a.txt', walker, '/acq/a.txt')
+    walker.prefetch.assert_called_once_with(['/acq/a.txt'])
+
+    task, = [args[0] for args, _ in queue.enqueue.call_args_list]
+    task.execute()
+    walker.release.assert_called_once_with(['/acq/a.txt'])
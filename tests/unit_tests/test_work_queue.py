@@ -0,0 +1,85 @@
+from flywheel_cli.importers.work_queue import Task, WorkQueue
+
+
+class MockTask(Task):
+    def __init__(self, group, size=0):
+        super(MockTask, self).__init__(group)
+        self.size = size
+        self.bytes_processed = 0
+
+    def execute(self):
+        self.bytes_processed = self.size
+        return None, None
+
+    def get_bytes_processed(self):
+        return self.bytes_processed
+
+    def get_desc(self):
+        return 'Mock {}'.format(self.group)
+
+
+def test_get_stats_empty():
+    queue = WorkQueue({'upload': 1, 'packfile': 1})
+
+    stats = queue.get_stats()
+    assert stats == {
+        'upload': {'completed': 0, 'completed_bytes': 0, 'skipped': 0, 'errors': 0,
+            'active': 0, 'limit': 1, 'waiting': 0},
+        'packfile': {'completed': 0, 'completed_bytes': 0, 'skipped': 0, 'errors': 0,
+            'active': 0, 'limit': 1, 'waiting': 0},
+    }
+
+
+def test_get_stats_incremental():
+    queue = WorkQueue({'upload': 3, 'packfile': 1})
+
+    tasks = [MockTask('upload', size=10) for _ in range(3)]
+    for task in tasks:
+        queue.enqueue(task)
+
+    # Simulate a worker
+    queue.running = True
+    for task in tasks:
+        assert queue.take('upload') is task
+        task.bytes_processed = 4
+
+    # Pending bytes are included in the totals
+    stats = queue.get_stats()
+    assert stats['upload']['completed'] == 0
+    assert stats['upload']['completed_bytes'] == 12
+    assert stats['upload']['active'] == 3
+
+    tasks[0].execute()
+    queue.complete(tasks[0])
+    queue.error(tasks[1])
+    queue.skip_task(group='packfile')
+
+    stats = queue.get_stats()
+    assert stats['upload'] == {'completed': 1, 'completed_bytes': 14, 'skipped': 0, 'errors': 1,
+        'active': 1, 'limit': 3, 'waiting': 0}
+    assert stats['packfile'] == {'completed': 0, 'completed_bytes': 0, 'skipped': 1, 'errors': 0,
+        'active': 0, 'limit': 1, 'waiting': 0}
+
+    assert queue.pending == {tasks[2]}
+    assert queue.errors == [tasks[1]]
+
+    # Stats are a snapshot
+    stats['upload']['completed'] = 100
+    assert queue.get_stats()['upload']['completed'] == 1
+
+
+def test_work_queue_executes_tasks():
+    queue = WorkQueue({'upload': 2, 'packfile': 1})
+    queue.start()
+
+    for i in range(10):
+        queue.enqueue(MockTask('upload', size=i))
+
+    queue.wait_for_finish()
+    queue.shutdown()
+
+    stats = queue.get_stats()
+    assert stats['upload']['completed'] == 10
+    assert stats['upload']['completed_bytes'] == 45
+    assert not queue.pending
+    assert not queue.has_errors()
@@ -1,3 +1,7 @@
+import time
+
+import pytest
+
 from flywheel_cli.walker import AbstractWalker, FileInfo
 
 class MockWalker(AbstractWalker):
@@ -132,3 +136,64 @@ def test_files_should_return_root_minus_walker_root_plus_file_name_if_walker_roo
         files.append(file)
 
     assert files[0] == '/path2/file1.txt'
+
+
+class TreeWalker(AbstractWalker):
+    """Walker over a dictionary of directory path to entries"""
+    def __init__(self, tree, **kwargs):
+        super(TreeWalker, self).__init__('/', **kwargs)
+        self.tree = tree
+
+    def _listdir(self, path):
+        # Finish listings out of order
+        time.sleep(0.01 * (len(path) % 3))
+        for name in self.tree[path]:
+            yield FileInfo(name.rstrip('/'), name.endswith('/'))
+
+    def open(self, path, mode='rb', **kwargs):
+        raise FileNotFoundError('File not found!')
+
+    def get_fs_url(self):
+        return self.root
+
+
+def make_tree(width, depth, root='/'):
+    tree = {root: []}
+    if depth:
+        for i in range(width):
+            name = 'dir{}'.format(i)
+            tree[root].append(name + '/')
+            tree.update(make_tree(width, depth - 1, walker_path(root, name)))
+    tree[root] += ['a.txt', 'b.dcm']
+    return tree
+
+
+def walker_path(root, name):
+    return root.rstrip('/') + '/' + name
+
+
+def walk_names(walker, **kwargs):
+    return [(root, [d.name for d in dirs], [f.name for f in files])
+        for root, dirs, files in walker.walk(**kwargs)]
+
+
+def test_concurrent_walk_matches_serial_walk():
+    tree = make_tree(3, 3)
+
+    serial = walk_names(TreeWalker(tree))
+    assert len(serial) == 40
+    assert walk_names(TreeWalker(tree, list_threads=4)) == serial
+
+    options = {'filter': ['*.dcm'], 'exclude_dirs': ['dir1']}
+    assert walk_names(TreeWalker(tree, list_threads=4, **options)) == walk_names(TreeWalker(tree, **options))
+    assert (walk_names(TreeWalker(tree, list_threads=4), subdir='dir2', max_depth=2) ==
+        walk_names(TreeWalker(tree), subdir='dir2', max_depth=2))
+
+
+def test_concurrent_walk_raises_listing_errors():
+    tree = make_tree(2, 2)
+    del tree['/dir1/dir0']
+
+    walker = TreeWalker(tree, list_threads=4)
+    with pytest.raises(KeyError):
+        list(walker.walk())
@@ -2,7 +2,7 @@ from unittest import mock
 
 import pytest
 
-from flywheel_cli.walker import factory, PyFsWalker, S3Walker
+from flywheel_cli.walker import factory, OsWalker, PyFsWalker, S3Walker
 
 
 @pytest.fixture
@@ -38,9 +38,15 @@ def test_create_walker_should_create_s3_walker_instance_for_s3_scheme(mocked_url
     assert isinstance(result, S3Walker)
 
 
-def test_create_walker_should_create_pyfs_walker_instance_for_os_scheme(mocked_urlparse):
+def test_create_walker_should_create_os_walker_instance_for_os_scheme(mocked_urlparse):
     mocked_urlparse(('osfs', '/', '/'))
 
     result = factory.create_walker('osfs://')
 
+    assert isinstance(result, OsWalker)
+
+
+def test_create_walker_should_create_pyfs_walker_instance_for_other_schemes():
+    result = factory.create_walker('mem://')
+
     assert isinstance(result, PyFsWalker)
@@ -0,0 +1,54 @@
+import fnmatch
+
+import pytest
+
+from flywheel_cli.walker.filters import PatternMatcher, PathFilter, compile_patterns
+from flywheel_cli.importers.folder import should_ignore_file
+
+
+NAMES = ['file.dcm', 'FILE.DCM', '.dcm', 'file.dcm.gz', 'notes.txt', 'Thumbs.db', '.hidden',
+    'Icon\r', 'a', 'abc', 'data[1].csv', 'dir/file.dcm', 'file.nii.gz', '']
+
+
+@pytest.mark.parametrize('patterns', [
+    [],
+    ['*'],
+    ['*.dcm'],
+    ['*.dcm', '*.gz', 'notes.txt'],
+    ['.*', 'ehthumbs.db', 'Thumbs.db', 'Icon\r'],
+    ['a*', 'file.*', '*.nii.gz'],
+    ['?', 'a?c', '[nt]otes.txt', 'data[[]1].csv', '*[0-9]*'],
+])
+def test_pattern_matcher_matches_fnmatch(patterns):
+    matcher = PatternMatcher(patterns)
+    for name in NAMES:
+        expected = any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+        assert matcher.match(name) == expected, name
+
+
+def test_compile_patterns_none():
+    assert compile_patterns(None) is None
+    assert not compile_patterns([]).match('file.dcm')
+
+
+def test_path_filter():
+    path_filter = PathFilter([['subject*', 'session*']])
+
+    assert path_filter.match(['subject1'])
+    assert path_filter.match(['subject1', 'session1'])
+    assert path_filter.match(['subject1', 'session1', 'anything'])
+    assert not path_filter.match(['subject1', 'scan1'])
+    assert not path_filter.match(['other'])
+
+    # Every pattern at least as long as the path must match
+    path_filter = PathFilter([['subject*', 'session*'], ['sub*']])
+    assert path_filter.match(['subject1'])
+    assert path_filter.match(['subject1', 'session1'])
+    assert not path_filter.match(['other'])
+
+
+def test_should_ignore_file():
+    assert should_ignore_file('.DS_Store')
+    assert should_ignore_file('Thumbs.db')
+    assert should_ignore_file('Icon\r')
+    assert not should_ignore_file('file.dcm')
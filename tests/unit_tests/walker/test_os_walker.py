@@ -0,0 +1,69 @@
+import os
+
+import fs
+import pytest
+
+from flywheel_cli.walker import OsWalker, PyFsWalker
+
+
+@pytest.fixture
+def local_tree(tmpdir):
+    tmpdir.join('a', 'one.dcm').write('one', ensure=True)
+    tmpdir.join('a', 'b', 'two.dcm').write('two!', ensure=True)
+    tmpdir.join('a', 'b', 'notes.txt').write('notes', ensure=True)
+    tmpdir.join('.hidden', 'three.dcm').write('three', ensure=True)
+    tmpdir.join('c', 'four.dcm').write('four', ensure=True)
+    os.symlink(str(tmpdir.join('c')), str(tmpdir.join('link')))
+    return 'osfs://{}'.format(tmpdir)
+
+
+def walk_result(walker, **kwargs):
+    result = []
+    for root, dirs, files in walker.walk(**kwargs):
+        result.append((root, sorted(d.name for d in dirs),
+            sorted((f.name, f.size, f.modified, f.is_link) for f in files)))
+    return sorted(result)
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'follow_symlinks': True},
+    {'ignore_dot_files': False},
+    {'filter': ['*.dcm'], 'exclude_dirs': ['c']},
+    {'filter_dirs': ['a/b']},
+])
+def test_os_walker_matches_pyfs_walker(local_tree, options):
+    os_walker = OsWalker(local_tree, **options)
+    pyfs_walker = PyFsWalker(local_tree, **options)
+
+    assert walk_result(os_walker) == walk_result(pyfs_walker)
+    assert sorted(os_walker.files()) == sorted(pyfs_walker.files())
+    assert walk_result(os_walker, subdir='a') == walk_result(pyfs_walker, subdir='a')
+
+
+def test_os_walker_open(local_tree):
+    walker = OsWalker(local_tree)
+
+    with walker.open('a/b/two.dcm') as f:
+        assert f.read() == b'two!'
+    with walker.open('/a/one.dcm', 'r') as f:
+        assert f.read() == 'one'
+
+    with pytest.raises(FileNotFoundError):
+        walker.open('a/missing.dcm')
+    with pytest.raises(fs.errors.IllegalBackReference):
+        walker.open('../outside.dcm')
+
+
+def test_os_walker_missing_root(tmpdir):
+    with pytest.raises(fs.errors.CreateFailed):
+        OsWalker('osfs://{}'.format(tmpdir.join('missing')))
+
+
+def test_os_walker_get_file_infos(local_tree):
+    walker = OsWalker(local_tree)
+
+    infos = walker.get_file_infos(['a/b/two.dcm', '/a/one.dcm', 'a/b/missing.dcm', 'a/b'])
+
+    assert [(info.name, info.size) for info in infos[:2]] == [('two.dcm', 4), ('one.dcm', 3)]
+    assert infos[2:] == [None, None]
@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+from flywheel_cli.walker.s3_cache import S3StagingCache
+
+
+class FakeDownloadClient(object):
+    def __init__(self, objects):
+        self.objects = objects
+        self.downloads = []
+        self.lock = threading.Lock()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def download_file(self, bucket, key, path):
+        self.gate.wait()
+        if key not in self.objects:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        with self.lock:
+            self.downloads.append(key)
+        with open(path, 'wb') as f:
+            f.write(self.objects[key])
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def staged_files(tmpdir):
+    return [name for name in os.listdir(str(tmpdir)) if not name.endswith('.part')]
+
+
+def test_staging_cache_evicts_least_recently_used(tmpdir):
+    client = FakeDownloadClient({'a': b'a' * 10, 'b': b'b' * 10, 'c': b'c' * 10})
+    cache = S3StagingCache(client, 'bucket', str(tmpdir), 25)
+
+    for key in ['a', 'b', 'a', 'c']:
+        with cache.open(key) as f:
+            assert f.read() == client.objects[key]
+
+    # b was least recently used when c was added
+    assert client.downloads == ['a', 'b', 'c']
+    assert cache.used == 20
+    assert len(staged_files(tmpdir)) == 2
+
+    with cache.open('b') as f:
+        assert f.read() == b'b' * 10
+    assert client.downloads == ['a', 'b', 'c', 'b']
+    cache.close()
+
+
+def test_staging_cache_release_and_prefetch(tmpdir):
+    client = FakeDownloadClient({key: key.encode() * 10 for key in 'abcd'})
+    cache = S3StagingCache(client, 'bucket', str(tmpdir), 20, download_threads=1)
+
+    # Prefetching stops once the cache is full
+    cache.prefetch(['a', 'b', 'c', 'd'])
+    wait_for(lambda: cache.used == 20)
+    cache.close()
+    assert client.downloads == ['a', 'b']
+    assert cache.used == 20
+
+    # Released files are removed
+    cache.release(['a'])
+    assert cache.used == 10
+    assert len(staged_files(tmpdir)) == 1
+
+    # Reading a prefetched file does not download it again
+    with cache.open('b') as f:
+        assert f.read() == b'b' * 10
+    assert client.downloads == ['a', 'b']
+
+
+def test_staging_cache_waits_for_prefetch(tmpdir):
+    client = FakeDownloadClient({'a': b'a' * 10})
+    client.gate.clear()
+    cache = S3StagingCache(client, 'bucket', str(tmpdir), 100)
+    cache.prefetch(['a'])
+
+    threading.Timer(0.05, client.gate.set).start()
+    with cache.open('a') as f:
+        assert f.read() == b'a' * 10
+    assert client.downloads == ['a']
+
+    with pytest.raises(ClientError):
+        cache.open('missing')
+    cache.close()
@@ -1,11 +1,12 @@
 import datetime
+import io
 from unittest import mock
-import os
 
-import fs
 import pytest
+from botocore.exceptions import ClientError
 
 from flywheel_cli.walker import S3Walker
+from flywheel_cli.walker.s3_file import MAX_READ_AHEAD, MIN_READ_AHEAD
 
 fs_url = 's3://bucket/path/'
 
@@ -55,42 +56,6 @@ def mocked_boto3_pagination():
         mocked_boto3_patch.stop()
 
 
-@pytest.fixture
-def mocked_open():
-    mocked_open_patch = mock.patch('flywheel_cli.walker.s3_walker.open')
-    yield mocked_open_patch.start()
-
-    mocked_open_patch.stop()
-
-
-@pytest.fixture
-def mocked_open_return():
-    mocked_open_patch = None
-
-    def patcher(is_side_effect, return_value=None):
-        nonlocal mocked_open_patch
-        mocked_open_patch = mock.patch('flywheel_cli.walker.s3_walker.open')
-        mocked_open = mocked_open_patch.start()
-        if is_side_effect:
-            mocked_open.side_effect = return_value
-        else:
-            mocked_open.return_value = return_value
-        return mocked_open
-
-    yield patcher
-
-    if mocked_open_patch is not None:
-        mocked_open_patch.stop()
-
-
-@pytest.fixture
-def mocked_os():
-    mocked_os_patch = mock.patch('flywheel_cli.walker.s3_walker.os')
-    yield mocked_os_patch.start()
-
-    mocked_os_patch.stop()
-
-
 @pytest.fixture
 def mocked_shutil():
     mocked_shutil_patch = mock.patch('flywheel_cli.walker.s3_walker.shutil')
@@ -496,116 +461,168 @@ def test_listdir_should_not_yield_files_if_they_do_not_exist_without_path(mocked
     assert len(files) == 0
 
 
-def test_open_should_request_isfile_from_os_path(mocked_boto3, mocked_open, mocked_os, mocked_shutil, mocked_tempfile,
-                                                 mocked_urlparse):
-    mocked_urlparse((None, 'bucket', '/'))
-    mocked_os.path.join = mock.MagicMock(return_value='/tmp/dir1/file.txt')
+class FakeObjectClient(object):
+    """Serves ranged GETs for in-memory objects"""
+    def __init__(self, objects):
+        self.objects = objects
+        self.ranges = []
+
+    def get_object(self, Bucket, Key, Range):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        data = self.objects[Key]
+        start, end = [int(x) for x in Range[len('bytes='):].split('-')]
+        if start >= len(data):
+            raise ClientError({'Error': {'Code': 'InvalidRange'}}, 'GetObject')
+        self.ranges.append((Key, start, end))
+        chunk = data[start:end+1]
+        return {
+            'Body': io.BytesIO(chunk),
+            'ContentLength': len(chunk),
+            'ContentRange': 'bytes {}-{}/{}'.format(start, start + len(chunk) - 1, len(data)),
+        }
+
+
+def make_data(size):
+    return (bytes(range(251)) * (size // 251 + 1))[:size]
+
+
+def test_open_should_read_only_the_header_range(mocked_boto3, mocked_urlparse):
+    mocked_urlparse((None, 'bucket', 'path/'))
+    data = make_data(10 * MAX_READ_AHEAD)
+    client = mocked_boto3.client.return_value = FakeObjectClient({'path/dir1/file.dcm': data})
     walker = S3Walker(fs_url)
-    walker.tmp_dir_path = '/tmp'
 
-    walker.open('/dir1/file.txt')
+    with walker.open('/dir1/file.dcm') as f:
+        assert f.read(132) == data[:132]
+        f.seek(128)
+        assert f.read(4) == data[128:132]
 
-    mocked_os.path.isfile.assert_called_with('/tmp/dir1/file.txt')
+    assert client.ranges == [('path/dir1/file.dcm', 0, MIN_READ_AHEAD - 1)]
 
 
-def test_open_should_request_makedirs_from_os_for_root_path_if_file_does_not_exist(mocked_boto3, mocked_open,
-                                                                                   mocked_os, mocked_shutil,
-                                                                                   mocked_tempfile, mocked_urlparse):
+def test_open_should_read_sequentially_with_growing_read_ahead(mocked_boto3, mocked_urlparse):
     mocked_urlparse((None, 'bucket', '/'))
-    mocked_os.path.isfile = mock.MagicMock(return_value=False)
-    mocked_os.path.join = mock.MagicMock(return_value='/tmp')
+    data = make_data(3 * MAX_READ_AHEAD + 100)
+    client = mocked_boto3.client.return_value = FakeObjectClient({'dir1/file.dcm': data})
     walker = S3Walker(fs_url)
-    walker.tmp_dir_path = '/tmp'
 
-    walker.open('/')
+    with walker.open('/dir1/file.dcm') as f:
+        chunks = list(iter(lambda: f.read(65536), b''))
+        assert b''.join(chunks) == data
+
+        f.seek(-100, io.SEEK_END)
+        assert f.read() == data[-100:]
+        f.seek(10)
+        assert f.read(10) == data[10:20]
 
-    mocked_os.makedirs.assert_called_with('/tmp', exist_ok=True)
+    sizes = [end - start + 1 for _, start, end in client.ranges]
+    assert max(sizes) == MAX_READ_AHEAD
+    assert len(client.ranges) < 15
 
 
-def test_open_should_request_makedirs_from_os_if_file_does_not_exist(mocked_boto3, mocked_open, mocked_os,
-                                                                     mocked_shutil, mocked_tempfile, mocked_urlparse):
+def test_open_should_support_text_mode_and_empty_files(mocked_boto3, mocked_urlparse):
     mocked_urlparse((None, 'bucket', '/'))
-    mocked_os.path.isfile = mock.MagicMock(return_value=False)
-    mocked_os.path.join = mock.MagicMock(return_value='/tmp/dir1/dir2')
+    mocked_boto3.client.return_value = FakeObjectClient({'a.txt': b'line1\nline2\n', 'empty.txt': b''})
     walker = S3Walker(fs_url)
-    walker.tmp_dir_path = '/tmp'
 
-    walker.open('/dir1/dir2/file.txt')
+    with walker.open('a.txt', 'r') as f:
+        assert f.readlines() == ['line1\n', 'line2\n']
 
-    mocked_os.makedirs.assert_called_with('/tmp/dir1/dir2', exist_ok=True)
+    with walker.open('empty.txt') as f:
+        assert f.read() == b''
 
 
-def test_open_should_request_download_file_from_boto3_client_if_file_does_not_exist(mocked_boto3, mocked_open,
-                                                                                    mocked_os, mocked_shutil,
-                                                                                    mocked_tempfile, mocked_urlparse):
+def test_open_should_throw_if_file_is_not_found(mocked_boto3, mocked_urlparse):
     mocked_urlparse((None, 'bucket', '/path/'))
-    mocked_os.path.isfile = mock.MagicMock(return_value=False)
-    mocked_os.path.join = mock.MagicMock(side_effect=['/tmp/path/dir1/file.txt', 'path/dir1/file.txt'])
+    mocked_boto3.client.return_value = FakeObjectClient({})
     walker = S3Walker(fs_url)
-    walker.tmp_dir_path = '/tmp'
 
-    walker.open('/dir1/file.txt')
+    with pytest.raises(FileNotFoundError, match=r'File /dir1/file.txt not found'):
+        walker.open('/dir1/file.txt')
 
-    walker.client.download_file.assert_called_with('bucket', 'path/dir1/file.txt', '/tmp/path/dir1/file.txt')
 
+class FakeS3Client(object):
+    """Lists keys like S3, with and without a delimiter"""
+    def __init__(self, keys, page_size=2):
+        self.keys = sorted(keys)
+        self.page_size = page_size
+        self.requests = []
 
-def test_open_should_request_download_file_from_boto3_client_if_file_does_not_exist_for_root(mocked_boto3, mocked_open,
-                                                                                             mocked_os, mocked_shutil,
-                                                                                             mocked_tempfile,
-                                                                                             mocked_urlparse):
-    mocked_urlparse((None, 'bucket', '/'))
-    mocked_os.path.isfile = mock.MagicMock(return_value=False)
-    mocked_os.path.join = mock.MagicMock(side_effect=['/tmp/path/dir1/file.txt', 'path/dir1/file.txt'])
-    walker = S3Walker(fs_url)
-    walker.tmp_dir_path = '/tmp'
+    def get_paginator(self, operation):
+        client = self
+        class Paginator(object):
+            def paginate(self, Bucket, Prefix, Delimiter=None):
+                return client.paginate(operation, Prefix, Delimiter)
+        return Paginator()
 
-    walker.open('/dir1/file.txt')
+    def paginate(self, operation, prefix, delimiter):
+        contents = []
+        prefixes = []
+        for key in self.keys:
+            if not key.startswith(prefix):
+                continue
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                common_prefix = prefix + rest.split(delimiter)[0] + delimiter
+                if common_prefix not in prefixes:
+                    prefixes.append(common_prefix)
+            else:
+                contents.append({'Key': key, 'Size': len(key), 'LastModified': datetime.datetime(2019, 1, 1)})
 
-    walker.client.download_file.assert_called_with('bucket', 'dir1/file.txt', '/tmp/path/dir1/file.txt')
+        for i in range(0, max(len(contents), 1), self.page_size):
+            self.requests.append((operation, prefix))
+            page = {'Contents': contents[i:i+self.page_size]}
+            if i == 0 and prefixes:
+                page['CommonPrefixes'] = [{'Prefix': p} for p in prefixes]
+            yield page
 
 
-def test_open_should_not_request_download_file_from_boto3_client_if_file_exists(mocked_boto3, mocked_open, mocked_os,
-                                                                                mocked_shutil, mocked_tempfile,
-                                                                                mocked_urlparse):
-    mocked_urlparse((None, 'bucket', '/path/'))
-    mocked_os.path.isfile = mock.MagicMock(return_value=True)
-    walker = S3Walker(fs_url)
-    walker.tmp_dir_path = '/tmp'
+S3_KEYS = [
+    'path/a/1.dcm', 'path/a/2.dcm', 'path/a/b/3.dcm', 'path/a/b/c/4.dcm', 'path/a/b/c/notes.txt',
+    'path/d/5.dcm', 'path/d/.hidden/6.dcm', 'path/7.dcm', 'other/8.dcm',
+]
 
-    walker.open('/dir1/file.txt')
 
-    walker.client.download_file.assert_not_called()
+def walk_result(walker, **kwargs):
+    return [(root, [d.name for d in dirs], [(f.name, f.size) for f in files])
+        for root, dirs, files in walker.walk(**kwargs)]
 
 
-def test_open_should_request_open(mocked_boto3, mocked_open, mocked_os, mocked_shutil, mocked_tempfile,
-                                  mocked_urlparse):
-    mocked_urlparse((None, 'bucket', '/path/'))
-    mocked_os.path.join = mock.MagicMock(return_value='/tmp/path/dir1/file.txt')
-    walker = S3Walker(fs_url)
-    walker.tmp_dir_path = '/tmp'
+@pytest.mark.parametrize('options', [{}, {'filter': ['*.dcm'], 'exclude_dirs': ['b']}, {'filter_dirs': ['a/b']}])
+def test_flat_listing_matches_delimiter_listing(mocked_boto3, options):
+    mocked_boto3.client.return_value = FakeS3Client(S3_KEYS)
+    expected = walk_result(S3Walker(fs_url, **options))
 
-    walker.open('/dir1/file.txt')
+    client = mocked_boto3.client.return_value = FakeS3Client(S3_KEYS)
+    walker = S3Walker(fs_url, flat_listing=True, **options)
+    assert walk_result(walker) == expected
 
-    mocked_open.assert_called_with('/tmp/path/dir1/file.txt', 'rb')
+    # The whole tree was listed at once
+    assert client.requests == [('list_objects_v2', 'path/')] * 4
 
+    # Later walks below the root are answered from the index
+    mocked_boto3.client.return_value = FakeS3Client(S3_KEYS)
+    assert walk_result(walker, subdir='a', max_depth=1) == walk_result(S3Walker(fs_url, **options),
+        subdir='a', max_depth=1)
+    assert len(client.requests) == 4
 
-def test_open_should_return_result_from_open(mocked_boto3, mocked_open_return, mocked_os, mocked_shutil,
-                                             mocked_tempfile, mocked_urlparse):
-    mocked_open_return(False, {})
-    mocked_urlparse((None, 'bucket', 'path/'))
-    walker = S3Walker(fs_url)
 
-    result = walker.open('/')
+def test_open_should_use_staging_cache(mocked_boto3, mocked_urlparse):
+    from .test_s3_cache import FakeDownloadClient
 
-    assert result == {}
+    mocked_urlparse((None, 'bucket', 'path/'))
+    client = mocked_boto3.client.return_value = FakeDownloadClient({'path/dir1/file.dcm': b'data'})
+    walker = S3Walker(fs_url, cache_size=1024)
+    assert walker.get_options()['cache_size'] == 1024
 
+    walker.prefetch(['/dir1/file.dcm'])
+    with walker.open('/dir1/file.dcm') as f:
+        assert f.read() == b'data'
+    assert client.downloads == ['path/dir1/file.dcm']
 
-def test_open_should_throw_if_file_if_resource_not_found_exception_is_thrown(mocked_boto3, mocked_open_return,
-                                                                             mocked_os, mocked_shutil, mocked_tempfile,
-                                                                             mocked_urlparse):
-    mocked_open_return(True, fs.errors.ResourceNotFound('not found'))
-    mocked_urlparse((None, 'bucket', '/path/'))
-    walker = S3Walker(fs_url)
+    with pytest.raises(FileNotFoundError):
+        walker.open('/dir1/missing.dcm')
 
-    with pytest.raises(FileNotFoundError, match=r'File /dir1/file.txt not found'):
-        walker.open('/dir1/file.txt')
+    walker.release(['/dir1/file.dcm'])
+    walker.close()
@@ -0,0 +1,198 @@
+import io
+import os
+import tarfile
+
+import fs.tarfs
+import pytest
+
+from flywheel_cli.walker import create_archive_walker, factory, PyFsWalker, TarStreamWalker
+
+
+@pytest.fixture
+def tar_archive(tmpdir):
+    src = tmpdir.join('src')
+    src.join('a', 'one.dcm').write('one', ensure=True)
+    src.join('a', 'b', 'two.dcm').write('two!', ensure=True)
+    src.join('a', 'b', 'notes.txt').write('notes', ensure=True)
+    src.join('.hidden', 'three.dcm').write('three', ensure=True)
+    src.join('c', 'four.dcm').write('four', ensure=True)
+
+    path = str(tmpdir.join('archive.tar.gz'))
+    with tarfile.open(path, 'w:gz') as archive:
+        archive.add(str(src), arcname='.')
+        # Member whose parent directory has no entry of its own, and a link (TarFS lists it as a file)
+        data = b'five'
+        info = tarfile.TarInfo('d/e/five.dcm')
+        info.size = len(data)
+        archive.addfile(info, io.BytesIO(data))
+        info = tarfile.TarInfo('d/link.dcm')
+        info.type = tarfile.SYMTYPE
+        info.linkname = 'e/five.dcm'
+        archive.addfile(info)
+    return path
+
+
+class CountingFile(io.FileIO):
+    read_bytes = 0
+    seeks = 0
+
+    def read(self, size=-1):
+        data = super(CountingFile, self).read(size)
+        self.read_bytes += len(data)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.seeks += 1
+        return super(CountingFile, self).seek(offset, whence)
+
+
+def walk_result(walker, **kwargs):
+    result = []
+    for root, dirs, files in walker.walk(**kwargs):
+        result.append((root, sorted(d.name for d in dirs),
+            sorted((f.name, f.size) for f in files if f.name != 'link.dcm')))
+    return sorted(result)
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'ignore_dot_files': False},
+    {'filter': ['*.dcm'], 'exclude_dirs': ['c']},
+    {'filter_dirs': ['a/b']},
+])
+def test_tar_stream_walker_matches_tarfs(tar_archive, options):
+    tar_walker = TarStreamWalker('tar://{}'.format(tar_archive), **options)
+    pyfs_walker = PyFsWalker(tar_archive, src_fs=fs.tarfs.TarFS(tar_archive), **options)
+
+    assert walk_result(tar_walker) == walk_result(pyfs_walker)
+    assert walk_result(tar_walker, subdir='a') == walk_result(pyfs_walker, subdir='a')
+    assert sorted(tar_walker.files()) == sorted(p for p in pyfs_walker.files() if p != 'd/link.dcm')
+
+
+def test_tar_stream_walker_reads_archive_sequentially(tar_archive):
+    fileobj = CountingFile(tar_archive)
+    walker = TarStreamWalker(tar_archive, fileobj=fileobj)
+
+    # Listing only reads the headers
+    assert sorted(walker.files()) == ['a/b/notes.txt', 'a/b/two.dcm', 'a/one.dcm', 'c/four.dcm', 'd/e/five.dcm']
+    list(walker.walk())
+    assert fileobj.read_bytes <= os.path.getsize(tar_archive)
+    assert fileobj.seeks == 0
+    assert os.listdir(walker.tmp_dir_path) == []
+
+    # Opening files reads the data in a second pass, staging members up to the opened file
+    with walker.open('/d/e/five.dcm', 'r') as f:
+        assert f.read() == 'five'
+    staged_count = len(os.listdir(walker.tmp_dir_path))
+    with walker.open('a/b/two.dcm') as f:
+        assert f.read() == b'two!'
+    assert fileobj.read_bytes <= 2 * os.path.getsize(tar_archive)
+    assert fileobj.seeks == 1
+    assert len(os.listdir(walker.tmp_dir_path)) == staged_count
+
+    with pytest.raises(FileNotFoundError):
+        walker.open('a/missing.dcm')
+
+    walker.close()
+    assert fileobj.closed
+    assert not os.path.exists(walker.tmp_dir_path)
+
+
+def test_tar_stream_walker_release_removes_staged_files(tar_archive):
+    walker = TarStreamWalker('tar://{}'.format(tar_archive))
+    list(walker.files())
+    walker.release(['a/b/two.dcm'])
+    with walker.open('a/one.dcm') as f:
+        assert f.read() == b'one'
+    staged_count = len(os.listdir(walker.tmp_dir_path))
+
+    walker.release(['a/one.dcm', 'a/missing.dcm'])
+    assert len(os.listdir(walker.tmp_dir_path)) == staged_count - 1
+
+    # Released files are not staged by the pass, unless they are opened again
+    with walker.open('c/four.dcm') as f:
+        assert f.read() == b'four'
+    assert 'a/b/two.dcm' not in walker._staged
+    with walker.open('a/one.dcm') as f:
+        assert f.read() == b'one'
+    walker.close()
+
+
+def test_tar_stream_walker_not_seekable(tar_archive):
+    class PipeFile(io.FileIO):
+        def seekable(self):
+            return False
+
+    walker = TarStreamWalker(tar_archive, fileobj=PipeFile(tar_archive))
+
+    # Files are staged while the headers are read, since the archive can't be read again
+    assert 'a/one.dcm' in list(walker.files())
+    assert len(os.listdir(walker.tmp_dir_path)) == 6
+    with walker.open('a/one.dcm') as f:
+        assert f.read() == b'one'
+
+    walker.release(['a/one.dcm'])
+    with pytest.raises(FileNotFoundError):
+        walker.open('a/one.dcm')
+    walker.close()
+
+
+def test_tar_stream_walker_skips_members_outside_archive(tmpdir):
+    path = str(tmpdir.join('escape.tar'))
+    with tarfile.open(path, 'w') as archive:
+        for name, data in [('../outside.dcm', b'outside'), ('a/one.dcm', b'one')]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+    walker = TarStreamWalker('tar://{}'.format(path))
+    assert list(walker.files()) == ['a/one.dcm']
+    with walker.open('a/one.dcm') as f:
+        assert f.read() == b'one'
+    walker.close()
+
+
+def test_create_walker_should_create_tar_stream_walker_for_tar_scheme(tar_archive):
+    assert isinstance(factory.create_walker('tar://{}'.format(tar_archive)), TarStreamWalker)
+
+
+def test_create_archive_walker_tar(tar_archive, tmpdir):
+    walker = factory.create_walker('osfs://{}'.format(tmpdir))
+
+    archive_walker = create_archive_walker(walker, 'archive.tar.gz')
+
+    assert isinstance(archive_walker, TarStreamWalker)
+    assert 'c/four.dcm' in list(archive_walker.files())
+    archive_walker.close()
+
+
+def test_tar_stream_walker_keeps_last_duplicate_member(tmpdir):
+    path = str(tmpdir.join('duplicates.tar'))
+    with tarfile.open(path, 'w') as archive:
+        for name, data in [('a/one.dcm', b'first'), ('a/two.dcm', b'two'), ('a/one.dcm', b'second!')]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+    walker = TarStreamWalker('tar://{}'.format(path))
+
+    assert walk_result(walker) == [('/', ['a'], []), ('/a', [], [('one.dcm', 7), ('two.dcm', 3)])]
+    with walker.open('a/one.dcm') as f:
+        assert f.read() == b'second!'
+    with walker.open('a/two.dcm') as f:
+        assert f.read() == b'two'
+    assert len(os.listdir(walker.tmp_dir_path)) == 2
+    walker.close()
+
+
+def test_tar_stream_walker_stages_in_tmp_dir(tar_archive, tmpdir):
+    tmp_dir = tmpdir.mkdir('staging')
+
+    walker = factory.create_walker('tar://{}'.format(tar_archive), tmp_dir=str(tmp_dir))
+    with walker.open('c/four.dcm') as f:
+        assert f.read() == b'four'
+
+    assert os.path.dirname(walker.tmp_dir_path) == str(tmp_dir)
+    assert os.listdir(walker.tmp_dir_path)
+    walker.close()
+    assert tmp_dir.listdir() == []
@@ -0,0 +1,83 @@
+import zipfile
+import zlib
+
+import fs.zipfs
+import pytest
+
+from flywheel_cli.walker import create_archive_walker, factory, PyFsWalker, ZipWalker
+
+
+@pytest.fixture
+def zip_archive(tmpdir):
+    path = str(tmpdir.join('archive.zip'))
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('a/', b'')
+        zf.writestr('a/one.dcm', b'one' * 100)
+        zf.writestr('a/b/two.dcm', b'two!')
+        zf.writestr('a/b/notes.txt', b'notes', compress_type=zipfile.ZIP_STORED)
+        zf.writestr('.hidden/three.dcm', b'three')
+        # No directory entries for c
+        zf.writestr('c/four.dcm', b'four')
+    return path
+
+
+def walk_result(walker, **kwargs):
+    result = []
+    for root, dirs, files in walker.walk(**kwargs):
+        result.append((root, sorted(d.name for d in dirs), sorted((f.name, f.size) for f in files)))
+    return sorted(result)
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'ignore_dot_files': False},
+    {'filter': ['*.dcm'], 'exclude_dirs': ['c']},
+    {'filter_dirs': ['a/b']},
+])
+def test_zip_walker_matches_zipfs(zip_archive, options):
+    zip_walker = ZipWalker('zip://{}'.format(zip_archive), **options)
+    pyfs_walker = PyFsWalker(zip_archive, src_fs=fs.zipfs.ZipFS(zip_archive), **options)
+
+    assert walk_result(zip_walker) == walk_result(pyfs_walker)
+    assert walk_result(zip_walker, subdir='a') == walk_result(pyfs_walker, subdir='a')
+    assert sorted(zip_walker.files()) == sorted(pyfs_walker.files())
+    zip_walker.close()
+
+
+def test_zip_walker_open(zip_archive):
+    walker = ZipWalker(zip_archive, fileobj=open(zip_archive, 'rb'))
+
+    with walker.open('a/one.dcm') as f:
+        assert f.read() == b'one' * 100
+    with walker.open('/a/b/notes.txt', 'r') as f:
+        assert f.read() == 'notes'
+    with pytest.raises(FileNotFoundError):
+        walker.open('a/missing.dcm')
+    walker.close()
+
+
+def test_zip_walker_open_compressed(zip_archive):
+    walker = ZipWalker('zip://{}'.format(zip_archive))
+    assert walker.can_open_compressed()
+
+    info, src_file = walker.open_compressed('a/one.dcm')
+    with src_file:
+        data = src_file.read()
+    assert info.compress_type == zipfile.ZIP_DEFLATED
+    assert len(data) == info.compress_size
+    assert zlib.decompress(data, -15) == b'one' * 100
+
+    info, src_file = walker.open_compressed('a/b/notes.txt')
+    with src_file:
+        assert src_file.read() == b'notes'
+    walker.close()
+
+
+def test_create_archive_walker_zip(zip_archive, tmpdir):
+    walker = factory.create_walker('osfs://{}'.format(tmpdir))
+
+    archive_walker = create_archive_walker(walker, 'archive.zip')
+
+    assert isinstance(archive_walker, ZipWalker)
+    assert 'c/four.dcm' in list(archive_walker.files())
+    archive_walker.close()